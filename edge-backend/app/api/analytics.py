@@ -0,0 +1,437 @@
+"""
+Yield / SPC analytics over the inspection history.
+
+Every finished run is ingested once into column arrays (numpy), one entry per
+inspected point and one per detection. Columns are persisted as append-only raw
+files under ANALYTICS_DIR (np.tofile / np.fromfile), the run table as JSON lines,
+so ingesting a run costs O(points of that run) and a restart loads everything
+with a few reads. Queries are vectorised (bincount / histogram2d) over these
+arrays and take milliseconds even for months of runs.
+
+Overrides from the Review UI patch the NG column in place; deleted runs are
+masked out.
+"""
+from fastapi import APIRouter, HTTPException
+from typing import Dict, Iterable, List, Optional
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from app.api import journal, history_index
+
+router = APIRouter()
+
+ANALYTICS_DIR = os.getenv("AOI_ANALYTICS_DIR", "/app/data/analytics")
+
+# name -> dtype of the per-point and per-detection columns
+POINT_COLUMNS = {"run": np.int32, "point_id": np.int32, "x": np.float32, "y": np.float32, "ng": np.int8}
+DET_COLUMNS = {"row": np.int64, "label": np.int16, "confidence": np.float32}
+
+
+class _Columns:
+    """Growable column arrays (capacity doubling) backed by append-only files"""
+    def __init__(self, directory: str, prefix: str, dtypes: Dict):
+        self.directory = directory
+        self.prefix = prefix
+        self.dtypes = dtypes
+        self.n = 0
+        self.cols = {k: np.empty(1024, dtype=t) for k, t in dtypes.items()}
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{self.prefix}_{name}.bin")
+
+    def load(self, n: int):
+        """Read the files, dropping anything past n (tail of an interrupted ingest)"""
+        for k, t in self.dtypes.items():
+            p = self.path(k)
+            data = np.fromfile(p, dtype=t) if os.path.exists(p) else np.empty(0, dtype=t)
+            if len(data) < n:
+                raise ValueError(f"Analytics column {p} is shorter than the run table")
+            if len(data) > n:
+                with open(p, "r+b") as f:
+                    f.truncate(n * np.dtype(t).itemsize)
+            self.cols[k] = np.resize(data[:n], max(1024, n * 2))
+        self.n = n
+
+    def append(self, arrays: Dict[str, np.ndarray]):
+        m = len(next(iter(arrays.values())))
+        need = self.n + m
+        for k, t in self.dtypes.items():
+            a = np.asarray(arrays[k], dtype=t)
+            if need > len(self.cols[k]):
+                grown = np.empty(max(need, len(self.cols[k]) * 2), dtype=t)
+                grown[:self.n] = self.cols[k][:self.n]
+                self.cols[k] = grown
+            self.cols[k][self.n:need] = a
+            with open(self.path(k), "ab") as f:
+                a.tofile(f)
+        self.n = need
+
+    def patch(self, name: str, index: int, value):
+        self.cols[name][index] = value
+        t = np.dtype(self.dtypes[name])
+        with open(self.path(name), "r+b") as f:
+            f.seek(index * t.itemsize)
+            f.write(np.asarray([value], dtype=t).tobytes())
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.cols[name][:self.n]
+
+    def reset(self):
+        for k in self.dtypes:
+            if os.path.exists(self.path(k)):
+                os.remove(self.path(k))
+        self.n = 0
+
+
+class AnalyticsStore:
+    def __init__(self, directory: str = ANALYTICS_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self.runs: List[Dict] = [] # run_id, completed_at, part_no, batch_no, program_name, rows [a, b), deleted
+        self.run_index: Dict[str, int] = {}
+        self.labels: List[str] = []
+        self.label_index: Dict[str, int] = {}
+        self.points = _Columns(directory, "points", POINT_COLUMNS)
+        self.dets = _Columns(directory, "dets", DET_COLUMNS)
+        self.loaded = False
+
+    @property
+    def _runs_path(self) -> str:
+        return os.path.join(self.directory, "runs.jsonl")
+
+    def _log(self, record: Dict):
+        with open(self._runs_path, "a") as f:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    # --- Persistence ---
+    def load(self):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            self.runs, self.run_index, self.labels, self.label_index = [], {}, [], {}
+            if os.path.exists(self._runs_path):
+                with open(self._runs_path, "r") as f:
+                    for line in f:
+                        try:
+                            rec = json.loads(line)
+                        except ValueError:
+                            continue # Torn last line
+                        kind = rec.pop("type")
+                        if kind == "run":
+                            for label in rec.pop("new_labels", []):
+                                self.label_index[label] = len(self.labels)
+                                self.labels.append(label)
+                            self.run_index[rec["run_id"]] = len(self.runs)
+                            self.runs.append(rec)
+                        elif kind == "delete" and rec["run_id"] in self.run_index:
+                            self.runs[self.run_index[rec["run_id"]]]["deleted"] = True
+            # The run record is written last: columns are valid up to the last run
+            last = self.runs[-1] if self.runs else {"rows": [0, 0], "dets": [0, 0]}
+            self.points.load(last["rows"][1])
+            self.dets.load(last["dets"][1])
+            self.loaded = True
+        print(f"Analytics: {len(self.runs)} runs, {self.points.n} points, {self.dets.n} detections")
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def reset(self):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            self.points.reset()
+            self.dets.reset()
+            if os.path.exists(self._runs_path):
+                os.remove(self._runs_path)
+            self.runs, self.run_index, self.labels, self.label_index = [], {}, [], {}
+            self.loaded = True
+
+    # --- Ingest / updates ---
+    def ingest(self, run_id: str, run: Dict, results: Iterable[Dict]) -> bool:
+        """Add one finished run. run: index row (part_no, batch_no, program_name, completed_at)"""
+        self._ensure_loaded()
+        if run_id in self.run_index:
+            return False
+        pt_id, xs, ys, ng = [], [], [], []
+        det_row, det_conf = [], []
+        labels = []
+        for r in results:
+            for d in r.get("detections") or []:
+                det_row.append(len(pt_id))
+                labels.append(d.get("label", ""))
+                det_conf.append(d.get("confidence") or 0.0)
+            pt_id.append(r["point_id"])
+            xs.append(r.get("x", 0.0))
+            ys.append(r.get("y", 0.0))
+            ng.append(r["result"] == "NG")
+
+        with self._lock:
+            if run_id in self.run_index:
+                return False
+            new_labels = []
+            for label in labels:
+                if label not in self.label_index:
+                    self.label_index[label] = len(self.labels)
+                    self.labels.append(label)
+                    new_labels.append(label)
+            idx = len(self.runs)
+            rows = [self.points.n, self.points.n + len(pt_id)]
+            dets = [self.dets.n, self.dets.n + len(det_row)]
+            self.points.append({"run": np.full(len(pt_id), idx), "point_id": pt_id, "x": xs, "y": ys, "ng": ng})
+            if det_row:
+                self.dets.append({"row": np.asarray(det_row, dtype=np.int64) + rows[0],
+                                  "label": [self.label_index[l] for l in labels], "confidence": det_conf})
+            rec = {
+                "run_id": run_id,
+                "completed_at": run.get("completed_at") or time.time(),
+                "part_no": run.get("part_no") or "",
+                "batch_no": run.get("batch_no") or "",
+                "program_name": run.get("program_name") or "",
+                "rows": rows,
+                "dets": dets,
+            }
+            self._log({"type": "run", **rec, "new_labels": new_labels})
+            self.run_index[run_id] = idx
+            self.runs.append(rec)
+        return True
+
+    def set_result(self, run_id: str, point_id: int, result: str):
+        self._ensure_loaded()
+        with self._lock:
+            if run_id not in self.run_index:
+                return
+            a, b = self.runs[self.run_index[run_id]]["rows"]
+            hits = np.nonzero(self.points["point_id"][a:b] == point_id)[0]
+            for h in hits:
+                self.points.patch("ng", a + int(h), result == "NG")
+
+    def remove_run(self, run_id: str):
+        self._ensure_loaded()
+        with self._lock:
+            if run_id in self.run_index:
+                self.runs[self.run_index[run_id]]["deleted"] = True
+                self._log({"type": "delete", "run_id": run_id})
+
+    # --- Queries ---
+    def _run_mask(self, part_no=None, program_name=None, batch_no=None, last_runs=None,
+                  date_from=None, date_to=None) -> np.ndarray:
+        mask = np.array([not r.get("deleted") for r in self.runs], dtype=bool)
+        for key, val in (("part_no", part_no), ("program_name", program_name), ("batch_no", batch_no)):
+            if val:
+                mask &= np.array([r[key] == val for r in self.runs], dtype=bool)
+        if date_from is not None or date_to is not None:
+            t = np.array([r["completed_at"] for r in self.runs], dtype=np.float64)
+            if date_from is not None:
+                mask &= t >= date_from
+            if date_to is not None:
+                mask &= t < date_to
+        if last_runs:
+            # Most recent N of the runs that passed the filters (ingest order = completion order)
+            keep = np.nonzero(mask)[0][-last_runs:]
+            mask = np.zeros(len(self.runs), dtype=bool)
+            mask[keep] = True
+        return mask
+
+    def _rows(self, **filters):
+        """Boolean mask over point rows + the run mask"""
+        run_mask = self._run_mask(**filters)
+        if not len(run_mask):
+            return np.zeros(0, dtype=bool), run_mask
+        return run_mask[self.points["run"]], run_mask
+
+    def ng_rate_by_point(self, **filters) -> List[Dict]:
+        self._ensure_loaded()
+        with self._lock:
+            rows, _ = self._rows(**filters)
+            pid = self.points["point_id"][rows]
+            ng = self.points["ng"][rows]
+            if not len(pid):
+                return []
+            total = np.bincount(pid)
+            bad = np.bincount(pid, weights=ng)
+        ids = np.nonzero(total)[0]
+        rate = bad[ids] / total[ids]
+        order = np.lexsort((ids, -rate))
+        return [{"point_id": int(ids[i]), "inspected": int(total[ids[i]]), "ng": int(bad[ids[i]]),
+                 "ng_rate": round(float(rate[i]), 4)} for i in order]
+
+    def pareto(self, **filters) -> List[Dict]:
+        """Detection counts per label, largest first, with cumulative share"""
+        self._ensure_loaded()
+        with self._lock:
+            rows, _ = self._rows(**filters)
+            if not self.dets.n or not len(rows):
+                return []
+            keep = rows[self.dets["row"]]
+            counts = np.bincount(self.dets["label"][keep], minlength=len(self.labels))
+            labels = list(self.labels)
+        total = counts.sum()
+        if not total:
+            return []
+        order = np.argsort(-counts, kind="stable")
+        order = order[counts[order] > 0]
+        cum = np.cumsum(counts[order]) / total
+        return [{"label": labels[i], "count": int(counts[i]), "percent": round(100.0 * counts[i] / total, 2),
+                 "cumulative_percent": round(100.0 * c, 2)} for i, c in zip(order, cum)]
+
+    def trend_by_batch(self, **filters) -> List[Dict]:
+        self._ensure_loaded()
+        with self._lock:
+            rows, run_mask = self._rows(**filters)
+            if not run_mask.any():
+                return []
+            run_ids = np.nonzero(run_mask)[0]
+            batches = [self.runs[i]["batch_no"] for i in run_ids]
+            times = np.array([self.runs[i]["completed_at"] for i in run_ids])
+            # Points and NG per run, then per batch
+            run_of_row = self.points["run"][rows]
+            n_runs = len(self.runs)
+            per_run_total = np.bincount(run_of_row, minlength=n_runs)[run_ids]
+            per_run_ng = np.bincount(run_of_row, weights=self.points["ng"][rows], minlength=n_runs)[run_ids]
+        names, inv = np.unique(batches, return_inverse=True)
+        total = np.bincount(inv, weights=per_run_total)
+        bad = np.bincount(inv, weights=per_run_ng)
+        runs = np.bincount(inv)
+        first = np.full(len(names), np.inf)
+        last = np.full(len(names), -np.inf)
+        np.minimum.at(first, inv, times)
+        np.maximum.at(last, inv, times)
+        out = [{"batch_no": str(names[i]), "runs": int(runs[i]), "points": int(total[i]), "ng": int(bad[i]),
+                "ng_rate": round(float(bad[i] / total[i]), 4) if total[i] else 0.0,
+                "first": float(first[i]), "last": float(last[i])} for i in range(len(names))]
+        return sorted(out, key=lambda b: b["first"])
+
+    def heatmap(self, bins: int = 20, **filters) -> Dict:
+        """NG count over board XY (machine mm) next to the number of inspections per cell"""
+        self._ensure_loaded()
+        with self._lock:
+            rows, _ = self._rows(**filters)
+            x = self.points["x"][rows]
+            y = self.points["y"][rows]
+            ng = self.points["ng"][rows]
+        if not len(x):
+            return {"x_edges": [], "y_edges": [], "ng": [], "inspected": []}
+        rng = [[float(x.min()), float(x.max()) + 1e-3], [float(y.min()), float(y.max()) + 1e-3]]
+        total, xe, ye = np.histogram2d(x, y, bins=bins, range=rng)
+        bad, _, _ = np.histogram2d(x, y, bins=bins, range=rng, weights=ng)
+        # Rows = y, columns = x (image layout)
+        return {"x_edges": xe.round(3).tolist(), "y_edges": ye.round(3).tolist(),
+                "ng": bad.T.astype(int).tolist(), "inspected": total.T.astype(int).tolist()}
+
+    def control_chart(self, sigma: float = 3.0, **filters) -> Dict:
+        """p-chart of the NG fraction per run with per-run limits (n varies)"""
+        self._ensure_loaded()
+        with self._lock:
+            rows, run_mask = self._rows(**filters)
+            run_ids = np.nonzero(run_mask)[0]
+            n_runs = len(self.runs)
+            run_of_row = self.points["run"][rows]
+            n = np.bincount(run_of_row, minlength=n_runs)[run_ids].astype(np.float64)
+            ng = np.bincount(run_of_row, weights=self.points["ng"][rows], minlength=n_runs)[run_ids]
+            names = [self.runs[i]["run_id"] for i in run_ids]
+            batches = [self.runs[i]["batch_no"] for i in run_ids]
+        valid = n > 0
+        if not valid.any():
+            return {"center": None, "runs": []}
+        pbar = ng[valid].sum() / n[valid].sum()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p = np.where(valid, ng / n, 0.0)
+            s = np.where(valid, np.sqrt(pbar * (1 - pbar) / n), 0.0)
+        ucl = np.minimum(1.0, pbar + sigma * s)
+        lcl = np.maximum(0.0, pbar - sigma * s)
+        return {
+            "center": round(float(pbar), 5),
+            "sigma": sigma,
+            "runs": [{"run_id": names[i], "batch_no": batches[i], "n": int(n[i]), "ng": int(ng[i]),
+                      "p": round(float(p[i]), 5), "ucl": round(float(ucl[i]), 5), "lcl": round(float(lcl[i]), 5),
+                      "out_of_control": bool(p[i] > ucl[i] or p[i] < lcl[i])}
+                     for i in range(len(names)) if valid[i]],
+        }
+
+    def info(self) -> Dict:
+        self._ensure_loaded()
+        with self._lock:
+            return {"runs": sum(1 for r in self.runs if not r.get("deleted")), "points": self.points.n,
+                    "detections": self.dets.n, "labels": len(self.labels)}
+
+
+store = AnalyticsStore()
+
+
+def ingest_run(history_dir: str, run_id: str):
+    """Called when a run is compacted and indexed"""
+    page = history_index.query(limit=1, run_id=run_id)
+    if page["items"]:
+        store.ingest(run_id, page["items"][0], journal.iter_results(os.path.join(history_dir, run_id)))
+
+def catch_up(history_dir: str) -> Dict:
+    """Ingest every indexed run not in the arrays yet (first start, after a rebuild)"""
+    t0 = time.perf_counter()
+    store._ensure_loaded()
+    added, offset = 0, 0
+    while True:
+        page = history_index.query(limit=500, offset=offset, sort="completed_at", descending=False)
+        for run in page["items"]:
+            if run["run_id"] not in store.run_index:
+                try:
+                    store.ingest(run["run_id"], run, journal.iter_results(os.path.join(history_dir, run["run_id"])))
+                    added += 1
+                except Exception as e:
+                    print(f"Analytics: skipping {run['run_id']}: {e}")
+        offset += len(page["items"])
+        if offset >= page["total"] or not page["items"]:
+            break
+    report = {"ingested": added, "seconds": round(time.perf_counter() - t0, 2)}
+    if added:
+        print(f"Analytics caught up: {report}")
+    return report
+
+
+# --- Endpoints ---
+def _filters(part_no, program_name, batch_no, last_runs, date_from, date_to) -> Dict:
+    return {"part_no": part_no, "program_name": program_name, "batch_no": batch_no,
+            "last_runs": last_runs, "date_from": date_from, "date_to": date_to}
+
+@router.get("/summary")
+def summary():
+    return store.info()
+
+@router.get("/ng_rate/points")
+def ng_rate_points(part_no: Optional[str] = None, program_name: Optional[str] = None, batch_no: Optional[str] = None,
+                   last_runs: Optional[int] = None, date_from: Optional[float] = None, date_to: Optional[float] = None):
+    """NG rate per point_id, worst first"""
+    return store.ng_rate_by_point(**_filters(part_no, program_name, batch_no, last_runs, date_from, date_to))
+
+@router.get("/pareto")
+def pareto(part_no: Optional[str] = None, program_name: Optional[str] = None, batch_no: Optional[str] = None,
+           last_runs: Optional[int] = None, date_from: Optional[float] = None, date_to: Optional[float] = None):
+    return store.pareto(**_filters(part_no, program_name, batch_no, last_runs, date_from, date_to))
+
+@router.get("/trend/batch")
+def trend_batch(part_no: Optional[str] = None, program_name: Optional[str] = None,
+                last_runs: Optional[int] = None, date_from: Optional[float] = None, date_to: Optional[float] = None):
+    return store.trend_by_batch(**_filters(part_no, program_name, None, last_runs, date_from, date_to))
+
+@router.get("/heatmap")
+def heatmap(bins: int = 20, part_no: Optional[str] = None, program_name: Optional[str] = None,
+            batch_no: Optional[str] = None, last_runs: Optional[int] = None,
+            date_from: Optional[float] = None, date_to: Optional[float] = None):
+    if not 1 <= bins <= 200:
+        raise HTTPException(status_code=400, detail="bins must be 1..200")
+    return store.heatmap(bins, **_filters(part_no, program_name, batch_no, last_runs, date_from, date_to))
+
+@router.get("/control_chart")
+def control_chart(sigma: float = 3.0, part_no: Optional[str] = None, program_name: Optional[str] = None,
+                  batch_no: Optional[str] = None, last_runs: Optional[int] = None,
+                  date_from: Optional[float] = None, date_to: Optional[float] = None):
+    return store.control_chart(sigma, **_filters(part_no, program_name, batch_no, last_runs, date_from, date_to))
+
+@router.post("/rebuild")
+def rebuild():
+    """Drop the arrays and re-ingest every indexed run"""
+    from app.api import orchestrator # Lazy: orchestrator owns HISTORY_DIR
+    store.reset()
+    return catch_up(orchestrator.HISTORY_DIR)
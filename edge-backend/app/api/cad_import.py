@@ -0,0 +1,367 @@
+"""
+Inspection programs from CAD data instead of teaching at the machine.
+
+Input is the pick-and-place (centroid) file the assembly line already has:
+Altium-style CSV or KiCad .pos tables, columns recognised by name
+(designator, X, Y, rotation, side, package, value), mm or mil.
+Optionally a Gerber file (RS-274X) is read as well:
+
+- coordinates without a component attribute give the board outline
+  (board origin and size for the raster comparison)
+- Gerber X3 component objects (%TO.C,<ref>*%, e.g. assembly / courtyard
+  outlines) give the real body size of each part
+
+Parts without an outline get a body size from their package name (chip
+codes 0201..2512, SOT/SOD/SOIC, "NxM" in the name). Fiducials (FID*)
+become the program's refs (fewer than 2: the two parts furthest apart);
+everything else becomes a region, and
+coverage.plan groups them per camera frame (candidate-centre grid index +
+greedy set cover), so one capture inspects every part it holds whole. Each
+frame becomes an inspect point with one pixel ROI per part.
+"""
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from typing import Dict, List, Optional, Tuple
+import csv
+import math
+import os
+import re
+import time
+
+import numpy as np
+
+from app.api import coverage, motion, program
+
+router = APIRouter()
+
+MIL_MM = 0.0254
+INCH_MM = 25.4
+DEFAULT_BODY_MM = (3.0, 3.0) # Unknown package
+
+# Column names (lowercase, without spaces / punctuation) -> field, in order of preference
+COLUMNS = {
+    "ref": ["designator", "refdes", "ref", "reference", "refdesignator", "component"],
+    "x": ["midx", "centerx", "centrex", "posx", "centroidx", "x", "locationx", "refx"],
+    "y": ["midy", "centery", "centrey", "posy", "centroidy", "y", "locationy", "refy"],
+    "rot": ["rotation", "rot", "angle", "orientation"],
+    "side": ["layer", "side", "tb", "mirror"],
+    "package": ["footprint", "package", "pattern", "pkg", "case"],
+    "value": ["comment", "value", "val", "partnumber", "description"],
+}
+
+# Imperial chip codes -> body incl. terminations (mm)
+CHIP_SIZES = {
+    "01005": (0.4, 0.2), "0201": (0.6, 0.3), "0402": (1.0, 0.5), "0603": (1.6, 0.8),
+    "0805": (2.0, 1.25), "1206": (3.2, 1.6), "1210": (3.2, 2.5), "1812": (4.5, 3.2),
+    "2010": (5.0, 2.5), "2512": (6.3, 3.2),
+}
+PACKAGE_SIZES = [ # (regex on the package name, (w, h) at rotation 0, leads included)
+    (r"SOT-?223", (6.5, 7.0)),
+    (r"SOT-?23", (2.9, 2.4)),
+    (r"SOD-?123", (3.7, 1.6)),
+    (r"SOD-?323", (2.5, 1.3)),
+    (r"SOT-?89", (4.5, 4.2)),
+    (r"SOIC-?8|SO-?8(?!\d)", (4.9, 6.0)),
+    (r"SOIC-?14|SO-?14", (8.7, 6.0)),
+    (r"SOIC-?16|SO-?16", (9.9, 6.0)),
+]
+
+
+class Component(BaseModel):
+    ref: str
+    x: float # CAD coordinates, mm
+    y: float
+    rot: float = 0.0
+    side: str = "top"
+    package: str = ""
+    value: str = ""
+
+class ImportRequest(BaseModel):
+    name: str # Program name
+    centroid: str # Pick-and-place file contents
+    gerber: Optional[str] = None # Outline / component-layer Gerber contents
+    units: str = "auto" # "mm", "mil", "inch" or "auto" (from header / values)
+    side: str = "top" # "top" or "bottom" (bottom is mirrored: the board is flipped for it)
+    origin: str = "outline" # Board origin: "outline" (Gerber min corner, else the parts' extent) or "cad" (CAD 0,0)
+    overlap_percent: float = 0.1
+    margin_mm: float = 0.3
+    save: bool = True # Store the program
+    overwrite: bool = False # Replace a stored program with the same name
+    load: bool = True # And make it the current program
+
+
+def _key(name: str) -> str:
+    # "Center-X(mm)" -> "centerx" (units are read from the raw header)
+    return re.sub(r"[^a-z0-9]", "", re.sub(r"\(.*?\)", "", name.lower()))
+
+def _number(value: str) -> Tuple[Optional[float], Optional[str]]:
+    """'12.5mm' -> (12.5, 'mm'), '450mil' -> (450.0, 'mil'), '' -> (None, None)"""
+    m = re.match(r"\s*([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)\s*([a-zA-Z]*)", value or "")
+    if not m:
+        return None, None
+    return float(m.group(1)), (m.group(2).lower() or None)
+
+
+def parse_centroid(text: str, units: str = "auto") -> Tuple[List[Component], Dict]:
+    """Components from a centroid / pick-and-place file"""
+    lines = [l for l in text.splitlines() if l.strip() and not l.lstrip().startswith("#")]
+    # Header: the first line naming a designator column (exports often start with a preamble)
+    header_idx, delim = None, None
+    for i, line in enumerate(lines[:50]):
+        for d in (",", ";", "\t", None):
+            cells = next(csv.reader([line], delimiter=d)) if d else line.split()
+            if any(_key(c) in COLUMNS["ref"] for c in cells) and len(cells) >= 3:
+                header_idx, delim = i, d
+                break
+        if header_idx is not None:
+            break
+    if header_idx is None:
+        # KiCad .pos: the header is a comment line; columns are Ref Val Package PosX PosY Rot Side
+        header = ["ref", "val", "package", "posx", "posy", "rot", "side"]
+        rows = [l.split() for l in lines]
+    else:
+        split = (lambda l: next(csv.reader([l], delimiter=delim))) if delim else str.split
+        header = split(lines[header_idx])
+        rows = [split(l) for l in lines[header_idx + 1:]]
+
+    keys = [_key(h) for h in header]
+    col = {}
+    for field, names in COLUMNS.items():
+        for name in names:
+            if name in keys:
+                col[field] = keys.index(name)
+                break
+    missing = [f for f in ("ref", "x", "y") if f not in col]
+    if missing:
+        raise ValueError(f"Centroid file: no column for {', '.join(missing)} (header: {header})")
+
+    if units == "auto":
+        head = " ".join(header).lower()
+        units = "mil" if "mil" in head else "inch" if "(in)" in head or "inch" in head else None
+    comps, skipped = [], 0
+    for cells in rows:
+        if len(cells) <= max(col["ref"], col["x"], col["y"]):
+            skipped += 1
+            continue
+        x, ux = _number(cells[col["x"]])
+        y, uy = _number(cells[col["y"]])
+        if x is None or y is None:
+            skipped += 1
+            continue
+        unit = units or ux or uy or "mm"
+        scale = MIL_MM if unit == "mil" else INCH_MM if unit in ("in", "inch") else 1.0
+        get = lambda f: cells[col[f]].strip() if f in col and col[f] < len(cells) else ""
+        rot = _number(get("rot"))[0] or 0.0
+        side = get("side").lower()
+        side = "bottom" if side.startswith(("b", "bot")) or side in ("yes", "mirrored") else "top"
+        comps.append(Component(ref=get("ref"), x=x * scale, y=y * scale, rot=rot, side=side,
+                               package=get("package"), value=get("value")))
+    if not comps:
+        raise ValueError("Centroid file: no placements (expected a header with designator, X and Y columns)")
+    return comps, {"rows": len(rows), "skipped_rows": skipped, "columns": {f: header[i] for f, i in col.items()}}
+
+
+def parse_gerber(text: str) -> Tuple[Optional[Tuple[float, float, float, float]], Dict[str, Tuple[float, float, float, float]]]:
+    """
+    Extents (min_x, min_y, max_x, max_y, mm) of everything drawn outside a
+    component object (the board outline), and per component designator.
+    Arcs count by their end points only.
+    """
+    to_mm = 1.0
+    fmt = {"X": (2, 6), "Y": (2, 6)}
+    trailing = False
+    cur = {"X": 0.0, "Y": 0.0}
+    component = None
+    board: List[Tuple[float, float]] = []
+    parts: Dict[str, List[Tuple[float, float]]] = {}
+
+    def coord(axis: str, s: str) -> float:
+        ints, dec = fmt[axis]
+        sign = -1.0 if s.startswith("-") else 1.0
+        digits = s.lstrip("+-")
+        if "." in digits:
+            return sign * float(digits)
+        if trailing:
+            digits = digits.ljust(ints + dec, "0")
+        return sign * int(digits) / 10 ** dec
+
+    def attribute(cmd: str):
+        nonlocal component
+        if cmd.startswith("TO.C,"):
+            component = cmd[5:].split(",")[0]
+        elif cmd == "TD" or cmd.startswith("TD.C"):
+            component = None
+
+    for m in re.finditer(r"%([^%]*)%|([^%*]+)\*", text):
+        if m.group(1) is not None:
+            for cmd in (c.strip() for c in m.group(1).split("*")):
+                if cmd.startswith("FS"):
+                    fs = re.match(r"FS([LT])?[AI]?X(\d)(\d)Y(\d)(\d)", cmd)
+                    if fs:
+                        trailing = fs.group(1) == "T"
+                        fmt = {"X": (int(fs.group(2)), int(fs.group(3))), "Y": (int(fs.group(4)), int(fs.group(5)))}
+                elif cmd.startswith("MO"):
+                    to_mm = INCH_MM if cmd == "MOIN" else 1.0
+                else:
+                    attribute(cmd)
+            continue
+        cmd = m.group(2).strip()
+        if cmd.startswith("G04"):
+            # KiCad writes X2 attributes as comments: G04 #@! TO.C,R1*
+            body = cmd[3:].strip()
+            if body.startswith("#@!"):
+                attribute(body[3:].strip())
+            continue
+        if cmd in ("MOMM", "MOIN"):
+            to_mm = INCH_MM if cmd == "MOIN" else 1.0
+            continue
+        if cmd in ("G70", "G71"):
+            to_mm = INCH_MM if cmd == "G70" else 1.0
+            continue
+        op = re.search(r"D0?([123])$", cmd)
+        xy = re.findall(r"([XY])([-+]?[\d.]+)", cmd)
+        if not xy and not op:
+            continue
+        prev = (cur["X"], cur["Y"])
+        for axis, value in xy:
+            cur[axis] = coord(axis, value) * to_mm
+        if op is None or op.group(1) == "2":
+            continue
+        pts = [prev, (cur["X"], cur["Y"])] if op.group(1) == "1" else [(cur["X"], cur["Y"])]
+        (parts.setdefault(component, []) if component else board).extend(pts)
+
+    def extent(pts):
+        a = np.asarray(pts, dtype=np.float64)
+        return tuple(float(v) for v in (a[:, 0].min(), a[:, 1].min(), a[:, 0].max(), a[:, 1].max()))
+    return (extent(board) if board else None), {ref: extent(p) for ref, p in parts.items()}
+
+
+def body_size(c: Component) -> Tuple[Tuple[float, float], bool]:
+    """Footprint size (mm) at rotation 0 from the package name; (size, known)"""
+    pkg = c.package.upper()
+    for code, size in CHIP_SIZES.items():
+        if re.search(rf"(?<!\d){code}(?!\d)", pkg):
+            return size, True
+    for pattern, size in PACKAGE_SIZES:
+        if re.search(pattern, pkg):
+            return size, True
+    m = re.search(r"(\d+(?:\.\d+)?)\s*[Xx]\s*(\d+(?:\.\d+)?)", pkg)
+    if m and 0 < float(m.group(1)) < 100 and 0 < float(m.group(2)) < 100:
+        return (float(m.group(1)), float(m.group(2))), True
+    return DEFAULT_BODY_MM, False
+
+
+def part_class(c: Component) -> str:
+    """Expected classifier class: designator letters + chip code ("C0402"), else the package"""
+    prefix = re.match(r"[A-Za-z]*", c.ref).group(0).upper()
+    for code in CHIP_SIZES:
+        if re.search(rf"(?<!\d){code}(?!\d)", c.package):
+            return prefix + code
+    return c.package or prefix
+
+
+def is_fiducial(c: Component) -> bool:
+    return c.ref.upper().startswith("FID") or "FIDUCIAL" in c.package.upper()
+
+
+def _farthest_pair(pos: np.ndarray, directions: int = 36) -> Optional[Tuple[int, int]]:
+    """Indices of the two points furthest apart, None if all points coincide"""
+    # The pair lies on the hull: compare only the extreme points along a fan of directions
+    a = np.linspace(0.0, np.pi, directions, endpoint=False)
+    proj = pos @ np.stack([np.cos(a), np.sin(a)])
+    cand = np.unique(np.concatenate([proj.argmin(axis=0), proj.argmax(axis=0)])) if len(pos) else np.array([], int)
+    d = np.linalg.norm(pos[cand, None, :] - pos[None, cand, :], axis=2)
+    if d.size == 0 or d.max() <= 0:
+        return None
+    i, j = np.unravel_index(int(np.argmax(d)), d.shape)
+    return int(cand[i]), int(cand[j])
+
+
+def build_program(req: ImportRequest) -> Tuple[program.Program, Dict]:
+    t0 = time.perf_counter()
+    comps, csv_info = parse_centroid(req.centroid, req.units)
+    outline, outlines = parse_gerber(req.gerber) if req.gerber else (None, {})
+    parse_ms = (time.perf_counter() - t0) * 1000.0
+
+    comps = [c for c in comps if c.side == req.side]
+    if not comps:
+        raise ValueError(f"No {req.side} side components in the centroid file")
+    xs = np.array([c.x for c in comps])
+    ys = np.array([c.y for c in comps])
+    lo_x, lo_y, hi_x, hi_y = outline or (float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max()))
+    if req.side == "bottom":
+        # Board flipped about its Y axis for the bottom side
+        xs = lo_x + hi_x - xs
+    origin = (lo_x, lo_y) if req.origin == "outline" else (0.0, 0.0)
+    ox, oy = motion.work_offset["x"], motion.work_offset["y"]
+
+    refs, regions, unknown = [], [], []
+    for c, x, y in zip(comps, xs, ys):
+        wx, wy = float(x - origin[0]), float(y - origin[1])
+        if is_fiducial(c):
+            refs.append(program.Point(id=len(refs) + 1, x=round(wx + ox, 4), y=round(wy + oy, 4), type="ref"))
+            continue
+        if c.ref in outlines:
+            # Gerber outline: already rotated, in CAD coordinates
+            x0, y0, x1, y1 = outlines[c.ref]
+            w, h = x1 - x0, y1 - y0
+        else:
+            (bw, bh), known = body_size(c)
+            if not known:
+                unknown.append(c.ref)
+            a = math.radians(c.rot)
+            w = abs(bw * math.cos(a)) + abs(bh * math.sin(a))
+            h = abs(bw * math.sin(a)) + abs(bh * math.cos(a))
+        regions.append(coverage.Region(x=wx, y=wy, w=w, h=h, name=c.ref, part_class=part_class(c)))
+
+    if len(refs) < 2:
+        # Fewer than 2 fiducials: the two parts furthest apart are taught as alignment references
+        pair = _farthest_pair(np.array([[r.x, r.y] for r in regions]).reshape(-1, 2))
+        if pair is None:
+            raise ValueError("Need at least 2 fiducials or 2 parts at different positions for alignment")
+        refs = [program.Point(id=k + 1, x=round(regions[i].x + ox, 4), y=round(regions[i].y + oy, 4), type="ref")
+                for k, i in enumerate(pair)]
+
+    start = (refs[-1].x, refs[-1].y) if refs else None
+    width = (hi_x - origin[0]) if outline else None
+    height = (hi_y - origin[1]) if outline else None
+    plan = coverage.plan(regions, req.overlap_percent, req.margin_mm, width, height, start=start)
+    prog = program.Program(name=req.name, refs=refs, points=coverage.frames_to_points(plan, regions))
+    plan.pop("frames")
+    report = {
+        "components": len(comps),
+        "fiducials": sum(1 for c in comps if is_fiducial(c)),
+        "refs": len(refs),
+        "regions": len(regions),
+        "outlines_used": sum(1 for c in comps if c.ref in outlines),
+        "unknown_packages": len(unknown),
+        "unknown_refs": unknown[:50],
+        "board_outline_mm": [round(v, 3) for v in outline] if outline else None,
+        "origin_mm": list(origin),
+        **csv_info,
+        "coverage": plan,
+        "parse_ms": round(parse_ms, 1),
+        "total_ms": round((time.perf_counter() - t0) * 1000.0, 1),
+    }
+    return prog, report
+
+
+@router.post("/import")
+async def import_cad(req: ImportRequest):
+    """Generate an inspection program from a centroid file (+ optional Gerber outlines)"""
+    if req.side not in ("top", "bottom"):
+        raise HTTPException(status_code=400, detail="side must be 'top' or 'bottom'")
+    # The name becomes a file name under program.DATA_DIR
+    if not req.name.strip() or os.path.basename(req.name) != req.name or req.name in (".", ".."):
+        raise HTTPException(status_code=400, detail="Invalid program name")
+    if req.save and not req.overwrite and os.path.exists(os.path.join(program.DATA_DIR, f"{req.name}.json")):
+        raise HTTPException(status_code=409, detail=f"Program {req.name!r} already exists (set overwrite to replace it)")
+    try:
+        prog, report = build_program(req)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if req.save:
+        program._save_to_disk(prog)
+    if req.load:
+        program.current_program = prog
+    return {"program": prog, "report": report}
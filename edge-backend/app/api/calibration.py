@@ -0,0 +1,268 @@
+"""
+Camera calibration: scale (mm per pixel), lens distortion and flat-field.
+
+- Distortion + scale: views of a chessboard target lying on the board plane
+  (moved / rotated between captures). cv2.calibrateCamera gives the camera
+  matrix and distortion; the scale is the known square size over the corner
+  spacing in the undistorted image (per axis, median over views).
+- Flat-field: frames of a uniform white target, averaged and heavily
+  smoothed; gain = mean / local brightness corrects vignetting and uneven
+  lighting.
+
+Stored with the machine (AOI_CALIBRATION + flatfield .npy next to it). At
+startup the correction is precomputed: fixed-point remap tables
+(initUndistortRectifyMap, CV_16SC2) and the flat-field gain as Q8 fixed-point,
+already remapped into undistorted coordinates. The capture thread then does
+one cv2.remap and one cv2.multiply per frame, and camera.mm_per_px() /
+camera.fov_mm() report the calibrated values (scan steps, fiducials, mosaic).
+"""
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from typing import List, Optional, Tuple
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from app.api import camera
+
+router = APIRouter()
+
+CALIBRATION_FILE = os.getenv("AOI_CALIBRATION", "/app/data/calibration.json")
+GAIN_BITS = 8 # Flat-field gain in Q8: 256 = 1.0
+MAX_GAIN = 4.0 # Don't amplify dark corners into noise
+
+
+class Calibration(BaseModel):
+    width: int
+    height: int
+    camera_matrix: Optional[List[List[float]]] = None
+    dist_coeffs: Optional[List[float]] = None
+    mm_per_px: Optional[List[float]] = None # x, y of the corrected image
+    rms_px: Optional[float] = None # Reprojection error
+    views: int = 0
+    flat_field: Optional[str] = None # .npy file name (next to the calibration file)
+    calibrated_at: Optional[float] = None
+
+
+class FrameCorrector:
+    """Precomputed LUTs: frame -> undistorted, flat-fielded frame"""
+    def __init__(self, cal: Calibration, gain: Optional[np.ndarray] = None):
+        size = (cal.width, cal.height)
+        self.map1 = self.map2 = None
+        if cal.camera_matrix is not None:
+            K = np.array(cal.camera_matrix, dtype=np.float64)
+            dist = np.array(cal.dist_coeffs, dtype=np.float64)
+            new_k = _new_camera_matrix(K, dist, size)
+            # CV_16SC2: integer coords + interpolation table index, the fast remap path
+            self.map1, self.map2 = cv2.initUndistortRectifyMap(K, dist, None, new_k, size, cv2.CV_16SC2)
+        self.gain = None
+        if gain is not None:
+            if self.map1 is not None:
+                # Gain is measured on raw pixels: move it to where remap puts them
+                gain = cv2.remap(gain, self.map1, self.map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            q = np.clip(np.round(gain * (1 << GAIN_BITS)), 0, 65535).astype(np.uint16)
+            self.gain = np.repeat(q[..., None], 3, axis=2) if q.ndim == 2 else q
+
+    def __call__(self, frame: np.ndarray) -> np.ndarray:
+        if self.map1 is not None:
+            frame = cv2.remap(frame, self.map1, self.map2, cv2.INTER_LINEAR)
+        if self.gain is not None:
+            frame = cv2.multiply(frame.astype(np.uint16), self.gain, scale=1.0 / (1 << GAIN_BITS), dtype=cv2.CV_8U)
+        return frame
+
+
+def _new_camera_matrix(K: np.ndarray, dist: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    # alpha=0: only valid pixels, no black borders; same image size as the sensor
+    new_k, _ = cv2.getOptimalNewCameraMatrix(K, dist, size, 0, size)
+    return new_k
+
+
+# --- Stored calibration ---
+current: Optional[Calibration] = None
+
+def _gain_path(cal: Calibration) -> Optional[str]:
+    if not cal.flat_field:
+        return None
+    return os.path.join(os.path.dirname(CALIBRATION_FILE), cal.flat_field)
+
+def load() -> Optional[Calibration]:
+    if not os.path.exists(CALIBRATION_FILE):
+        return None
+    with open(CALIBRATION_FILE) as f:
+        return Calibration(**json.load(f))
+
+def save(cal: Calibration, gain: Optional[np.ndarray] = None):
+    os.makedirs(os.path.dirname(CALIBRATION_FILE), exist_ok=True)
+    if gain is not None:
+        cal.flat_field = "flatfield.npy"
+        np.save(_gain_path(cal), gain.astype(np.float32))
+    tmp = CALIBRATION_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cal.model_dump(), f, indent=2)
+    os.replace(tmp, CALIBRATION_FILE)
+
+def apply(cal: Optional[Calibration]):
+    """Build the LUTs and hand them to the capture thread (None = nominal, uncorrected)"""
+    global current
+    current = cal
+    if cal is None:
+        camera.set_calibration(None, None)
+        return
+    if (cal.width, cal.height) != (camera.camera_driver.width, camera.camera_driver.height):
+        print(f"Calibration is for {cal.width}x{cal.height}, camera is "
+              f"{camera.camera_driver.width}x{camera.camera_driver.height}: ignored")
+        camera.set_calibration(None, None)
+        return
+    gain_path = _gain_path(cal)
+    gain = np.load(gain_path) if gain_path and os.path.exists(gain_path) else None
+    t0 = time.perf_counter()
+    fix = FrameCorrector(cal, gain)
+    scale = tuple(cal.mm_per_px) if cal.mm_per_px else None
+    camera.set_calibration(fix if (fix.map1 is not None or fix.gain is not None) else None, scale)
+    print(f"Calibration applied ({(time.perf_counter() - t0) * 1000:.0f} ms): "
+          f"mm/px={scale}, undistort={fix.map1 is not None}, flat-field={fix.gain is not None}")
+
+def load_and_apply():
+    try:
+        apply(load())
+    except Exception as e:
+        print(f"Calibration not applied: {e}")
+
+
+# --- Measuring ---
+def find_corners(gray: np.ndarray, pattern: Tuple[int, int]) -> Optional[np.ndarray]:
+    found, corners = cv2.findChessboardCorners(gray, pattern, cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE)
+    if not found:
+        return None
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    return cv2.cornerSubPix(gray, corners, (5, 5), (-1, -1), criteria)
+
+
+def corner_scale(corners: np.ndarray, obj_mm: np.ndarray) -> Tuple[float, float]:
+    """mm per px along image x and y from (undistorted) corners of a target at any rotation"""
+    # Least-squares affine target mm -> image px; its inverse maps one pixel step to mm
+    src = np.hstack([obj_mm[:, :2], np.ones((len(obj_mm), 1))])
+    A, *_ = np.linalg.lstsq(src, corners.reshape(-1, 2), rcond=None)
+    B = np.linalg.inv(A[:2].T)
+    return float(np.linalg.norm(B[:, 0])), float(np.linalg.norm(B[:, 1]))
+
+
+def solve(views: List[np.ndarray], pattern: Tuple[int, int], square_mm: float,
+          size: Tuple[int, int]) -> Calibration:
+    """Camera matrix, distortion and scale from detected corner sets"""
+    cols, rows = pattern
+    obj = np.zeros((rows * cols, 3), np.float32)
+    obj[:, :2] = np.mgrid[0:cols, 0:rows].T.reshape(-1, 2) * square_mm
+    rms, K, dist, _, _ = cv2.calibrateCamera([obj] * len(views), views, size, None, None)
+    new_k = _new_camera_matrix(K, dist, size)
+    scales = []
+    for corners in views:
+        und = cv2.undistortPoints(corners, K, dist, P=new_k)
+        scales.append(corner_scale(und, obj))
+    kx, ky = np.median(np.array(scales), axis=0)
+    return Calibration(width=size[0], height=size[1], camera_matrix=K.tolist(), dist_coeffs=dist.ravel().tolist(),
+                       mm_per_px=[round(float(kx), 6), round(float(ky), 6)], rms_px=round(float(rms), 4),
+                       views=len(views), calibrated_at=time.time())
+
+
+def flat_field_gain(frames: List[np.ndarray], smooth_frac: float = 0.05) -> np.ndarray:
+    """Per-pixel, per-channel gain from frames of a uniform target"""
+    mean = np.mean(np.stack([f.astype(np.float32) for f in frames]), axis=0)
+    h, w = mean.shape[:2]
+    # Smooth away target texture / dust, keep the vignetting
+    sigma = max(3.0, smooth_frac * max(h, w))
+    light = cv2.GaussianBlur(mean, (0, 0), sigma)
+    target = light.reshape(-1, light.shape[-1]).mean(axis=0) if light.ndim == 3 else light.mean()
+    return np.clip(target / np.maximum(light, 1.0), 0.0, MAX_GAIN).astype(np.float32)
+
+
+# --- Endpoints ---
+class TargetConfig(BaseModel):
+    cols: int = 9 # Inner corners per row
+    rows: int = 6
+    square_mm: float = 2.0
+
+class FlatFieldRequest(BaseModel):
+    frames: int = 16
+
+session = {"views": [], "pattern": None, "square_mm": None}
+_session_lock = threading.Lock()
+
+def _raw_frames(n: int = 1) -> List[np.ndarray]:
+    """n consecutive uncorrected frames (correction stays on for everybody else)"""
+    frames = []
+    last = time.monotonic()
+    for _ in range(max(1, n)):
+        frame, last, _ = camera.read_frame(after=last, raw=True)
+        frames.append(frame)
+    return frames
+
+@router.get("/")
+async def get_calibration():
+    return {
+        "calibration": current,
+        "mm_per_px": camera.mm_per_px_xy(),
+        "fov_mm": camera.fov_mm(),
+        "correcting": camera.corrector is not None,
+        "session_views": len(session["views"]),
+    }
+
+@router.post("/views")
+def capture_view(target: TargetConfig = TargetConfig()):
+    """Capture a view of the chessboard target (move / rotate it between views)"""
+    pattern = (target.cols, target.rows)
+    with _session_lock:
+        if session["pattern"] not in (None, pattern) or session["square_mm"] not in (None, target.square_mm):
+            raise HTTPException(status_code=409, detail="Target changed: clear the views first")
+        gray = cv2.cvtColor(_raw_frames()[0], cv2.COLOR_BGR2GRAY)
+        corners = find_corners(gray, pattern)
+        if corners is None:
+            raise HTTPException(status_code=422, detail="Chessboard not found")
+        session.update(pattern=pattern, square_mm=target.square_mm)
+        session["views"].append(corners)
+        return {"views": len(session["views"]), "corners": len(corners)}
+
+@router.delete("/views")
+def clear_views():
+    with _session_lock:
+        session.update(views=[], pattern=None, square_mm=None)
+    return {"views": 0}
+
+@router.post("/solve")
+def solve_calibration():
+    """Calibrate from the captured views (at least 5), store and apply"""
+    with _session_lock:
+        if len(session["views"]) < 5:
+            raise HTTPException(status_code=400, detail=f"Need at least 5 views, have {len(session['views'])}")
+        size = (camera.camera_driver.width, camera.camera_driver.height)
+        cal = solve(session["views"], session["pattern"], session["square_mm"], size)
+        if current is not None and current.flat_field:
+            cal.flat_field = current.flat_field
+        save(cal)
+        session.update(views=[], pattern=None, square_mm=None)
+    apply(cal)
+    return cal
+
+@router.post("/flatfield")
+def measure_flat_field(req: FlatFieldRequest = FlatFieldRequest()):
+    """Average frames of a uniform white target into the flat-field gain"""
+    frames = _raw_frames(req.frames)
+    gain = flat_field_gain(frames)
+    cal = current.model_copy() if current is not None else Calibration(
+        width=camera.camera_driver.width, height=camera.camera_driver.height)
+    cal.calibrated_at = time.time()
+    save(cal, gain)
+    apply(cal)
+    return {"frames": len(frames), "gain_min": round(float(gain.min()), 3), "gain_max": round(float(gain.max()), 3)}
+
+@router.delete("/")
+def reset_calibration():
+    """Back to the nominal FOV, no correction"""
+    if os.path.exists(CALIBRATION_FILE):
+        os.remove(CALIBRATION_FILE)
+    apply(None)
+    return {"status": "reset", "fov_mm": camera.fov_mm()}
@@ -1,11 +1,24 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Query
 from fastapi.responses import StreamingResponse
+import asyncio
 import cv2
 import numpy as np
+import threading
 import time
+from typing import Optional
 
 router = APIRouter()
 
+# Number of frames kept by the capture thread
+RING_SIZE = 4
+
+# Optics (nominal until calibrated): field of view of the full frame, in mm
+FOV_MM = (40.0, 30.0)
+# Image axes -> machine axes. Image Y grows downwards, machine Y upwards.
+IMAGE_AXIS_SIGN = (1.0, -1.0)
+# Mock: gantry ringing after a stop, amplitude (px) * exp(-t / decay) * sin(2 pi f t)
+MOCK_RING = (6.0, 0.08, 12.0)
+
 
 class MockCamera:
     def __init__(self):
@@ -16,6 +29,11 @@ class MockCamera:
         self.box_y = self.height // 2
         self.dx = 5
         self.dy = 3
+        # Time between exposure and get_frame() returning (mock renders at return)
+        self.readout_latency = 0.0
+        self.exposure_s = 0.0002 # Strobed LED ring
+        self.fps = 20.0 # Free-running frame rate
+        self._stopped_at: Optional[float] = None
 
     def get_frame(self):
         # Simulate capture delay
@@ -85,37 +103,306 @@ class MockCamera:
         # so user sees SOMETHING moving.
         cv2.circle(img, (50 + int(motion.machine_pos["x"]), 400 - int(motion.machine_pos["y"])), 15, (0, 255, 255), -1)
 
-        return img
+        return self._ring(img, motion.controller.state)
+
+    def _ring(self, img, state: str):
+        # The frame shakes for a moment after every move, like a real gantry
+        now = time.monotonic()
+        if state == "moving":
+            self._stopped_at = None
+            return img
+        if self._stopped_at is None:
+            self._stopped_at = now
+        amp, decay, freq = MOCK_RING
+        t = now - self._stopped_at
+        d = amp * np.exp(-t / decay) * np.sin(2 * np.pi * freq * t + np.pi / 2)
+        if abs(d) < 0.05:
+            return img
+        m = np.float32([[1, 0, d], [0, 1, 0.5 * d]])
+        return cv2.warpAffine(img, m, (img.shape[1], img.shape[0]))
+
+
+class FrameRing:
+    """
+    Small preallocated ring of the most recent frames.
+    Every slot carries a monotonic timestamp and a sequence number, so readers
+    can ask for "the first frame exposed after t" instead of flushing buffers.
+    """
+    def __init__(self, size: int, shape: tuple):
+        self.size = size
+        self.frames = np.zeros((size,) + shape, np.uint8)
+        self.stamps = np.zeros(size, np.float64)
+        self.seqs = np.full(size, -1, np.int64)
+        self.seq = 0 # Frames written so far
+        self.cond = threading.Condition()
+
+    def write(self, frame, ts: float):
+        with self.cond:
+            slot = self.seq % self.size
+            np.copyto(self.frames[slot], frame)
+            self.stamps[slot] = ts
+            self.seqs[slot] = self.seq
+            self.seq += 1
+            self.cond.notify_all()
+
+    def _find(self, after: Optional[float], after_seq: Optional[int]) -> int:
+        # Oldest slot that satisfies the condition, -1 if none yet
+        best = -1
+        for slot in range(self.size):
+            s = self.seqs[slot]
+            if s < 0:
+                continue
+            if after is not None and self.stamps[slot] <= after:
+                continue
+            if after_seq is not None and s <= after_seq:
+                continue
+            if after is None and after_seq is None:
+                # Plain "latest": newest slot wins
+                if best < 0 or s > self.seqs[best]:
+                    best = slot
+            elif best < 0 or s < self.seqs[best]:
+                best = slot
+        return best
+
+    def read(self, after: Optional[float] = None, after_seq: Optional[int] = None, timeout: float = 2.0):
+        """
+        Returns (frame copy, timestamp, seq).
+        after: only frames stamped later than this time.monotonic() value
+        after_seq: only frames newer than this sequence number
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                slot = self._find(after, after_seq)
+                if slot >= 0:
+                    return self.frames[slot].copy(), float(self.stamps[slot]), int(self.seqs[slot])
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("No camera frame within timeout")
+                self.cond.wait(remaining)
+
 
-    def flush_buffer(self):
-        """Read and discard frames to ensure fresh data"""
-        for _ in range(3):
-            self.get_frame()
+class CaptureThread(threading.Thread):
+    """
+    The only consumer of the camera driver: reads frames back-to-back into the ring.
+    Timestamp = time the read returned minus the driver's readout latency,
+    i.e. roughly when the frame was exposed.
+    """
+    def __init__(self, driver, ring: FrameRing):
+        super().__init__(name="aoi-capture", daemon=True)
+        self.driver = driver
+        self.ring = ring
+        self.stop_event = threading.Event()
+
+    def run(self):
+        latency = getattr(self.driver, "readout_latency", 0.0)
+        while not self.stop_event.is_set():
+            try:
+                frame = self.driver.get_frame()
+            except Exception as e:
+                print(f"Camera read failed: {e}")
+                time.sleep(0.5)
+                continue
+            ts = time.monotonic() - latency
+            if _raw_readers:
+                raw_ring.write(frame, ts) # Calibration wants the frame as the sensor saw it
+            fix = corrector
+            if fix is not None:
+                frame = fix(frame) # Undistort + flat-field (calibration.FrameCorrector)
+            self.ring.write(frame, ts)
 
 # Global Camera Instance
 camera_driver = MockCamera()
+frame_ring = FrameRing(RING_SIZE, (camera_driver.height, camera_driver.width, 3))
+# Uncorrected frames, only filled while someone reads with raw=True
+raw_ring = FrameRing(RING_SIZE, (camera_driver.height, camera_driver.width, 3))
+_raw_readers = 0
+_raw_lock = threading.Lock()
+_capture_thread: Optional[CaptureThread] = None
+_capture_lock = threading.Lock()
 
-def get_latest_frame():
-    """Returns the current Opencv frame"""
-    return camera_driver.get_frame()
+# Set from the stored calibration at startup (see calibration.apply)
+corrector = None # frame -> corrected frame, run by the capture thread
+_calibrated_scale: Optional[tuple] = None # (mm/px x, mm/px y) of corrected frames
 
-def flush_buffer():
-    """Clear internal camera buffer"""
-    camera_driver.flush_buffer()
+def set_calibration(fix, scale_xy: Optional[tuple]):
+    global corrector, _calibrated_scale
+    corrector = fix
+    _calibrated_scale = scale_xy
 
-def generate_frames():
-    while True:
-        frame = camera_driver.get_frame()
-        
-        # Encode
-        _, buffer = cv2.imencode('.jpg', frame)
-        frame_bytes = buffer.tobytes()
-        
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-        
-        time.sleep(0.05) # 20 FPS
+def mm_per_px_xy() -> tuple:
+    if _calibrated_scale is not None:
+        return _calibrated_scale
+    k = FOV_MM[0] / camera_driver.width
+    return (k, k)
+
+def mm_per_px() -> float:
+    kx, ky = mm_per_px_xy()
+    return (kx + ky) / 2.0
+
+def fov_mm() -> tuple:
+    """Field of view of one frame (mm): calibrated, or the nominal FOV_MM"""
+    kx, ky = mm_per_px_xy()
+    return (camera_driver.width * kx, camera_driver.height * ky)
+
+def start_capture():
+    """Start the background capture thread (idempotent)"""
+    global _capture_thread
+    with _capture_lock:
+        if _capture_thread is None or not _capture_thread.is_alive():
+            _capture_thread = CaptureThread(camera_driver, frame_ring)
+            _capture_thread.start()
+
+def stop_capture():
+    global _capture_thread
+    with _capture_lock:
+        if _capture_thread is not None:
+            _capture_thread.stop_event.set()
+            _capture_thread.join(timeout=2.0)
+            _capture_thread = None
+
+def read_frame(after: Optional[float] = None, after_seq: Optional[int] = None, timeout: float = 2.0,
+               raw: bool = False):
+    """
+    Returns (frame, timestamp, seq) from the capture ring, see FrameRing.read.
+    raw: the frame before undistortion / flat-field (calibration); pass after= so it is a fresh one.
+    """
+    global _raw_readers
+    start_capture()
+    if not raw:
+        return frame_ring.read(after=after, after_seq=after_seq, timeout=timeout)
+    with _raw_lock:
+        _raw_readers += 1
+    try:
+        return raw_ring.read(after=after, after_seq=after_seq, timeout=timeout)
+    finally:
+        with _raw_lock:
+            _raw_readers -= 1
+
+def get_latest_frame(after: Optional[float] = None, timeout: float = 2.0):
+    """
+    Returns the current Opencv frame.
+    Pass after=time.monotonic() (taken once the machine has settled) to get the
+    first frame exposed after that moment: guaranteed fresh, no discarded reads.
+    """
+    frame, _, _ = read_frame(after=after, timeout=timeout)
+    return frame
+
+class _Subscriber:
+    def __init__(self, fps: float, max_width: Optional[int]):
+        self.fps = fps
+        self.max_width = max_width
+        self.next_due = 0.0
+        # Holds at most one frame: a slow client skips frames instead of stalling the producer
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self.dropped = 0
+
+    def offer(self, jpg: Optional[bytes]):
+        # None ends this client's stream
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait(jpg)
+
+
+class MJPEGBroadcaster:
+    """
+    Single producer for /feed: reads each frame from the ring once, JPEG-encodes
+    it once per requested resolution and fans the bytes out to all clients.
+    Runs only while at least one client is connected.
+    """
+    def __init__(self, max_fps: float = 20.0, run_fps: float = 2.0, quality: int = 80):
+        self.max_fps = max_fps
+        self.run_fps = run_fps # Cap while an inspection run is active
+        self.quality = quality
+        self.run_active = False
+        self.subscribers = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, fps: Optional[float] = None, max_width: Optional[int] = None) -> _Subscriber:
+        sub = _Subscriber(min(fps or self.max_fps, self.max_fps), max_width)
+        self.subscribers.add(sub)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._produce())
+        return sub
+
+    def unsubscribe(self, sub: _Subscriber):
+        self.subscribers.discard(sub)
+
+    def _encode(self, frame, max_width: Optional[int]) -> bytes:
+        if max_width and frame.shape[1] > max_width:
+            h = int(frame.shape[0] * max_width / frame.shape[1])
+            frame = cv2.resize(frame, (max_width, h), interpolation=cv2.INTER_AREA)
+        _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return buffer.tobytes()
+
+    async def _produce(self):
+        loop = asyncio.get_running_loop()
+        seq = None
+        while self.subscribers:
+            t0 = loop.time()
+            try:
+                frame, _, seq = await asyncio.to_thread(read_frame, None, seq)
+            except TimeoutError:
+                continue
+
+            now = loop.time()
+            encoded = {} # max_width -> jpeg bytes, shared by clients with the same cap
+            for sub in list(self.subscribers):
+                fps = min(sub.fps, self.run_fps) if self.run_active else sub.fps
+                if now < sub.next_due:
+                    continue
+                # Keep the schedule, but don't let a stalled producer cause a burst
+                sub.next_due = max(sub.next_due + 1.0 / fps, now)
+                try:
+                    if sub.max_width not in encoded:
+                        encoded[sub.max_width] = await asyncio.to_thread(self._encode, frame, sub.max_width)
+                except Exception as e:
+                    # One client's settings must not take the stream down for the others
+                    print(f"MJPEG encode failed (width={sub.max_width}): {e}")
+                    self.unsubscribe(sub)
+                    sub.offer(None)
+                    continue
+                sub.offer(encoded[sub.max_width])
+
+            # No point in pulling frames faster than the fastest client wants them
+            fastest = max((s.fps for s in self.subscribers), default=self.max_fps)
+            if self.run_active:
+                fastest = min(fastest, self.run_fps)
+            await asyncio.sleep(max(0.0, 1.0 / fastest - (loop.time() - t0)))
+
+broadcaster = MJPEGBroadcaster()
+
+def set_run_active(active: bool):
+    """Called by the orchestrator: throttle the live stream while a run needs the CPU"""
+    broadcaster.run_active = active
+
+async def _stream(sub: _Subscriber):
+    try:
+        while True:
+            frame_bytes = await sub.queue.get()
+            if frame_bytes is None:
+                return
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+    finally:
+        broadcaster.unsubscribe(sub)
 
 @router.get("/feed")
-async def video_feed():
-    return StreamingResponse(generate_frames(), media_type="multipart/x-mixed-replace; boundary=frame")
+async def video_feed(fps: Optional[float] = Query(None, gt=0), width: Optional[int] = Query(None, gt=0)):
+    """
+    Live MJPEG stream. fps / width cap the rate and resolution for this client.
+    """
+    sub = broadcaster.subscribe(fps=fps, max_width=width)
+    return StreamingResponse(_stream(sub), media_type="multipart/x-mixed-replace; boundary=frame")
+
+@router.get("/feed/stats")
+async def feed_stats():
+    return {
+        "clients": len(broadcaster.subscribers),
+        "run_active": broadcaster.run_active,
+        "dropped": [s.dropped for s in broadcaster.subscribers],
+    }
@@ -0,0 +1,121 @@
+"""
+Two-stage cascade inspection.
+
+Stage 1 is a cheap classical check of the captured frame against the golden
+reference of the same point: best normalized cross-correlation inside a small
+shift window plus mean absolute pixel difference, both on a downscaled
+grayscale image. A point that clearly matches its golden image is OK and the
+neural model is skipped. Everything else (ambiguous, suspicious, no golden
+image) goes to stage 2, the regular inference.
+"""
+import threading
+from typing import Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from app.api import golden
+
+
+def compare(frame: np.ndarray, template: "golden.GoldenTemplate", cfg) -> Dict:
+    """
+    Score a BGR frame against a precomputed golden template.
+    Returns {"ncc", "diff", "shift"}: best NCC over +-cfg.max_shift_px, mean abs
+    difference at that shift (masked pixels only) and the shift in full-res px.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    lvl = template.level(cfg.downscale)
+    # Same pyrDown chain as the template, so both sides are filtered identically
+    img = golden.build_pyramid(gray, lvl + 1)[lvl]
+    ref, mask = template.pyramid[lvl], template.masks[lvl]
+
+    # Search the golden centre inside the frame to absorb small alignment errors
+    m = max(1, cfg.max_shift_px >> lvl)
+    tmpl, tmask = ref[m:-m, m:-m], mask[m:-m, m:-m]
+    scores = cv2.matchTemplate(img, tmpl, cv2.TM_CCOEFF_NORMED, mask=tmask)
+    np.nan_to_num(scores, copy=False, nan=-1.0, posinf=-1.0, neginf=-1.0)
+    _, ncc, _, (bx, by) = cv2.minMaxLoc(scores)
+
+    window = img[by:by + tmpl.shape[0], bx:bx + tmpl.shape[1]]
+    diff = cv2.mean(cv2.absdiff(window, tmpl), mask=tmask)[0]
+    return {"ncc": round(float(ncc), 4), "diff": round(diff, 2), "shift": [(bx - m) << lvl, (by - m) << lvl]}
+
+
+def is_clear_match(score: Dict, cfg) -> bool:
+    return score["ncc"] >= cfg.ok_ncc and score["diff"] <= cfg.ok_diff
+
+
+class CascadeStats:
+    """Per-run counters, read by /status and written into the report"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.short_circuited = 0
+        self.sent_to_model = 0
+        self.no_golden = 0
+
+    def to_dict(self) -> Dict:
+        with self.lock:
+            total = self.checked + self.no_golden
+            return {
+                "checked": self.checked,
+                "short_circuited": self.short_circuited,
+                "sent_to_model": self.sent_to_model,
+                "no_golden": self.no_golden,
+                "short_circuit_rate": round(self.short_circuited / total, 3) if total else 0.0,
+            }
+
+
+def make_cascade_infer(
+    golden_set: Optional["golden.GoldenSet"],
+    cfg,
+    infer_fn: Callable[[List, List], List[Dict]],
+    stats: CascadeStats,
+) -> Callable[[List, List], List[Dict]]:
+    """
+    Wrap a batched infer_fn(frames, points) with the classical pre-check.
+    Only frames that are not a clear golden match reach infer_fn.
+    golden_set is resolved once per run: the hot path only does dict lookups.
+    """
+
+    def infer(frames: List, points: List) -> List[Dict]:
+        results: List[Optional[Dict]] = [None] * len(frames)
+        scores: List[Optional[Dict]] = [None] * len(frames)
+        todo = []
+        for i, (frame, pt) in enumerate(zip(frames, points)):
+            template = golden_set.get(pt.id) if golden_set else None
+            if template is None:
+                with stats.lock:
+                    stats.no_golden += 1
+                    stats.sent_to_model += 1
+                todo.append(i)
+                continue
+
+            score = compare(frame, template, cfg)
+            scores[i] = score
+            ok = is_clear_match(score, cfg)
+            with stats.lock:
+                stats.checked += 1
+                if ok:
+                    stats.short_circuited += 1
+                else:
+                    stats.sent_to_model += 1
+            if ok:
+                results[i] = {"result": "OK", "detections": [], "latency_ms": 0.0}
+            else:
+                todo.append(i)
+
+        if todo:
+            for i, r in zip(todo, infer_fn([frames[i] for i in todo], [points[i] for i in todo])):
+                results[i] = r
+
+        sent = set(todo)
+        for i, r in enumerate(results):
+            r["cascade"] = {
+                "score": scores[i],
+                "skipped_model": i not in sent,
+            }
+        return results
+
+    return infer
@@ -0,0 +1,274 @@
+"""
+ROI coverage planning: capture only where there is something to inspect.
+
+scan.preview_scan_path rasters the whole width x height rectangle, empty
+copper and all. Here the regions of interest (component bodies from the
+program's ROIs, or an imported component list) are covered with as few
+camera frames as possible, every region whole inside one frame:
+
+- candidate frame centres lie on a grid (pitch a fraction of the FOV); for
+  each region the centres whose usable FOV contains it form a rectangle of
+  grid cells, so all (cell, region) pairs are generated with numpy at once
+- greedy set cover: repeatedly take the cell covering the most uncovered
+  regions (ln-n approximation of the minimum), then re-centre each chosen
+  frame on what it covers for the largest margin
+- the frames are ordered with path_optimizer and timed with motion_model,
+  next to the full raster over the same board
+
+Regions larger than the usable FOV are split into FOV-sized pieces first.
+"""
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from typing import Dict, List, Optional, Sequence, Tuple
+import time
+
+import numpy as np
+
+from app.api import camera, motion, path_optimizer, program
+from app.api.motion_model import model as motion_model
+from app.api.scan import ScanConfig, grid
+
+router = APIRouter()
+
+CANDIDATES_PER_FOV = 24 # Grid pitch = usable FOV / this (finer = closer to optimal, more pairs)
+MAX_PAIRS = 20_000_000 # (cell, region) pairs: coarsen the grid above this
+
+
+class Region(BaseModel):
+    # Rectangle to inspect, work coordinates (mm, board origin), axis-aligned
+    x: float # Centre
+    y: float
+    w: float
+    h: float
+    name: str = "" # Designator
+    part_class: str = ""
+
+class CoverageRequest(BaseModel):
+    regions: List[Region] = [] # Empty: the ROIs of the current program
+    overlap_percent: float = 0.1 # FOV border kept free (lens edge, alignment slack), like the raster overlap
+    margin_mm: float = 0.3 # Clearance around each region
+    width_mm: Optional[float] = None # Board size for the raster comparison (default: region extents)
+    height_mm: Optional[float] = None
+    optimize: bool = True # Order the frames with the path optimizer (else row by row)
+    time_limit_s: float = 0.3
+
+
+def split_oversize(rects: np.ndarray, usable: Tuple[float, float]) -> Tuple[np.ndarray, np.ndarray]:
+    """Split [cx, cy, w, h] rows bigger than the usable FOV into pieces; returns (pieces, source row)"""
+    u = np.asarray(usable, dtype=np.float64)
+    n = np.maximum(1, np.ceil(rects[:, 2:] / u - 1e-9)).astype(np.int64) # Pieces per axis
+    if (n == 1).all():
+        return rects, np.arange(len(rects))
+    counts = n[:, 0] * n[:, 1]
+    src = np.repeat(np.arange(len(rects)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    ny = n[src, 1]
+    ix, iy = k // ny, k % ny
+    size = rects[src, 2:] / n[src]
+    x0 = rects[src, 0] - rects[src, 2] / 2 + (ix + 0.5) * size[:, 0]
+    y0 = rects[src, 1] - rects[src, 3] / 2 + (iy + 0.5) * size[:, 1]
+    return np.column_stack([x0, y0, size]), src
+
+
+def cover(rects: np.ndarray, usable: Tuple[float, float], pitch: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray, Dict]:
+    """
+    Frame centres covering every [cx, cy, w, h] row (each fits the usable FOV).
+    Returns (centres [T, 2], frame index per rect [N], info).
+    """
+    n = len(rects)
+    if n == 0:
+        return np.zeros((0, 2)), np.zeros(0, dtype=np.int64), {"candidates": 0, "pitch_mm": pitch}
+    u = np.asarray(usable, dtype=np.float64)
+    pitch = pitch or float(min(u)) / CANDIDATES_PER_FOV
+    while True:
+        # Centres c with the rect inside [c - u/2, c + u/2]: rect_max - u/2 <= c <= rect_min + u/2
+        lo = np.ceil((rects[:, :2] + rects[:, 2:] / 2 - u / 2) / pitch - 1e-9).astype(np.int64)
+        hi = np.floor((rects[:, :2] - rects[:, 2:] / 2 + u / 2) / pitch + 1e-9).astype(np.int64)
+        # Nearly FOV-sized rects may fall between grid points: their own centre is the candidate
+        own = (hi < lo).any(axis=1)
+        lo[own] = hi[own] = 0
+        span = hi - lo + 1
+        counts = np.where(own, 1, span[:, 0] * span[:, 1])
+        if counts.sum() <= MAX_PAIRS:
+            break
+        pitch *= 2.0
+
+    # All (cell, rect) pairs, grouped by rect
+    pair_rect = np.repeat(np.arange(n), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    ny = span[pair_rect, 1]
+    ix = lo[pair_rect, 0] + k // ny
+    iy = lo[pair_rect, 1] + k % ny
+    gx0, gy0 = ix.min(), iy.min()
+    stride = int(iy.max() - gy0 + 1)
+    key = (ix - gx0) * stride + (iy - gy0)
+    grid_keys = int(key.max()) + 1 if len(key) else 0
+    key = np.where(own[pair_rect], grid_keys + pair_rect, key) # Private candidates after the grid
+    cand_keys, pair_cand = np.unique(key, return_inverse=True)
+
+    # Greedy: the candidate covering most uncovered rects, until all are covered
+    count = np.bincount(pair_cand, minlength=len(cand_keys)).astype(np.int64)
+    by_cand = np.argsort(pair_cand, kind="stable")
+    cand_ptr = np.concatenate([[0], np.cumsum(np.bincount(pair_cand, minlength=len(cand_keys)))])
+    rect_ptr = np.concatenate([[0], np.cumsum(counts)])
+    covered = np.zeros(n, dtype=bool)
+    assign = np.full(n, -1, dtype=np.int64)
+    chosen = []
+    while not covered.all():
+        c = int(np.argmax(count))
+        rs = pair_rect[by_cand[cand_ptr[c]:cand_ptr[c + 1]]]
+        rs = rs[~covered[rs]]
+        covered[rs] = True
+        assign[rs] = len(chosen)
+        chosen.append(c)
+        # These rects no longer count for any candidate containing them
+        drop = np.concatenate([pair_cand[rect_ptr[r]:rect_ptr[r + 1]] for r in rs])
+        np.subtract.at(count, drop, 1)
+
+    # Re-centre each frame on the bounding box of its rects (they fit: they fitted the cell)
+    lo_xy = rects[:, :2] - rects[:, 2:] / 2
+    hi_xy = rects[:, :2] + rects[:, 2:] / 2
+    t = len(chosen)
+    bb_lo = np.full((t, 2), np.inf)
+    bb_hi = np.full((t, 2), -np.inf)
+    np.minimum.at(bb_lo, assign, lo_xy)
+    np.maximum.at(bb_hi, assign, hi_xy)
+    centres = (bb_lo + bb_hi) / 2
+    return centres, assign, {"candidates": int(len(cand_keys)), "pairs": int(len(pair_cand)), "pitch_mm": round(pitch, 4)}
+
+
+def _program_regions(prog) -> List[Region]:
+    """ROIs of the program's inspect points as work-coordinate regions (whole usable FOV for points without ROIs)"""
+    kx, ky = camera.mm_per_px_xy()
+    sx, sy = camera.IMAGE_AXIS_SIGN
+    w, h = camera.camera_driver.width, camera.camera_driver.height
+    ox, oy = motion.work_offset["x"], motion.work_offset["y"]
+    regions = []
+    for p in prog.points:
+        if not p.rois:
+            regions.append(Region(x=p.x - ox, y=p.y - oy, w=0.0, h=0.0, name=f"point {p.id}"))
+            continue
+        for r in p.rois:
+            regions.append(Region(
+                x=p.x - ox + sx * (r.x + r.w / 2 - w / 2) * kx,
+                y=p.y - oy + sy * (r.y + r.h / 2 - h / 2) * ky,
+                w=r.w * kx, h=r.h * ky, name=r.name, part_class=r.part_class))
+    return regions
+
+
+def _start() -> Tuple[float, float]:
+    # Like a program run: frames start right after alignment, at the last ref
+    refs = program.current_program.refs
+    return (refs[-1].x, refs[-1].y) if refs else (motion.machine_pos["x"], motion.machine_pos["y"])
+
+
+def plan(regions: Sequence[Region], overlap_percent: float = 0.1, margin_mm: float = 0.3,
+         width_mm: Optional[float] = None, height_mm: Optional[float] = None, optimize: bool = True,
+         time_limit_s: float = 0.3, start: Optional[Sequence[float]] = None) -> Dict:
+    """Frames covering the regions, in visiting order, with the saving vs the full raster"""
+    t0 = time.perf_counter()
+    fov_w, fov_h = camera.fov_mm()
+    usable = (fov_w * (1 - overlap_percent), fov_h * (1 - overlap_percent))
+    start = tuple(start) if start is not None else _start()
+    ox, oy = motion.work_offset["x"], motion.work_offset["y"]
+
+    rects = np.array([[r.x, r.y, r.w + 2 * margin_mm, r.h + 2 * margin_mm] for r in regions], dtype=np.float64).reshape(-1, 4)
+    # Regions without a size (taught points) take a whole frame
+    rects[:, 2:] = np.where(rects[:, 2:] <= 2 * margin_mm, np.asarray(usable), rects[:, 2:])
+    pieces, src = split_oversize(rects, usable)
+    centres, assign, info = cover(pieces, usable)
+
+    # Visiting order (machine coordinates)
+    xy = centres + np.array([ox, oy])
+    if optimize and len(xy):
+        order = path_optimizer.optimize_order(xy, start, time_limit=time_limit_s)
+    else:
+        order = np.lexsort((centres[:, 0], np.round(centres[:, 1], 3)))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    xy = xy[order]
+
+    frames = [{"id": i + 1, "work_x": round(float(centres[j, 0]), 3), "work_y": round(float(centres[j, 1]), 3),
+               "machine_x": round(float(xy[i, 0]), 3), "machine_y": round(float(xy[i, 1]), 3), "regions": []}
+              for i, j in enumerate(order)]
+    for k, f in enumerate(rank[assign]):
+        frames[f]["regions"].append(int(src[k]))
+    for f in frames:
+        f["regions"] = sorted(set(f["regions"]))
+
+    # The raster it replaces: same board area, zigzag, stop-and-go
+    if len(rects):
+        ext_w = width_mm or float((rects[:, 0] + rects[:, 2] / 2).max())
+        ext_h = height_mm or float((rects[:, 1] + rects[:, 3] / 2).max())
+    else:
+        ext_w, ext_h = width_mm or 0.0, height_mm or 0.0
+    raster_xy = np.zeros((0, 2))
+    if ext_w > 0 and ext_h > 0:
+        xs, ys, _, _ = grid(ScanConfig(width_mm=ext_w, height_mm=ext_h, overlap_percent=overlap_percent))
+        raster_xy = np.array([[x + ox, y + oy] for r, y in enumerate(ys) for x in (xs if r % 2 == 0 else xs[::-1])]).reshape(-1, 2)
+    time_s = motion_model.predict(xy, start)["cycle_time_s"] if len(xy) else 0.0
+    raster_s = motion_model.predict(raster_xy, start)["cycle_time_s"] if len(raster_xy) else 0.0
+
+    return {
+        "frames": frames,
+        "regions": len(regions),
+        "pieces": int(len(pieces)),
+        "tiles": len(frames),
+        "raster_tiles": int(len(raster_xy)),
+        "tiles_saved": int(len(raster_xy) - len(frames)),
+        "time_s": round(time_s, 2),
+        "raster_time_s": round(raster_s, 2),
+        "time_saved_s": round(raster_s - time_s, 2),
+        # Densely populated everywhere: whole-component frames can't beat the plain raster
+        "raster_recommended": bool(len(raster_xy)) and raster_s <= time_s,
+        "usable_fov_mm": [round(usable[0], 3), round(usable[1], 3)],
+        "board_mm": [round(ext_w, 2), round(ext_h, 2)],
+        **info,
+        "compute_ms": round((time.perf_counter() - t0) * 1000.0, 1),
+    }
+
+
+def frames_to_points(p: Dict, regions: Sequence[Region], first_id: int = 1) -> List[program.Point]:
+    """Inspect points, one per frame, with each region as a pixel ROI of that frame"""
+    kx, ky = camera.mm_per_px_xy()
+    sx, sy = camera.IMAGE_AXIS_SIGN
+    w, h = camera.camera_driver.width, camera.camera_driver.height
+    points = []
+    for i, f in enumerate(p["frames"]):
+        rois = []
+        for k in f["regions"]:
+            r = regions[k]
+            if r.w <= 0 or r.h <= 0:
+                continue
+            # Work mm -> pixels of the frame centred at (work_x, work_y); a split region is clipped to the frame
+            rw, rh = r.w / kx, r.h / ky
+            cx = w / 2 + sx * (r.x - f["work_x"]) / kx
+            cy = h / 2 + sy * (r.y - f["work_y"]) / ky
+            x0, y0 = max(0, int(round(cx - rw / 2))), max(0, int(round(cy - rh / 2)))
+            x1, y1 = min(w, int(round(cx + rw / 2))), min(h, int(round(cy + rh / 2)))
+            if x1 > x0 and y1 > y0:
+                rois.append(program.ROI(x=x0, y=y0, w=x1 - x0, h=y1 - y0, part_class=r.part_class, name=r.name))
+        points.append(program.Point(id=first_id + i, x=f["machine_x"], y=f["machine_y"], type="inspect", rois=rois))
+    return points
+
+
+def _request_regions(req: CoverageRequest) -> List[Region]:
+    regions = req.regions or _program_regions(program.current_program)
+    if not regions:
+        raise HTTPException(status_code=400, detail="No regions: pass regions or load a program with inspect points")
+    return regions
+
+@router.post("/plan")
+async def plan_coverage(req: CoverageRequest = CoverageRequest()):
+    """Frames that cover the regions (or the current program's ROIs), ordered, vs the full raster"""
+    regions = _request_regions(req)
+    return plan(regions, req.overlap_percent, req.margin_mm, req.width_mm, req.height_mm, req.optimize, req.time_limit_s)
+
+@router.post("/apply")
+async def apply_coverage(req: CoverageRequest = CoverageRequest()):
+    """Replace the current program's inspect points with the coverage frames (refs are kept)"""
+    regions = _request_regions(req)
+    p = plan(regions, req.overlap_percent, req.margin_mm, req.width_mm, req.height_mm, req.optimize, req.time_limit_s)
+    program.current_program.points = frames_to_points(p, regions)
+    p.pop("frames")
+    return {"program": program.current_program, "report": p}
@@ -0,0 +1,119 @@
+"""
+Run event stream (Server-Sent Events).
+
+Worker threads publish small events (point started / finished, run started /
+finished) into a bounded backlog with increasing sequence numbers. Each SSE
+client follows the backlog from its own position: a reconnecting client sends
+Last-Event-ID and gets exactly what it missed; a client that fell further
+behind than the backlog gets a fresh snapshot instead. A slow client receives
+whatever accumulated since its last flush in one go, with superseded progress
+events dropped.
+"""
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+import asyncio
+import json
+import threading
+
+BACKLOG = 2048 # Events kept for resuming clients
+FLUSH_INTERVAL_S = 0.1 # Minimum time between two flushes to one client (bursts are batched)
+HEARTBEAT_S = 15.0 # Comment line to keep proxies from closing an idle stream
+
+# Only the latest of these matters to a client that is behind
+_PROGRESS_EVENTS = ("point_started",)
+
+
+class EventBus:
+    def __init__(self, backlog: int = BACKLOG):
+        self._events: "deque[Tuple[int, str, Dict]]" = deque(maxlen=backlog)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def publish(self, kind: str, data: Dict) -> int:
+        """Thread-safe; wakes every connected client"""
+        with self._lock:
+            self._seq += 1
+            self._events.append((self._seq, kind, data))
+            waiters = list(self._waiters)
+            seq = self._seq
+        for loop, ev in waiters:
+            try:
+                loop.call_soon_threadsafe(ev.set)
+            except RuntimeError:
+                pass # Loop already closed
+        return seq
+
+    def since(self, seq: int) -> Tuple[List[Tuple[int, str, Dict]], bool]:
+        """Events after seq, and False if some of them already fell out of the backlog"""
+        with self._lock:
+            if seq >= self._seq:
+                return [], True
+            oldest = self._events[0][0] if self._events else self._seq + 1
+            if seq + 1 < oldest:
+                return [], False
+            return [e for e in self._events if e[0] > seq], True
+
+    def subscribe(self) -> asyncio.Event:
+        ev = asyncio.Event()
+        with self._lock:
+            self._waiters.append((asyncio.get_running_loop(), ev))
+        return ev
+
+    def unsubscribe(self, ev: asyncio.Event):
+        with self._lock:
+            self._waiters = [w for w in self._waiters if w[1] is not ev]
+
+    @property
+    def clients(self) -> int:
+        return len(self._waiters)
+
+
+def coalesce(events: List[Tuple[int, str, Dict]]) -> List[Tuple[int, str, Dict]]:
+    """Drop progress events that a later event of the same kind supersedes"""
+    last = {}
+    for i, (_, kind, _) in enumerate(events):
+        if kind in _PROGRESS_EVENTS:
+            last[kind] = i
+    return [e for i, e in enumerate(events) if e[1] not in _PROGRESS_EVENTS or last[e[1]] == i]
+
+
+def format_sse(seq: int, kind: str, data: Dict) -> str:
+    return f"id: {seq}\nevent: {kind}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+async def stream(request, bus: EventBus, snapshot: Callable[[], Dict], since: Optional[int] = None):
+    """
+    SSE generator for one client. Without a resumable position the client
+    first gets a "snapshot" event (current state), then live events.
+    """
+    ev = bus.subscribe()
+    try:
+        last = since
+        if last is None or not bus.since(last)[1]:
+            last = bus.seq
+            yield format_sse(last, "snapshot", snapshot())
+        while True:
+            if await request.is_disconnected():
+                return
+            events, complete = bus.since(last)
+            if not complete:
+                last = bus.seq
+                yield format_sse(last, "snapshot", snapshot())
+                continue
+            if events:
+                yield "".join(format_sse(*e) for e in coalesce(events))
+                last = events[-1][0]
+                await asyncio.sleep(FLUSH_INTERVAL_S)
+                continue
+            try:
+                await asyncio.wait_for(ev.wait(), HEARTBEAT_S)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"
+            ev.clear()
+    finally:
+        bus.unsubscribe(ev)
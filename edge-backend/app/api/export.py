@@ -0,0 +1,247 @@
+"""
+Streaming history export.
+
+Rows are produced by generators, one run and one point at a time (results are
+read from the run journals), and encoded in small chunks, so memory stays flat
+no matter how many runs are exported.
+
+- csv / parquet / arrow: one row per detection (a point without detections
+  gives one row with empty detection columns)
+- ndjson: one line per point, detections kept as a nested list
+Parquet and Arrow IPC use pyarrow (imported only when those formats are asked for).
+"""
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from typing import Dict, Iterator, List, Optional
+import csv
+import io
+import json
+import os
+
+from app.api import journal, history_index
+
+router = APIRouter()
+
+CSV_FLUSH_ROWS = 500 # Rows buffered before a chunk is sent
+ARROW_BATCH_ROWS = 4096 # Rows per Parquet row group / Arrow record batch
+INDEX_PAGE = 500 # Runs fetched from the history index per query
+
+COLUMNS = [
+    "run_id", "part_no", "batch_no", "program_name", "completed_at",
+    "point_id", "x", "y", "result", "manual_override",
+    "label", "confidence", "box_x", "box_y", "box_w", "box_h", "roi", "expected",
+]
+
+# Per-run CSV (/history/{run_id}/export/csv): the original columns stay first
+LEGACY_CSV_COLUMNS = {"Point ID": "point_id", "X": "x", "Y": "y", "Result": "result",
+                      "Label": "label", "Confidence": "confidence"}
+
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def _history_dir() -> str:
+    from app.api import orchestrator # Lazy: orchestrator owns HISTORY_DIR
+    return orchestrator.HISTORY_DIR
+
+
+def select_runs(run_ids: Optional[List[str]] = None, **filters) -> Iterator[Dict]:
+    """Index rows of the runs to export, oldest first, fetched page by page"""
+    if run_ids:
+        for run_id in run_ids:
+            page = history_index.query(limit=1, run_id=run_id)
+            if page["items"]:
+                yield page["items"][0]
+        return
+    offset = 0
+    while True:
+        page = history_index.query(limit=INDEX_PAGE, offset=offset, sort="completed_at", descending=False, **filters)
+        yield from page["items"]
+        offset += len(page["items"])
+        if offset >= page["total"] or not page["items"]:
+            return
+
+
+def iter_points(runs: Iterator[Dict]) -> Iterator[Dict]:
+    """Every point of every run, with the run columns attached"""
+    history_dir = _history_dir()
+    for run in runs:
+        run_cols = {
+            "run_id": run["run_id"],
+            "part_no": run["part_no"],
+            "batch_no": run["batch_no"],
+            "program_name": run["program_name"],
+            "completed_at": run["completed_at"],
+        }
+        for r in journal.iter_results(os.path.join(history_dir, run["run_id"])):
+            yield {
+                **run_cols,
+                "point_id": r.get("point_id"),
+                "x": r.get("x"),
+                "y": r.get("y"),
+                "result": r.get("result"),
+                "manual_override": bool(r.get("manual_override", False)),
+                "detections": r.get("detections") or [],
+            }
+
+
+def iter_rows(points: Iterator[Dict]) -> Iterator[Dict]:
+    """Flatten points to one row per detection"""
+    for p in points:
+        base = {k: v for k, v in p.items() if k != "detections"}
+        for d in p["detections"] or [None]:
+            row = dict(base)
+            if d is None:
+                row.update(label=None, confidence=None, box_x=None, box_y=None, box_w=None, box_h=None,
+                           roi=None, expected=None)
+            else:
+                box = d.get("box") or [None] * 4
+                row.update(label=d.get("label"), confidence=d.get("confidence"),
+                           box_x=box[0], box_y=box[1], box_w=box[2], box_h=box[3],
+                           roi=d.get("roi"), expected=d.get("expected"))
+            yield row
+
+
+# --- Encoders: each yields bytes chunks ---
+def encode_csv(rows: Iterator[Dict], legacy: bool = False) -> Iterator[bytes]:
+    buf = io.StringIO()
+    if legacy:
+        fields = list(LEGACY_CSV_COLUMNS) + [c for c in COLUMNS if c not in LEGACY_CSV_COLUMNS.values()]
+        rename = {v: k for k, v in LEGACY_CSV_COLUMNS.items()}
+    else:
+        fields, rename = COLUMNS, {}
+    writer = csv.DictWriter(buf, fieldnames=fields)
+    writer.writeheader()
+    n = 0
+    for row in rows:
+        writer.writerow({rename.get(k, k): v for k, v in row.items()} if rename else row)
+        n += 1
+        if n % CSV_FLUSH_ROWS == 0:
+            yield buf.getvalue().encode()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode()
+
+
+def encode_ndjson(points: Iterator[Dict]) -> Iterator[bytes]:
+    chunk = []
+    for p in points:
+        chunk.append(json.dumps(p, separators=(",", ":")))
+        if len(chunk) >= CSV_FLUSH_ROWS:
+            yield ("\n".join(chunk) + "\n").encode()
+            chunk = []
+    if chunk:
+        yield ("\n".join(chunk) + "\n").encode()
+
+
+class _ChunkSink:
+    """Write-only file object for pyarrow: keeps the position, hands out what was written"""
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        b = bytes(data)
+        self.chunks.append(b)
+        self.pos += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        out = b"".join(self.chunks)
+        self.chunks = []
+        return out
+
+
+def _arrow_schema(pa):
+    return pa.schema([
+        ("run_id", pa.string()), ("part_no", pa.string()), ("batch_no", pa.string()),
+        ("program_name", pa.string()), ("completed_at", pa.float64()),
+        ("point_id", pa.int64()), ("x", pa.float64()), ("y", pa.float64()),
+        ("result", pa.string()), ("manual_override", pa.bool_()),
+        ("label", pa.string()), ("confidence", pa.float64()),
+        ("box_x", pa.int64()), ("box_y", pa.int64()), ("box_w", pa.int64()), ("box_h", pa.int64()),
+        ("roi", pa.string()), ("expected", pa.string()),
+    ])
+
+
+def encode_arrow(rows: Iterator[Dict], fmt: str) -> Iterator[bytes]:
+    import pyarrow as pa
+    schema = _arrow_schema(pa)
+    sink = _ChunkSink()
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression="zstd")
+        write = writer.write_table
+    else:
+        writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+        write = writer.write_table
+
+    cols: Dict[str, list] = {c: [] for c in COLUMNS}
+    for row in rows:
+        for c in COLUMNS:
+            cols[c].append(row[c])
+        if len(cols["run_id"]) >= ARROW_BATCH_ROWS:
+            write(pa.Table.from_pydict(cols, schema=schema))
+            cols = {c: [] for c in COLUMNS}
+            yield sink.take()
+    if cols["run_id"]:
+        write(pa.Table.from_pydict(cols, schema=schema))
+    writer.close()
+    yield sink.take()
+
+
+def stream(fmt: str, runs: Iterator[Dict], legacy_csv: bool = False) -> Iterator[bytes]:
+    points = iter_points(runs)
+    if fmt == "ndjson":
+        return encode_ndjson(points)
+    if fmt == "csv":
+        return encode_csv(iter_rows(points), legacy_csv)
+    return encode_arrow(iter_rows(points), fmt)
+
+
+def export_response(fmt: str, runs: Iterator[Dict], filename: str, legacy_csv: bool = False) -> StreamingResponse:
+    if fmt not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {fmt}")
+    if fmt in ("parquet", "arrow"):
+        try:
+            import pyarrow # noqa: F401
+        except ImportError:
+            raise HTTPException(status_code=501, detail="Parquet/Arrow export needs pyarrow installed")
+    # Sync generator: Starlette iterates it in the threadpool
+    return StreamingResponse(
+        stream(fmt, runs, legacy_csv),
+        media_type=MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f"attachment; filename={filename}.{fmt}"}
+    )
+
+
+@router.get("/runs")
+def export_runs(
+    format: str = "csv",
+    run_ids: Optional[str] = None, # Comma separated; overrides the filters
+    part_no: Optional[str] = None,
+    batch_no: Optional[str] = None,
+    status: Optional[str] = None,
+    date_from: Optional[float] = None, # Unix time, on completed_at
+    date_to: Optional[float] = None,
+):
+    """Export the results of many runs (selected through the history index)"""
+    ids = [r for r in run_ids.split(",") if r] if run_ids else None
+    runs = select_runs(ids, part_no=part_no, batch_no=batch_no, status=status,
+                       date_from=date_from, date_to=date_to)
+    name = batch_no or part_no or "history"
+    return export_response(format, runs, f"aoi_{name}")
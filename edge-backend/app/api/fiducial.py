@@ -0,0 +1,202 @@
+"""
+Automatic fiducial alignment.
+
+For every taught ref the machine moves to the ref position, grabs a fresh frame
+and locates the fiducial:
+- template mode: the ref's golden image (captured with the golden board) is
+  matched coarse-to-fine: whole-frame search on a low pyramid level, then a
+  small window at full resolution, then a parabolic sub-pixel peak fit.
+- circle mode (no golden image): Hough circle closest to the image centre,
+  refined with the intensity centroid of the fiducial disc.
+The pixel offset is converted to mm and the measured ref positions go into the
+same affine solve as manual alignment.
+"""
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from typing import Dict, Optional, Tuple
+import time
+
+import cv2
+import numpy as np
+
+from app.api import camera, golden, motion
+from app.api import program as program_api
+from app.api.program import Point
+
+router = APIRouter()
+
+PATCH_PX = 128 # Fiducial template: central square of the golden ref image
+COARSE_LEVEL = 2 # Pyramid level of the whole-frame search (1/4 size)
+REFINE_WINDOW_PX = 12 # +- search window at full resolution around the coarse hit
+MIN_SCORE = 0.6 # Below this the fiducial is considered not found
+
+
+def _subpixel_peak(scores: np.ndarray, x: int, y: int) -> Tuple[float, float]:
+    """Parabola fit through the peak and its neighbours, per axis"""
+    def fit(l, c, r):
+        denom = l - 2 * c + r
+        return 0.0 if abs(denom) < 1e-12 else 0.5 * (l - r) / denom
+    h, w = scores.shape
+    dx = fit(scores[y, x - 1], scores[y, x], scores[y, x + 1]) if 0 < x < w - 1 else 0.0
+    dy = fit(scores[y - 1, x], scores[y, x], scores[y + 1, x]) if 0 < y < h - 1 else 0.0
+    return x + dx, y + dy
+
+
+def locate_template(gray: np.ndarray, template: "golden.GoldenTemplate") -> Dict:
+    """
+    Find the central patch of a golden ref template in gray.
+    Returns {"found", "score", "offset_px": [dx, dy]}, offset relative to where
+    the patch sits in the golden image.
+    """
+    ref = template.gray
+    h, w = ref.shape
+    half = PATCH_PX // 2
+    px0, py0 = w // 2 - half, h // 2 - half
+
+    # Coarse: whole frame at 1/2^L (pyramid views, nothing copied from the cache)
+    lvl = min(COARSE_LEVEL, len(template.pyramid) - 1)
+    img_c = golden.build_pyramid(gray, lvl + 1)[lvl]
+    patch_c = template.pyramid[lvl][py0 >> lvl:(py0 + PATCH_PX) >> lvl, px0 >> lvl:(px0 + PATCH_PX) >> lvl]
+    scores = cv2.matchTemplate(img_c, patch_c, cv2.TM_CCOEFF_NORMED)
+    _, _, _, (cx, cy) = cv2.minMaxLoc(scores)
+
+    # Fine: small window at full resolution
+    patch = ref[py0:py0 + PATCH_PX, px0:px0 + PATCH_PX]
+    gx, gy = cx << lvl, cy << lvl
+    r = REFINE_WINDOW_PX
+    x0, y0 = max(0, gx - r), max(0, gy - r)
+    x1 = min(gray.shape[1], gx + PATCH_PX + r)
+    y1 = min(gray.shape[0], gy + PATCH_PX + r)
+    scores = cv2.matchTemplate(gray[y0:y1, x0:x1], patch, cv2.TM_CCOEFF_NORMED)
+    _, score, _, (fx, fy) = cv2.minMaxLoc(scores)
+    sx, sy = _subpixel_peak(scores, fx, fy)
+
+    return {
+        "found": bool(score >= MIN_SCORE),
+        "score": round(float(score), 4),
+        "offset_px": [round(x0 + sx - px0, 3), round(y0 + sy - py0, 3)],
+    }
+
+
+def locate_circle(gray: np.ndarray) -> Dict:
+    """
+    Find the round fiducial closest to the image centre.
+    Returns {"found", "score", "offset_px"}, offset relative to the image centre.
+    """
+    h, w = gray.shape
+    small = cv2.pyrDown(gray)
+    small = cv2.medianBlur(small, 5)
+    circles = cv2.HoughCircles(small, cv2.HOUGH_GRADIENT, dp=1.2, minDist=20,
+                               param1=100, param2=30, minRadius=4, maxRadius=min(h, w) // 6)
+    if circles is None:
+        return {"found": False, "score": 0.0, "offset_px": [0.0, 0.0]}
+
+    c = circles[0] * 2.0 # back to full resolution
+    d = np.hypot(c[:, 0] - w / 2, c[:, 1] - h / 2)
+    cx, cy, rad = c[int(np.argmin(d))]
+
+    # Sub-pixel: intensity centroid of the disc (pad is bright or dark vs. background)
+    r = int(rad * 1.3) + 2
+    x0, y0 = max(0, int(cx) - r), max(0, int(cy) - r)
+    roi = gray[y0:int(cy) + r + 1, x0:int(cx) + r + 1]
+    _, bw = cv2.threshold(roi, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    if bw[bw.shape[0] // 2, bw.shape[1] // 2] == 0:
+        bw = 255 - bw
+    m = cv2.moments(bw, binaryImage=True)
+    if m["m00"] > 0:
+        cx, cy = x0 + m["m10"] / m["m00"], y0 + m["m01"] / m["m00"]
+
+    return {
+        "found": True,
+        "score": 1.0,
+        "offset_px": [round(float(cx - w / 2), 3), round(float(cy - h / 2), 3)],
+    }
+
+
+def detect_at(ref: Point, template: Optional["golden.GoldenTemplate"]) -> Dict:
+    """Move to a taught ref, capture, locate the fiducial. Returns the measured ref position."""
+    motion.move_and_wait(ref.x, ref.y)
+    frame = camera.get_latest_frame(after=time.monotonic())
+
+    t0 = time.perf_counter()
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if template is not None:
+        res = locate_template(gray, template)
+        res["mode"] = "template"
+    else:
+        res = locate_circle(gray)
+        res["mode"] = "circle"
+    res["detect_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+
+    # The board moved by the fiducial offset: convert px -> mm in machine axes
+    kx, ky = camera.mm_per_px_xy() # Calibrated scale (frames are undistorted already)
+    sx, sy = camera.IMAGE_AXIS_SIGN
+    res["id"] = ref.id
+    res["x"] = round(motion.machine_pos["x"] + sx * res["offset_px"][0] * kx, 4)
+    res["y"] = round(motion.machine_pos["y"] + sy * res["offset_px"][1] * ky, 4)
+    return res
+
+
+ALIGN_JOB = "fiducial alignment"
+
+def _claim_machine():
+    # Not while a run, fly-scan or golden capture is driving the gantry
+    busy = motion.claim(ALIGN_JOB)
+    if busy:
+        raise HTTPException(status_code=409, detail=f"Machine busy: {busy} in progress")
+
+
+class AutoAlignRequest(BaseModel):
+    # Defaults to the currently loaded program
+    program_name: str = ""
+
+@router.post("/align")
+def auto_align(req: AutoAlignRequest = AutoAlignRequest()):
+    """
+    Visit every taught ref, locate its fiducial and solve the board transform.
+    Same response as /api/program/align plus per-fiducial measurements.
+    (Plain def: runs in the threadpool, it moves the machine.)
+    """
+    prog = program_api.current_program
+    if req.program_name and req.program_name != prog.name:
+        prog = program_api._load_from_disk(req.program_name)
+        if not prog:
+            raise HTTPException(status_code=404, detail="Program not found")
+    if len(prog.refs) < 2:
+        raise HTTPException(status_code=400, detail="Need at least 2 refs for alignment")
+
+    golden_set = golden.store.load(prog.name)
+    t0 = time.perf_counter()
+    fiducials = []
+    _claim_machine()
+    try:
+        for ref in prog.refs:
+            template = golden_set.get(ref.id, "ref") if golden_set else None
+            fiducials.append(detect_at(ref, template))
+    finally:
+        motion.release(ALIGN_JOB)
+
+    # Missing fiducials are skipped; the solve needs at least 2 of them
+    run_refs = [Point(id=f["id"], x=f["x"], y=f["y"], type="ref") for f in fiducials if f["found"]]
+    if len(run_refs) < 2:
+        missing = [f["id"] for f in fiducials if not f["found"]]
+        raise HTTPException(status_code=422, detail=f"Fiducial not found for ref(s) {missing}")
+    result = program_api._align_program(prog, run_refs)
+    result["fiducials"] = fiducials
+    result["total_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    return result
+
+@router.post("/detect")
+def detect_here(ref_id: Optional[int] = None):
+    """Locate a fiducial at the current position (teaching aid)"""
+    prog = program_api.current_program
+    template = None
+    if ref_id is not None:
+        golden_set = golden.store.load(prog.name)
+        template = golden_set.get(ref_id, "ref") if golden_set else None
+    _claim_machine()
+    try:
+        here = Point(id=ref_id or 0, x=motion.machine_pos["x"], y=motion.machine_pos["y"], type="ref")
+        return detect_at(here, template)
+    finally:
+        motion.release(ALIGN_JOB)
@@ -0,0 +1,276 @@
+"""
+Simulated FluidNC/GRBL controller on a pseudo-terminal.
+
+Speaks enough of the GRBL serial protocol to test the streaming driver with no
+hardware: line commands answered with ok/error once they enter a bounded
+planner queue, real-time characters (? ! ~ Ctrl-X) handled immediately,
+status reports <Idle|MPos:...|FS:...>, ALARM on soft-limit violations.
+Moves are executed in real time along a straight line with a trapezoidal
+velocity profile (axis rate and acceleration limits projected on the move
+direction), each block starting and ending at rest.
+
+    sim = SimulatedFluidNC(); sim.start(); print(sim.port)  # e.g. /dev/pts/3
+"""
+from collections import deque
+from typing import Dict, Optional
+import math
+import os
+import re
+import threading
+import time
+import tty
+
+from app.api.motion_model import model as motion_model
+
+TRAVEL = {"x": 300.0, "y": 300.0} # Soft limits ($130/$131)
+PLANNER_BLOCKS = 16 # Blocks queued before the controller stops answering "ok"
+STEP_S = 0.002 # Simulation time step
+
+_WORD = re.compile(r"([A-Z])\s*(-?\d+\.?\d*)")
+
+
+class SimulatedFluidNC:
+    def __init__(self, max_rate: Optional[Dict] = None, accel: Optional[Dict] = None, travel: Dict = TRAVEL,
+                 planner_blocks: int = PLANNER_BLOCKS):
+        # $110/$111 (mm/min) and $120/$121 (mm/s^2). None: the machine's motion model,
+        # read per block so predicted and simulated move times agree after /model updates
+        self.max_rate = dict(max_rate) if max_rate else None
+        self.accel = dict(accel) if accel else None
+        self.travel = dict(travel)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self._lock = threading.Condition()
+        self._queue: "deque[Dict]" = deque()
+        self._planner_blocks = planner_blocks
+        self.pos = {"x": 0.0, "y": 0.0}
+        self.feed = 0.0
+        self.state = "Idle" # Idle / Run / Hold:0 / Hold:1 / Alarm
+        self._hold = False
+        self._reset = False
+        self._resets = 0 # Lines parsed before a Ctrl-X must not reach the planner
+        self._absolute = True
+        self._motion = 0 # Modal G0 / G1
+        self._feed_rate = 1000.0 # Modal F (mm/min)
+        self._lines: "deque[str]" = deque() # Serial RX buffer (parsed by a separate thread)
+        self._write_lock = threading.Lock()
+        self.lines_received = 0
+
+    # --- Lifecycle ---
+    def start(self):
+        threading.Thread(target=self._rx, name="fluidnc-sim-rx", daemon=True).start()
+        threading.Thread(target=self._parser, name="fluidnc-sim-parser", daemon=True).start()
+        threading.Thread(target=self._exec, name="fluidnc-sim-exec", daemon=True).start()
+        self._send("Grbl 3.7 [FluidNC v3.7.0 (simulated) '$' for help]")
+        return self
+
+    def _send(self, line: str):
+        with self._write_lock:
+            os.write(self.master, (line + "\r\n").encode())
+
+    # --- Serial input ---
+    def _rx(self):
+        """Real-time characters act immediately; lines go to the parser (which may block on the planner)"""
+        buf = b""
+        while True:
+            data = os.read(self.master, 256)
+            for b in data:
+                ch = bytes([b])
+                if ch == b"?":
+                    self._send(self._status())
+                elif ch == b"!":
+                    with self._lock:
+                        if self.state == "Run":
+                            self._hold = True
+                            self.state = "Hold:1" # Decelerating
+                        self._lock.notify_all()
+                elif ch == b"~":
+                    with self._lock:
+                        self._hold = False
+                        if self.state.startswith("Hold"):
+                            self.state = "Run" if self._queue else "Idle"
+                        self._lock.notify_all()
+                elif ch == b"\x18":
+                    with self._lock:
+                        self._queue.clear()
+                        self._lines.clear()
+                        self._hold = False
+                        self._reset = True
+                        self._resets += 1
+                        if self.state != "Alarm":
+                            self.state = "Idle"
+                        self._lock.notify_all()
+                    buf = b""
+                    self._send("Grbl 3.7 [FluidNC v3.7.0 (simulated) '$' for help]")
+                elif ch in (b"\n", b"\r"):
+                    if buf.strip():
+                        with self._lock:
+                            self._lines.append(buf.decode(errors="replace").strip())
+                            self._lock.notify_all()
+                    buf = b""
+                else:
+                    buf += ch
+
+    def _parser(self):
+        while True:
+            with self._lock:
+                self._lock.wait_for(lambda: self._lines)
+                line = self._lines.popleft()
+                gen = self._resets
+            self._line(line, gen)
+
+    def _line(self, line: str, gen: int = 0):
+        self.lines_received += 1
+        upper = line.upper()
+        if upper == "$X":
+            with self._lock:
+                if self.state == "Alarm":
+                    self.state = "Idle"
+            self._send("[MSG:Caution: Unlocked]")
+            self._send("ok")
+            return
+        if upper.startswith("$"):
+            self._send("ok")
+            return
+        if self.state == "Alarm":
+            self._send("error:9") # G-code locked out during alarm
+            return
+
+        words = dict((k, float(v)) for k, v in _WORD.findall(upper))
+        gs = [float(v) for k, v in _WORD.findall(upper) if k == "G"]
+        ms = [float(v) for k, v in _WORD.findall(upper) if k == "M"]
+        if 90 in gs:
+            self._absolute = True
+        if 91 in gs:
+            self._absolute = False
+        if 0 in gs:
+            self._motion = 0
+        if 1 in gs:
+            self._motion = 1
+        if "F" in words:
+            self._feed_rate = words["F"]
+
+        block = None
+        if 4 in gs:
+            block = {"dwell": words.get("P", 0.0)}
+        elif 0 in ms:
+            block = {"pause": True} # M0: feed hold once the moves before it are done
+        elif "X" in words or "Y" in words:
+            with self._lock:
+                # Target relative to the end of the last queued move (planner position)
+                base = dict(self._queue[-1]["target"]) if self._queue and "target" in self._queue[-1] else dict(self.pos)
+            tgt = {}
+            for ax in ("x", "y"):
+                v = words.get(ax.upper())
+                tgt[ax] = base[ax] if v is None else (v if self._absolute else base[ax] + v)
+            if not all(0.0 <= tgt[ax] <= self.travel[ax] for ax in tgt):
+                with self._lock:
+                    self._queue.clear()
+                    self.state = "Alarm"
+                    self._lock.notify_all()
+                self._send("ALARM:2") # Soft limit
+                return
+            block = {"target": tgt, "feed": None if self._motion == 0 else self._feed_rate}
+
+        if block is not None:
+            with self._lock:
+                # Planner full: "ok" is withheld until a block finishes
+                self._lock.wait_for(lambda: len(self._queue) < self._planner_blocks or self._resets != gen)
+                if self._resets != gen:
+                    return # Flushed by a reset while waiting
+                self._queue.append(block)
+                if self.state == "Idle":
+                    self.state = "Run"
+                self._lock.notify_all()
+        self._send("ok")
+
+    def _status(self) -> str:
+        with self._lock:
+            return f"<{self.state}|MPos:{self.pos['x']:.3f},{self.pos['y']:.3f},0.000|FS:{self.feed:.0f},0>"
+
+    # --- Motion ---
+    def _limits(self, ux: float, uy: float, feed: Optional[float]):
+        """Path velocity (mm/s) and acceleration limits along direction (ux, uy)"""
+        rate = self.max_rate or {a: motion_model.axis(a).max_velocity * 60.0 for a in ("x", "y")}
+        accel = self.accel or {a: motion_model.axis(a).accel for a in ("x", "y")}
+        v = min((rate[a] / 60.0) / abs(u) for a, u in (("x", ux), ("y", uy)) if abs(u) > 1e-9)
+        acc = min(accel[a] / abs(u) for a, u in (("x", ux), ("y", uy)) if abs(u) > 1e-9)
+        if feed:
+            v = min(v, feed / 60.0)
+        return v, acc
+
+    def _exec(self):
+        while True:
+            with self._lock:
+                self._lock.wait_for(lambda: self._queue and not self._hold)
+                block = self._queue[0]
+                self._reset = False
+            if "pause" in block:
+                with self._lock:
+                    self._hold = True
+                    self.state = "Hold:0"
+            elif "dwell" in block:
+                end = time.monotonic() + block["dwell"]
+                while time.monotonic() < end and not self._reset:
+                    time.sleep(STEP_S)
+            else:
+                self._move(block)
+            with self._lock:
+                if self._queue and self._queue[0] is block:
+                    self._queue.popleft()
+                if not self._queue and self.state in ("Run", "Hold:0") and not self._hold:
+                    self.state = "Idle"
+                self.feed = 0.0
+                self._lock.notify_all()
+
+    def _move(self, block: Dict):
+        sx, sy = self.pos["x"], self.pos["y"]
+        tx, ty = block["target"]["x"], block["target"]["y"]
+        length = math.hypot(tx - sx, ty - sy)
+        if length < 1e-6:
+            return
+        ux, uy = (tx - sx) / length, (ty - sy) / length
+        v_max, acc = self._limits(ux, uy, block["feed"])
+        s, v = 0.0, 0.0
+        t_last = time.monotonic()
+        while s < length:
+            time.sleep(STEP_S)
+            now = time.monotonic()
+            dt, t_last = now - t_last, now
+            with self._lock:
+                if self._reset:
+                    return
+                holding = self._hold
+            if holding or v * v / (2 * acc) >= length - s:
+                v = max(0.0, v - acc * dt) # Decelerate (end of block or feed hold)
+                if holding and v == 0.0:
+                    with self._lock:
+                        self.state = "Hold:0" # Stopped, waiting for ~
+                        self._lock.wait_for(lambda: not self._hold or self._reset)
+                        if self._reset:
+                            return
+                        self.state = "Run"
+                    t_last = time.monotonic()
+                    continue
+                if v == 0.0:
+                    v = acc * dt # Creep the last fraction of a step
+            else:
+                v = min(v_max, v + acc * dt)
+            s = min(length, s + v * dt)
+            with self._lock:
+                self.pos["x"], self.pos["y"] = sx + ux * s, sy + uy * s
+                self.feed = v * 60.0
+        with self._lock:
+            self.pos["x"], self.pos["y"] = tx, ty
+
+
+if __name__ == "__main__":
+    sim = SimulatedFluidNC().start()
+    print(f"Simulated FluidNC on {sim.port} (Ctrl-C to quit)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
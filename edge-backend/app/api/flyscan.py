@@ -0,0 +1,285 @@
+"""
+On-the-fly (continuous motion) board scanning.
+
+Stop-and-go pays move + settle + capture for every tile of the
+scan.preview raster. Here the gantry sweeps each row at constant velocity
+and frames are taken as the camera passes the tile centres:
+
+- hardware trigger: the exported G-code pulses M62/M63 P1 at each tile
+  centre (synchronised with motion on FluidNC), wired to the camera trigger
+- software position compare (simulation / free-running camera): every
+  frame's exposure time is mapped to the machine position interpolated
+  from the controller's status reports, and the frame closest to each tile
+  centre is kept
+
+The sweep velocity is the lowest of: the motion-blur budget (blur_px =
+v * exposure / mm_per_px), the frame rate (a free-running camera must
+expose within the overlap of each tile) and the axis max velocity. Each
+row gets a run-up so the tiles are taken at constant speed.
+"""
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
+from typing import Dict, List, Optional
+import asyncio
+import datetime
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from app.api import camera, mosaic, motion, storage
+from app.api.motion_model import model as motion_model, profile_time
+from app.api.scan import SCANS_DIR, ScanConfig, grid
+
+router = APIRouter()
+
+TRIGGER_PULSE_S = 0.001 # M62 -> M63 pulse length
+RUNUP_MARGIN_MM = 1.0
+
+
+class FlyScanConfig(ScanConfig):
+    exposure_s: Optional[float] = None # Default: the camera's exposure (strobe) time
+    max_blur_px: float = 0.5
+    max_velocity: Optional[float] = None # mm/s, extra cap
+    image_profile: str = "inspection"
+    stitch: bool = True # Build the mosaic + zoom pyramid while scanning
+
+
+def plan(cfg: FlyScanConfig) -> Dict:
+    """Rows, trigger positions, sweep velocity and predicted time vs stop-and-go"""
+    xs, ys, step_x, step_y = grid(cfg)
+    if not xs or not ys:
+        raise HTTPException(status_code=400, detail="Board size gives no tiles")
+    fov_w = camera.fov_mm()[0]
+    mmpp = camera.mm_per_px()
+    exposure = cfg.exposure_s or getattr(camera.camera_driver, "exposure_s", 0.001)
+    fps = getattr(camera.camera_driver, "fps", 20.0)
+    ax = motion_model.axis("x")
+
+    limits = {
+        "blur": cfg.max_blur_px * mmpp / exposure,
+        # Frame spacing v / fps must not exceed the overlap, or a tile can fall between frames
+        "frame_rate": max(fov_w - step_x, 1e-3) * fps,
+        "axis": ax.max_velocity,
+    }
+    if cfg.max_velocity:
+        limits["requested"] = cfg.max_velocity
+    limited_by = min(limits, key=limits.get)
+    v = limits[limited_by]
+    runup = v * v / (2.0 * ax.accel) + RUNUP_MARGIN_MM
+    tol = (fov_w - step_x) / 2.0 # Position error still covered by the overlap
+
+    ox, oy = motion.work_offset["x"], motion.work_offset["y"]
+    lo_x, hi_x = motion.SOFT_LIMITS["x"]
+    rows, tiles = [], []
+    tile_id = 1
+    for r, y in enumerate(ys):
+        direction = 1 if r % 2 == 0 else -1 # Zigzag, like preview_scan_path
+        cols = list(range(len(xs))) if direction > 0 else list(range(len(xs)))[::-1]
+        triggers = []
+        for c in cols:
+            t = {"id": tile_id, "row": r, "col": c, "work_x": round(xs[c], 3), "work_y": round(y, 3),
+                 "machine_x": round(ox + xs[c], 3), "machine_y": round(oy + y, 3)}
+            triggers.append(t)
+            tiles.append(t)
+            tile_id += 1
+        if not triggers:
+            continue
+        first, last = triggers[0]["machine_x"], triggers[-1]["machine_x"]
+        rows.append({
+            "row": r,
+            "y": round(oy + y, 3),
+            "direction": direction,
+            # Run-up before the first and after the last tile (clipped to the travel)
+            "start_x": round(min(hi_x, max(lo_x, first - direction * runup)), 3),
+            "end_x": round(min(hi_x, max(lo_x, last + direction * runup)), 3),
+            "triggers": triggers,
+        })
+
+    # Predicted times: sweeps + row changes vs move/settle/capture per tile
+    fly_s = 0.0
+    prev = None
+    for row in rows:
+        if prev is not None:
+            fly_s += float(motion_model.move_time((prev["end_x"], prev["y"]), (row["start_x"], row["y"])))
+        fly_s += float(profile_time(row["end_x"] - row["start_x"], v, ax.accel))
+        prev = row
+    xy = np.array([[t["machine_x"], t["machine_y"]] for t in tiles], dtype=np.float64).reshape(-1, 2)
+    stop_go_s = motion_model.predict(xy, xy[0] if len(xy) else (0.0, 0.0))["cycle_time_s"]
+
+    return {
+        "velocity_mm_s": round(v, 2),
+        "limited_by": limited_by,
+        "limits_mm_s": {k: round(val, 2) for k, val in limits.items()},
+        "blur_px": round(v * exposure / mmpp, 3),
+        "exposure_s": exposure,
+        "runup_mm": round(runup, 2),
+        "tolerance_mm": round(tol, 3),
+        "step_mm": [round(step_x, 3), round(step_y, 3)],
+        "tiles": len(tiles),
+        "rows": rows,
+        "fly_time_s": round(fly_s, 2),
+        "stop_and_go_s": round(stop_go_s, 2),
+        "speedup": round(stop_go_s / fly_s, 2) if fly_s > 0 else None,
+    }
+
+
+def plan_gcode(p: Dict) -> str:
+    """Hardware-triggered fly-scan: one M62/M63 P1 pulse at every tile centre"""
+    feed = p["velocity_mm_s"] * 60.0
+    pulse = p["velocity_mm_s"] * TRIGGER_PULSE_S
+    lines = ["%", "(Fly-scan, generated by AOI Edge)", "G21 G90 G17 (mm, abs, XY plane)", "G54"]
+    for row in p["rows"]:
+        lines.append(f"(ROW {row['row']})")
+        lines.append(f"G0 X{row['start_x']:.3f} Y{row['y']:.3f}")
+        for t in row["triggers"]:
+            lines.append(f"G1 X{t['machine_x']:.3f} F{feed:.0f}")
+            lines.append(f"M62 P1 (Trigger tile {t['id']})")
+            lines.append(f"G1 X{t['machine_x'] + row['direction'] * pulse:.3f}")
+            lines.append("M63 P1")
+        lines.append(f"G1 X{row['end_x']:.3f}")
+    lines += ["M30", "%"]
+    return "\n".join(lines)
+
+
+# --- Execution (software position compare) ---
+scan_state = {"running": False, "scan_id": None, "tiles_done": 0, "total": 0, "missed": 0,
+              "error": None, "stop_signal": False}
+SCAN_JOB = "fly-scan" # Held on the machine (motion.claim) while the scan runs
+
+
+def _sweep(row: Dict, p: Dict, scan_dir: str, profile: str, tiles_out: List[Dict], builder=None):
+    c = motion.controller
+    v, tol = p["velocity_mm_s"], p["tolerance_mm"]
+    direction = row["direction"]
+    pending = list(row["triggers"])
+    best: Dict[int, tuple] = {} # tile id -> (error_mm, frame, ts, x, y)
+
+    def finish(t):
+        b = best.pop(t["id"], None)
+        if b is None:
+            scan_state["missed"] += 1
+            tiles_out.append({**t, "missed": True})
+            return
+        err, frame, ts, x, y = b
+        name = storage.writer.submit(scan_dir, f"tile_{t['row']:03d}_{t['col']:03d}", frame, profile=profile, review_width=0)
+        tiles_out.append({**t, "image": name, "exposure_x": round(x, 4), "exposure_y": round(y, 4),
+                          "error_mm": round(err, 4), "velocity_mm_s": v})
+        if builder is not None:
+            builder.submit(frame, x, y, name)
+        scan_state["tiles_done"] += 1
+
+    _, _, seq = camera.read_frame()
+    c.move_to(row["end_x"], row["y"], feed=v)
+    while pending:
+        try:
+            frame, ts, seq = camera.read_frame(after_seq=seq, timeout=1.0)
+        except TimeoutError:
+            if c.state != "moving":
+                break
+            continue
+        # The frame was exposed before the newest status report may have arrived
+        c.wait_report_after(ts, timeout=0.5)
+        x, y = c.position_at(ts)
+        for t in pending:
+            err = abs(x - t["machine_x"])
+            if err <= tol and (t["id"] not in best or err < best[t["id"]][0]):
+                best[t["id"]] = (err, frame, ts, x, y)
+        # Tiles the camera has passed are final
+        while pending and direction * (x - pending[0]["machine_x"]) > tol:
+            finish(pending.pop(0))
+        if c.state != "moving" and ts > c.position_history_end():
+            break
+    for t in pending:
+        finish(t)
+    c.wait_idle(timeout=abs(row["end_x"] - row["start_x"]) / v + motion.MOVE_TIMEOUT_MARGIN_S)
+
+
+def run_flyscan(p: Dict, scan_dir: str, profile: str, stitch: bool = False):
+    tiles: List[Dict] = []
+    builder = None
+    mosaic_report = None
+    t0 = time.monotonic()
+    try:
+        camera.start_capture()
+        if stitch:
+            centres = [(t["machine_x"], t["machine_y"]) for row in p["rows"] for t in row["triggers"]]
+            shape = (camera.camera_driver.height, camera.camera_driver.width)
+            builder = mosaic.MosaicBuilder(mosaic.for_scan(scan_dir, centres, shape))
+        for row in p["rows"]:
+            if scan_state["stop_signal"]:
+                print("Fly-scan stopped by user")
+                break
+            # Run-up start: a normal rapid, no settle (nothing is captured there)
+            motion.move_and_wait(row["start_x"], row["y"], settle=0)
+            _sweep(row, p, scan_dir, profile, tiles, builder)
+        storage.writer.drain()
+    except Exception as e:
+        print(f"Fly-scan error: {e}")
+        scan_state["error"] = str(e)
+    finally:
+        elapsed = time.monotonic() - t0
+        if builder is not None:
+            try:
+                mosaic_report = builder.close()
+                mosaic_report.pop("placed")
+            except Exception as e:
+                print(f"Fly-scan mosaic failed: {e}")
+        meta = {k: v for k, v in p.items() if k != "rows"}
+        with open(os.path.join(scan_dir, "tiles.json"), "w") as f:
+            json.dump({"scan_id": scan_state["scan_id"], "plan": meta, "elapsed_s": round(elapsed, 2),
+                       "fov_mm": list(camera.fov_mm()), "mm_per_px": camera.mm_per_px(), "tiles": tiles,
+                       "mosaic": mosaic_report}, f)
+        scan_state["running"] = False
+        motion.release(SCAN_JOB)
+        print(f"Fly-scan finished: {scan_state['tiles_done']} tiles in {elapsed:.1f}s "
+              f"(predicted {p['fly_time_s']}s, stop-and-go {p['stop_and_go_s']}s)")
+
+
+@router.post("/plan")
+async def plan_scan(cfg: FlyScanConfig):
+    return plan(cfg)
+
+@router.post("/plan/gcode")
+async def plan_scan_gcode(cfg: FlyScanConfig):
+    return PlainTextResponse(plan_gcode(plan(cfg)), media_type="text/plain",
+                             headers={"Content-Disposition": "attachment; filename=flyscan.nc"})
+
+@router.post("/start")
+async def start_scan(cfg: FlyScanConfig):
+    if scan_state["running"]:
+        raise HTTPException(status_code=409, detail="A scan is already running")
+    if cfg.image_profile not in storage.PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown image profile: {cfg.image_profile}")
+    p = plan(cfg)
+    busy = motion.claim(SCAN_JOB)
+    if busy:
+        raise HTTPException(status_code=409, detail=f"Machine busy: {busy} in progress")
+    scan_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    scan_dir = os.path.join(SCANS_DIR, scan_id)
+    os.makedirs(scan_dir, exist_ok=True)
+    scan_state.update(running=True, scan_id=scan_id, tiles_done=0, total=p["tiles"], missed=0,
+                      error=None, stop_signal=False)
+    threading.Thread(target=run_flyscan, args=(p, scan_dir, cfg.image_profile, cfg.stitch), daemon=True).start()
+    return {"status": "started", "scan_id": scan_id, "plan": {k: v for k, v in p.items() if k != "rows"}}
+
+@router.post("/stop")
+async def stop_scan():
+    scan_state["stop_signal"] = True
+    if scan_state["running"]:
+        await asyncio.to_thread(motion.controller.stop)
+    return scan_state
+
+@router.get("/status")
+async def scan_status():
+    return scan_state
+
+@router.get("/{scan_id}")
+async def get_scan(scan_id: str):
+    path = os.path.join(SCANS_DIR, os.path.basename(scan_id), "tiles.json")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Scan not found")
+    with open(path) as f:
+        return json.load(f)
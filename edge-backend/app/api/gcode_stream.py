@@ -0,0 +1,306 @@
+"""
+G-code streaming driver for GRBL-protocol controllers (FluidNC, grblHAL, GRBL).
+
+Lines are streamed with the character-counting protocol: the driver tracks how
+many bytes are sitting in the controller's serial RX buffer (sent, not yet
+answered with ok/error) and keeps sending as long as the next line fits. The
+controller's planner always has the next moves queued, instead of idling for a
+round trip after every line.
+
+A reader thread parses everything the controller sends (ok / error / ALARM /
+<status> reports); a poller sends the real-time '?' at motion.STATUS_HZ. Status
+reports feed motion.MotionController, so wait_idle() / await move() work the
+same as with the simulator. Feed hold ('!'), resume ('~') and soft reset
+(Ctrl-X) are real-time characters and bypass the counted buffer.
+
+Ports (AOI_MOTION_PORT):
+  ""                    built-in SimulatedController, no G-code at all
+  "sim"                 SimulatedFluidNC on a pty, streamed like real hardware
+  "/dev/ttyUSB0"        serial port (needs pyserial), AOI_MOTION_BAUD
+  "tcp://host:23"       FluidNC telnet / WiFi
+"""
+from collections import deque
+from typing import Callable, Iterable, Optional, Tuple
+import os
+import re
+import socket
+import threading
+import time
+
+from app.api import motion
+
+RX_BUFFER_SIZE = int(os.getenv("AOI_GRBL_RX_BUFFER", "127")) # GRBL: 128 bytes; FluidNC has more, 127 is always safe
+BAUD = int(os.getenv("AOI_MOTION_BAUD", "115200"))
+
+_STATUS = re.compile(r"<([^|>]+)\|(.*)>")
+
+
+# --- Transports: blocking read(n) / write(bytes) ---
+class FdTransport:
+    """TTY or pty opened as a raw file descriptor"""
+    def __init__(self, path: str):
+        import tty
+        self.fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(self.fd)
+
+    def read(self) -> bytes:
+        return os.read(self.fd, 1024)
+
+    def write(self, data: bytes):
+        os.write(self.fd, data)
+
+    def close(self):
+        os.close(self.fd)
+
+class SerialTransport:
+    def __init__(self, path: str, baud: int = BAUD):
+        try:
+            import serial
+        except ImportError:
+            raise RuntimeError("pyserial is required for serial ports (pip install pyserial)")
+        self.port = serial.Serial(path, baud, timeout=None)
+
+    def read(self) -> bytes:
+        return self.port.read(max(1, self.port.in_waiting))
+
+    def write(self, data: bytes):
+        self.port.write(data)
+
+    def close(self):
+        self.port.close()
+
+class SocketTransport:
+    def __init__(self, host: str, port: int):
+        self.sock = socket.create_connection((host, port), timeout=5)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def read(self) -> bytes:
+        return self.sock.recv(1024)
+
+    def write(self, data: bytes):
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+
+def parse_status(line: str) -> Optional[Tuple[str, Optional[Tuple[float, float]]]]:
+    """'<Run|MPos:1.000,2.000,0.000|FS:500,0>' -> ('Run', (1.0, 2.0))"""
+    m = _STATUS.match(line)
+    if not m:
+        return None
+    state, fields = m.group(1), m.group(2).split("|")
+    pos = wco = None
+    for f in fields:
+        key, _, val = f.partition(":")
+        if key in ("MPos", "WPos", "WCO"):
+            v = [float(p) for p in val.split(",")]
+            if key == "WCO":
+                wco = v
+            else:
+                pos = (key, v)
+    if pos is None:
+        return state, None
+    kind, v = pos
+    if kind == "WPos" and wco is not None:
+        v = [a + b for a, b in zip(v, wco)]
+    return state, (v[0], v[1])
+
+
+class GrblStreamer(motion.MotionController):
+    def __init__(self, transport, rx_buffer: int = RX_BUFFER_SIZE):
+        super().__init__()
+        self.t = transport
+        self.rx_buffer = rx_buffer
+        self._inflight: "deque[Tuple[int, str]]" = deque() # (bytes, line) awaiting ok/error
+        self._buf = threading.Condition()
+        self._write_lock = threading.Lock()
+        self.controller_state = "Unknown" # Raw state word from the last report
+        self.last_error: Optional[str] = None
+        self.lines_sent = 0
+        self.errors: "deque[str]" = deque(maxlen=20)
+        self._closed = False
+        threading.Thread(target=self._reader, name="aoi-grbl-rx", daemon=True).start()
+        threading.Thread(target=self._poller, name="aoi-grbl-status", daemon=True).start()
+
+    # --- Sending ---
+    def _write(self, data: bytes):
+        with self._write_lock:
+            self.t.write(data)
+
+    def realtime(self, ch: bytes):
+        """Real-time command: not counted, acted on immediately by the controller"""
+        self._write(ch)
+
+    def send_line(self, line: str, timeout: Optional[float] = None, on_queued: Optional[Callable[[], None]] = None):
+        """
+        Queue one line; blocks only while the controller's RX buffer has no room for it.
+        on_queued runs once the line is in flight, before a status report can be handled.
+        """
+        data = (line.strip() + "\n").encode()
+        if len(data) > self.rx_buffer:
+            raise ValueError(f"G-code line longer than the RX buffer: {line!r}")
+        with self._buf:
+            ok = self._buf.wait_for(lambda: sum(n for n, _ in self._inflight) + len(data) <= self.rx_buffer
+                                    or self._closed, timeout)
+            if not ok:
+                raise motion.MotionError("Controller stopped accepting G-code")
+            self._inflight.append((len(data), line))
+            if on_queued:
+                on_queued()
+            self._write(data)
+            self.lines_sent += 1
+
+    def stream(self, lines: Iterable[str], on_progress: Optional[Callable[[int], None]] = None) -> int:
+        """Stream a program (comments / blank lines dropped). Returns once every line is sent."""
+        n = 0
+        for raw in lines:
+            line = raw.split(";", 1)[0].split("(", 1)[0].strip()
+            if not line:
+                continue
+            if self.state == "alarm":
+                raise motion.MotionError(f"Alarm: {self.alarm}")
+            self.send_line(line)
+            n += 1
+            if on_progress:
+                on_progress(n)
+        return n
+
+    def wait_acked(self, timeout: Optional[float] = None):
+        """Until every sent line was answered (all in the planner, not necessarily executed)"""
+        with self._buf:
+            if not self._buf.wait_for(lambda: not self._inflight, timeout):
+                raise motion.MotionError("Controller did not acknowledge the queued G-code")
+
+    # --- MotionController commands ---
+    def move_to(self, x: float, y: float, feed: Optional[float] = None) -> Tuple[float, float]:
+        if self.state == "alarm":
+            raise motion.MotionError(f"Alarm: {self.alarm}")
+        tx, ty = motion.clip(x, y)
+        with self._cond:
+            self.target = (tx, ty)
+        if feed:
+            line = f"G90 G1 X{tx:.3f} Y{ty:.3f} F{feed * 60.0:.0f}"
+        else:
+            line = f"G90 G0 X{tx:.3f} Y{ty:.3f}"
+        # "moving" and the in-flight line go together: an Idle report in between would end the wait early
+        self.send_line(line, on_queued=lambda: self._report(state="moving"))
+        return tx, ty
+
+    def hold(self):
+        self.realtime(b"!")
+
+    def resume(self):
+        self.realtime(b"~")
+
+    def stop(self):
+        """Feed hold, then soft reset once stopped: flushes the planner, keeps the position"""
+        self.hold()
+        deadline = time.monotonic() + 2.0
+        while not self.controller_state.startswith(("Hold:0", "Idle", "Alarm")) and time.monotonic() < deadline:
+            time.sleep(1.0 / motion.STATUS_HZ)
+        self.realtime(b"\x18")
+        self._flush()
+        self._report(state="idle")
+
+    def unlock(self):
+        self._flush()
+        self.send_line("$X")
+        with self._cond:
+            self.alarm = None
+        self._report(state="idle")
+
+    def close(self):
+        self._closed = True
+        with self._buf:
+            self._buf.notify_all()
+        self.t.close()
+
+    # --- Receiving ---
+    def _flush(self):
+        # After a reset / alarm the controller drops its buffers without answering
+        with self._buf:
+            self._inflight.clear()
+            self._buf.notify_all()
+
+    def _reader(self):
+        buf = b""
+        while not self._closed:
+            try:
+                data = self.t.read()
+            except OSError:
+                break
+            if not data:
+                break
+            buf += data
+            while b"\n" in buf:
+                line, buf = buf.split(b"\n", 1)
+                line = line.strip().decode(errors="replace")
+                if line:
+                    self._handle(line)
+        if not self._closed:
+            self._report(state="alarm", alarm="Controller connection lost")
+
+    def _handle(self, line: str):
+        if line == "ok" or line.startswith("error"):
+            with self._buf:
+                sent = self._inflight.popleft()[1] if self._inflight else ""
+                self._buf.notify_all()
+            if line.startswith("error"):
+                self.last_error = f"{line} ({sent})"
+                self.errors.append(self.last_error)
+                print(f"G-code {self.last_error}")
+            return
+        if line.startswith("<"):
+            parsed = parse_status(line)
+            if parsed is None:
+                return
+            state, pos = parsed
+            self.controller_state = state
+            x, y = pos if pos else (None, None)
+            word = state.split(":")[0]
+            if word == "Alarm":
+                self._report(x, y, state="alarm", alarm=self.alarm or "Alarm")
+            elif word in ("Hold", "Door"):
+                self._report(x, y, state="hold")
+            elif word == "Idle":
+                # A report that left before our last move was planned still says Idle:
+                # only trust it once every sent line has been acknowledged
+                with self._buf:
+                    busy = bool(self._inflight)
+                    self._report(x, y, state=None if busy else "idle")
+            else: # Run / Jog / Home
+                self._report(x, y, state="moving")
+            return
+        if line.startswith("ALARM"):
+            self._flush()
+            self._report(state="alarm", alarm=line)
+            return
+        if line.startswith("Grbl") or line.startswith("[MSG"):
+            print(f"Controller: {line}")
+
+    def _poller(self):
+        while not self._closed:
+            try:
+                self.realtime(b"?")
+            except OSError:
+                return
+            time.sleep(1.0 / motion.STATUS_HZ)
+
+
+def connect(port: str) -> motion.MotionController:
+    """Controller for AOI_MOTION_PORT (see module docstring)"""
+    if not port:
+        return motion.SimulatedController()
+    if port == "sim":
+        from app.api.fluidnc_sim import SimulatedFluidNC
+        sim = SimulatedFluidNC().start()
+        print(f"Simulated FluidNC on {sim.port}")
+        streamer = GrblStreamer(FdTransport(sim.port))
+        streamer.sim = sim
+        return streamer
+    if port.startswith("tcp://"):
+        host, _, p = port[len("tcp://"):].partition(":")
+        return GrblStreamer(SocketTransport(host, int(p or 23)))
+    return GrblStreamer(SerialTransport(port))
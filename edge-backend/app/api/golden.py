@@ -0,0 +1,230 @@
+"""
+Golden-board reference store.
+
+Capturing a golden board saves one lossless reference image per program point
+(and per ref/fiducial) under GOLDEN_DIR/<program>/. When a program is loaded the
+references are turned into ready-to-use templates (grayscale, image pyramid,
+valid-pixel mask) and kept in an LRU cache keyed by (program name, mtime), so
+per-point comparisons during a run never touch the disk or recompute anything.
+"""
+from fastapi import APIRouter, BackgroundTasks, HTTPException
+from collections import OrderedDict
+from typing import Dict, List, Optional
+import asyncio
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from app.api import camera, motion, storage
+from app.api import program as program_api
+
+router = APIRouter()
+
+GOLDEN_DIR = "app/data/golden"
+PYRAMID_LEVELS = 4 # Level k is 1/2^k size
+SATURATION_LEVEL = 250 # Specular highlights are masked out of comparisons
+MASK_BORDER_PX = 8 # Vignetting / lens edge
+CACHE_PROGRAMS = 4 # Golden sets kept in memory
+
+
+def program_dir(name: str) -> str:
+    return os.path.join(GOLDEN_DIR, name)
+
+def point_key(point_id: int, kind: str = "inspect") -> str:
+    return f"ref_{point_id}" if kind == "ref" else str(point_id)
+
+def image_path(name: str, key: str) -> str:
+    return os.path.join(program_dir(name), f"{key}.png")
+
+def manifest_path(name: str) -> str:
+    return os.path.join(program_dir(name), "golden.json")
+
+
+def build_pyramid(gray: np.ndarray, levels: int = PYRAMID_LEVELS) -> List[np.ndarray]:
+    pyr = [gray]
+    for _ in range(1, levels):
+        pyr.append(cv2.pyrDown(pyr[-1]))
+    return pyr
+
+
+class GoldenTemplate:
+    """Precomputed reference of one point"""
+    __slots__ = ("key", "x", "y", "pyramid", "masks")
+
+    def __init__(self, key: str, x: float, y: float, bgr: np.ndarray):
+        self.key = key
+        self.x = x
+        self.y = y
+        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY) if bgr.ndim == 3 else bgr
+        self.pyramid = build_pyramid(gray)
+
+        mask = np.where(gray >= SATURATION_LEVEL, 0, 255).astype(np.uint8)
+        b = MASK_BORDER_PX
+        mask[:b, :] = 0
+        mask[-b:, :] = 0
+        mask[:, :b] = 0
+        mask[:, -b:] = 0
+        # Nearest-style downsampling keeps the mask binary
+        self.masks = [mask]
+        for lvl in self.pyramid[1:]:
+            self.masks.append(cv2.resize(self.masks[-1], (lvl.shape[1], lvl.shape[0]), interpolation=cv2.INTER_NEAREST))
+
+    @property
+    def gray(self) -> np.ndarray:
+        return self.pyramid[0]
+
+    def level(self, downscale: int) -> int:
+        """Pyramid level matching a power-of-two downscale factor"""
+        return min(len(self.pyramid) - 1, max(0, int(round(np.log2(max(1, downscale))))))
+
+
+class GoldenSet:
+    """All templates of one program, in memory"""
+    def __init__(self, name: str, mtime: float, templates: Dict[str, GoldenTemplate]):
+        self.name = name
+        self.mtime = mtime
+        self.templates = templates
+
+    def get(self, point_id: int, kind: str = "inspect") -> Optional[GoldenTemplate]:
+        return self.templates.get(point_key(point_id, kind))
+
+
+class GoldenStore:
+    """LRU cache of GoldenSets keyed by (program name, manifest mtime)"""
+    def __init__(self, max_programs: int = CACHE_PROGRAMS):
+        self.max_programs = max_programs
+        self._cache: "OrderedDict[tuple, GoldenSet]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, name: str) -> Optional[GoldenSet]:
+        """
+        Return the golden set of a program, building it on a cache miss.
+        Only this call touches the disk (one stat on a hit); keep the returned set
+        for the duration of a run.
+        """
+        path = manifest_path(name)
+        if not os.path.exists(path):
+            return None
+        key = (name, os.path.getmtime(path))
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        golden = self._build(name, key[1])
+        with self._lock:
+            # Drop stale versions of the same program first
+            for k in [k for k in self._cache if k[0] == name]:
+                del self._cache[k]
+            self._cache[key] = golden
+            while len(self._cache) > self.max_programs:
+                self._cache.popitem(last=False)
+        return golden
+
+    def _build(self, name: str, mtime: float) -> GoldenSet:
+        t0 = time.perf_counter()
+        with open(manifest_path(name), "r") as f:
+            manifest = json.load(f)
+        templates = {}
+        for entry in manifest.get("points", []):
+            img = cv2.imread(image_path(name, entry["key"]), cv2.IMREAD_COLOR)
+            if img is None:
+                continue
+            templates[entry["key"]] = GoldenTemplate(entry["key"], entry["x"], entry["y"], img)
+        print(f"Golden set '{name}': {len(templates)} templates in {(time.perf_counter() - t0) * 1000:.0f} ms")
+        return GoldenSet(name, mtime, templates)
+
+    def invalidate(self, name: str):
+        with self._lock:
+            for k in [k for k in self._cache if k[0] == name]:
+                del self._cache[k]
+
+    def info(self):
+        with self._lock:
+            return [{"program": k[0], "mtime": k[1], "templates": len(v.templates)} for k, v in self._cache.items()]
+
+store = GoldenStore()
+
+
+# --- Capture ---
+capture_state = {
+    "is_running": False,
+    "program": None,
+    "done": 0,
+    "total": 0,
+    "last_error": None,
+}
+CAPTURE_JOB = "golden capture" # Held on the machine (motion.claim) while capturing
+
+def capture_golden(prog: program_api.Program):
+    """Visit every ref and inspect point of a known-good board and save lossless references"""
+    capture_state.update(is_running=True, program=prog.name, done=0, last_error=None,
+                         total=len(prog.refs) + len(prog.points))
+    try:
+        os.makedirs(program_dir(prog.name), exist_ok=True)
+        entries = []
+        targets = [(p, "ref") for p in prog.refs] + [(p, "inspect") for p in prog.points]
+        for pt, kind in targets:
+            motion.move_and_wait(pt.x, pt.y)
+            frame = camera.get_latest_frame(after=time.monotonic())
+            key = point_key(pt.id, kind)
+            # PNG: lossless, written in the background while the gantry moves on
+            storage.writer.submit(program_dir(prog.name), key, frame, profile="golden", review_width=0)
+            entries.append({"key": key, "id": pt.id, "kind": kind, "x": pt.x, "y": pt.y})
+            capture_state["done"] += 1
+
+        storage.writer.drain()
+        # Manifest last: its mtime versions the whole set
+        with open(manifest_path(prog.name), "w") as f:
+            json.dump({"program": prog.name, "captured_at": time.time(), "points": entries}, f)
+        store.invalidate(prog.name)
+        store.load(prog.name)
+    except Exception as e:
+        print(f"Golden capture error: {e}")
+        capture_state["last_error"] = str(e)
+    finally:
+        capture_state["is_running"] = False
+        motion.release(CAPTURE_JOB)
+
+
+@router.post("/{name}/capture")
+async def start_capture(name: str, background_tasks: BackgroundTasks):
+    """Capture the golden references of a saved program (board under the camera must be known-good)"""
+    if capture_state["is_running"]:
+        raise HTTPException(status_code=409, detail="Golden capture already running")
+    prog = program_api._load_from_disk(name)
+    if not prog:
+        raise HTTPException(status_code=404, detail="Program not found")
+    # Not while a run or fly-scan is driving the gantry (and neither of them starts meanwhile)
+    busy = motion.claim(CAPTURE_JOB)
+    if busy:
+        raise HTTPException(status_code=409, detail=f"Machine busy: {busy} in progress")
+    background_tasks.add_task(capture_golden, prog)
+    return {"status": "started", "points": len(prog.refs) + len(prog.points)}
+
+@router.get("/capture/status")
+async def get_capture_status():
+    return capture_state
+
+@router.get("/cache")
+async def cache_info():
+    return store.info()
+
+@router.get("/{name}")
+async def golden_info(name: str):
+    path = manifest_path(name)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="No golden references for this program")
+    with open(path, "r") as f:
+        return json.load(f)
+
+@router.post("/{name}/preload")
+async def preload(name: str):
+    golden = await asyncio.to_thread(store.load, name)
+    if golden is None:
+        raise HTTPException(status_code=404, detail="No golden references for this program")
+    return {"program": name, "templates": len(golden.templates)}
@@ -0,0 +1,199 @@
+"""
+SQLite index of inspection runs.
+
+One row per run (metadata + result counts) so the Review dashboard can list,
+filter, sort and page through thousands of runs without opening any
+report.json. Rows are written when a run completes and when a result is
+overridden; the run directories stay the source of truth and the index can be
+rebuilt from them at any time:
+
+    python -m app.api.history_index rebuild [--workers N]
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sqlite3
+import threading
+import time
+
+from app.api import journal
+
+DB_PATH = os.getenv("AOI_HISTORY_DB", "/app/data/history.db")
+
+SORT_COLUMNS = ("completed_at", "start_time", "part_no", "batch_no", "status", "total", "ng", "ng_rate")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    part_no TEXT,
+    batch_no TEXT,
+    program_name TEXT,
+    start_time REAL,
+    completed_at REAL,
+    status TEXT,
+    total INTEGER,
+    ok INTEGER,
+    ng INTEGER,
+    overridden INTEGER,
+    ng_rate REAL,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_completed ON runs(completed_at);
+CREATE INDEX IF NOT EXISTS runs_part ON runs(part_no, completed_at);
+CREATE INDEX IF NOT EXISTS runs_batch ON runs(batch_no, completed_at);
+CREATE INDEX IF NOT EXISTS runs_status ON runs(status, completed_at);
+"""
+
+_COLUMNS = ("run_id", "part_no", "batch_no", "program_name", "start_time", "completed_at",
+            "status", "total", "ok", "ng", "overridden", "ng_rate", "metadata")
+
+_lock = threading.Lock()
+_conn: Optional[sqlite3.Connection] = None
+
+
+def _connect(path: str = DB_PATH) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # WAL: readers (dashboard) never block the writer (run completion)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def db() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        _conn = _connect()
+    return _conn
+
+
+def row_from_report(run_id: str, data: Dict) -> tuple:
+    meta = data.get("metadata", {}) or {}
+    summary = data.get("summary")
+    results = data.get("results", [])
+    if summary:
+        total, ok, ng, overridden = summary["total"], summary["ok"], summary["ng"], summary["overridden"]
+    else:
+        total = len(results)
+        ok = sum(1 for r in results if r["result"] == "OK")
+        ng = sum(1 for r in results if r["result"] == "NG")
+        overridden = sum(1 for r in results if r.get("manual_override"))
+    return (
+        run_id, meta.get("part_no", ""), meta.get("batch_no", ""), meta.get("program_name", ""),
+        meta.get("start_time"), data.get("completed_at"), data.get("status"),
+        total, ok, ng, overridden, ng / total if total else 0.0, json.dumps(meta),
+    )
+
+def _scan_run(args) -> Optional[tuple]:
+    # Runs in a worker process during rebuild
+    history_dir, run_id = args
+    try:
+        data = journal.load_report(os.path.join(history_dir, run_id))
+    except Exception as e:
+        print(f"Index: skipping {run_id}: {e}")
+        return None
+    return row_from_report(run_id, data) if data is not None else None
+
+
+def upsert(run_id: str, data: Dict):
+    row = row_from_report(run_id, data)
+    with _lock:
+        conn = db()
+        conn.execute(f"INSERT OR REPLACE INTO runs ({','.join(_COLUMNS)}) VALUES ({','.join('?' * len(_COLUMNS))})", row)
+        conn.commit()
+
+def refresh(history_dir: str, run_id: str):
+    """Re-read one run (after an override) and update its row"""
+    row = _scan_run((history_dir, run_id))
+    if row is None:
+        remove(run_id)
+        return
+    with _lock:
+        conn = db()
+        conn.execute(f"INSERT OR REPLACE INTO runs ({','.join(_COLUMNS)}) VALUES ({','.join('?' * len(_COLUMNS))})", row)
+        conn.commit()
+
+def remove(run_id: str):
+    with _lock:
+        conn = db()
+        conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+        conn.commit()
+
+def count() -> int:
+    with _lock:
+        return db().execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+
+def query(
+    limit: int = 100,
+    offset: int = 0,
+    run_id: Optional[str] = None,
+    part_no: Optional[str] = None,
+    batch_no: Optional[str] = None,
+    status: Optional[str] = None,
+    date_from: Optional[float] = None,
+    date_to: Optional[float] = None,
+    sort: str = "completed_at",
+    descending: bool = True,
+) -> Dict:
+    """One page of runs plus the total number of matches"""
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f"Cannot sort by {sort}")
+    where, args = [], []
+    for col, val in (("run_id", run_id), ("part_no", part_no), ("batch_no", batch_no), ("status", status)):
+        if val:
+            where.append(f"{col} = ?")
+            args.append(val)
+    if date_from is not None:
+        where.append("completed_at >= ?")
+        args.append(date_from)
+    if date_to is not None:
+        where.append("completed_at < ?")
+        args.append(date_to)
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+    direction = "DESC" if descending else "ASC"
+
+    with _lock:
+        conn = db()
+        total = conn.execute(f"SELECT COUNT(*) FROM runs {clause}", args).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT * FROM runs {clause} ORDER BY {sort} {direction}, run_id {direction} LIMIT ? OFFSET ?",
+            args + [limit, offset],
+        ).fetchall()
+    return {"total": total, "items": [dict(r) for r in rows]}
+
+
+def rebuild(history_dir: str, workers: Optional[int] = None, exclude: Optional[List[str]] = None) -> Dict:
+    """
+    Rescan every run directory (reports parsed in parallel) and replace the index.
+    Runs in exclude (the active run: loading it would compact its live journal) are left out.
+    """
+    t0 = time.perf_counter()
+    skip = set(exclude or ())
+    run_ids = sorted(d for d in os.listdir(history_dir) if os.path.isdir(os.path.join(history_dir, d)) and d not in skip) \
+        if os.path.isdir(history_dir) else []
+    # spawn, not fork: called from the threaded server, a forked child could inherit held locks
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn")) as pool:
+        rows = [r for r in pool.map(_scan_run, [(history_dir, r) for r in run_ids], chunksize=16) if r]
+
+    with _lock:
+        conn = db()
+        with conn:
+            conn.execute("DELETE FROM runs")
+            conn.executemany(f"INSERT INTO runs ({','.join(_COLUMNS)}) VALUES ({','.join('?' * len(_COLUMNS))})", rows)
+    report = {"runs": len(rows), "skipped": len(run_ids) - len(rows), "seconds": round(time.perf_counter() - t0, 2)}
+    print(f"History index rebuilt: {report}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AOI history index")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--history-dir", default="/app/data/history")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    rebuild(args.history_dir, args.workers)
@@ -1,54 +1,418 @@
 from fastapi import APIRouter
 from pydantic import BaseModel
 from typing import List, Optional
+import ast
+import os
 import random
+import threading
 import time
+import cv2
+import numpy as np
+from app.api import camera
 
 router = APIRouter()
 
+# --- Configuration (env) ---
+# No model file -> simulation mode (random NG), same as before a model is deployed
+MODEL_PATH = os.getenv("AOI_MODEL_PATH", "app/data/models/model.onnx")
+MODEL_LABELS = os.getenv("AOI_MODEL_LABELS", "") # "missing,shift,bridge" overrides model metadata
+INFER_THREADS = int(os.getenv("AOI_INFER_THREADS", "4")) # Pi 5 has 4 cores
+CONF_THRESHOLD = float(os.getenv("AOI_CONF_THRESHOLD", "0.25"))
+IOU_THRESHOLD = float(os.getenv("AOI_IOU_THRESHOLD", "0.45"))
+WARMUP_RUNS = int(os.getenv("AOI_WARMUP_RUNS", "3"))
+INPUT_SIZE = int(os.getenv("AOI_MODEL_INPUT_SIZE", "640")) # Used when the model doesn't declare it
+LETTERBOX_COLOR = 114
+
 class Detection(BaseModel):
     label: str
     confidence: float
-    box: List[int] # [x, y, w, h] relative to image ?? or absolute? Let's say pixel
+    box: List[int] # [x, y, w, h] in pixels of the source image
 
 class InferenceResult(BaseModel):
     result: str # "OK" or "NG"
     detections: List[Detection]
     image_url: Optional[str] = None
+    latency_ms: Optional[float] = None
 
 
-# Internal function
-def predict_on_image(image):
+# --- Pre / Post processing ---
+def letterbox_batch(images: List[np.ndarray], size: int):
     """
-    Simulate running model on an image (numpy array).
+    Resize keeping aspect ratio and pad to size x size, for a whole batch.
+    Returns (NCHW float32 blob, scales, pads) where pads are (left, top) per image.
     """
-    # In real app: results = session.run(...)
-    time.sleep(0.5) # Simulate inference time
-    
-    is_ng = random.random() < 0.3 # 30% chance of NG
-    
-    if is_ng:
-        return {
-            "result": "NG",
-            "detections": [
-                {
-                    "label": "missing_component",
-                    "confidence": 0.95,
-                    "box": [100, 100, 50, 50]
-                }
+    n = len(images)
+    batch = np.full((n, size, size, 3), LETTERBOX_COLOR, np.uint8)
+    scales = np.empty(n, np.float32)
+    pads = np.empty((n, 2), np.float32)
+    for i, img in enumerate(images):
+        h, w = img.shape[:2]
+        r = min(size / h, size / w)
+        nw, nh = int(round(w * r)), int(round(h * r))
+        left, top = (size - nw) // 2, (size - nh) // 2
+        if (nw, nh) != (w, h):
+            img = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_LINEAR)
+        if img.ndim == 2:
+            img = img[:, :, None]
+        batch[i, top:top + nh, left:left + nw] = img
+        scales[i] = r
+        pads[i] = (left, top)
+    # BGR -> RGB, HWC -> CHW, 0..1 in one vectorised pass over the batch
+    blob = np.ascontiguousarray(batch[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32)
+    blob *= 1.0 / 255.0
+    return blob, scales, pads
+
+def nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """Greedy NMS on xyxy boxes. Returns kept indices, best score first."""
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1).clip(0) * (y2 - y1).clip(0)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = (np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest])).clip(0)
+        h = (np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest])).clip(0)
+        inter = w * h
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+def postprocess_yolo(output: np.ndarray, scale: float, pad, shape, labels: List[str]) -> List[dict]:
+    """
+    Decode one image of a YOLOv8-style head: [4 + num_classes, anchors]
+    (cx, cy, w, h, class scores...). Boxes are mapped back to source pixels.
+    """
+    preds = output.T if output.shape[0] < output.shape[1] else output
+    scores_all = preds[:, 4:]
+    cls = scores_all.argmax(axis=1)
+    conf = scores_all[np.arange(len(preds)), cls]
+    mask = conf >= CONF_THRESHOLD
+    if not mask.any():
+        return []
+    preds, cls, conf = preds[mask], cls[mask], conf[mask]
+
+    xy, wh = preds[:, 0:2], preds[:, 2:4]
+    boxes = np.concatenate([xy - wh / 2, xy + wh / 2], axis=1)
+    # Class-aware NMS in one call: shift each class into its own coordinate range
+    offsets = (cls * 4096.0)[:, None]
+    keep = nms(boxes + offsets, conf, IOU_THRESHOLD)
+
+    boxes = (boxes[keep] - np.tile(pad, 2)) / scale
+    h, w = shape[:2]
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, w)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, h)
+
+    detections = []
+    for (x1, y1, x2, y2), c, s in zip(boxes, cls[keep], conf[keep]):
+        detections.append({
+            "label": labels[c] if c < len(labels) else str(int(c)),
+            "confidence": round(float(s), 4),
+            "box": [int(x1), int(y1), int(x2 - x1), int(y2 - y1)]
+        })
+    return detections
+
+
+# --- Engine ---
+class InferenceEngine:
+    """
+    Loads the model once and keeps the session around.
+    Backends: ONNX Runtime (preferred), OpenCV DNN (fallback), simulation (no model).
+    """
+    def __init__(self, model_path: str = MODEL_PATH, labels: str = MODEL_LABELS, input_size: int = INPUT_SIZE):
+        self.model_path = model_path
+        self.label_override = labels
+        self.backend = "simulation"
+        self.session = None
+        self.net = None
+        self.input_name = None
+        self.input_size = input_size
+        self.fixed_batch = True
+        self.labels: List[str] = []
+        self.lock = threading.Lock() # cv2.dnn nets are not re-entrant
+        self.calls = 0
+        self.images = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+
+    def load(self, path: Optional[str] = None):
+        path = path or self.model_path
+        if not os.path.exists(path):
+            print(f"No model at {path}, inference runs in simulation mode")
+            self.backend = "simulation"
+            return
+        try:
+            self._open(path)
+        except Exception as e:
+            # Corrupt or incompatible model: keep serving in simulation mode
+            print(f"Failed to load model {path}: {e}")
+            self.session = None
+            self.net = None
+            self.backend = "simulation"
+            return
+
+        if self.label_override:
+            self.labels = [l.strip() for l in self.label_override.split(",")]
+        print(f"Inference backend: {self.backend} ({path}, {self.input_size}px, {INFER_THREADS} threads)")
+        self.warmup()
+
+    def _open(self, path: str):
+        """ONNX Runtime if installed, otherwise OpenCV DNN"""
+        try:
+            import onnxruntime as ort
+            opts = ort.SessionOptions()
+            opts.intra_op_num_threads = INFER_THREADS
+            opts.inter_op_num_threads = 1
+            opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.session = ort.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"])
+            inp = self.session.get_inputs()[0]
+            self.input_name = inp.name
+            if isinstance(inp.shape[-1], int):
+                self.input_size = inp.shape[-1]
+            self.fixed_batch = isinstance(inp.shape[0], int)
+            names = self.session.get_modelmeta().custom_metadata_map.get("names")
+            if names:
+                # Ultralytics exports "{0: 'missing', 1: 'shift'}"
+                parsed = ast.literal_eval(names)
+                self.labels = [parsed[k] for k in sorted(parsed)]
+            self.backend = "onnxruntime"
+        except ImportError:
+            cv2.setNumThreads(INFER_THREADS)
+            self.net = cv2.dnn.readNetFromONNX(path)
+            self.fixed_batch = True
+            self.backend = "opencv-dnn"
+
+    def warmup(self, runs: int = WARMUP_RUNS):
+        """First runs pay for lazy allocations / kernel selection; do that before the first board"""
+        if self.backend == "simulation":
+            return
+        dummy = np.full((self.input_size, self.input_size, 3), LETTERBOX_COLOR, np.uint8)
+        t0 = time.perf_counter()
+        for _ in range(runs):
+            self._run([dummy])
+        print(f"Inference warmup: {runs} runs in {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+    def _forward(self, blob: np.ndarray) -> np.ndarray:
+        if self.session is not None:
+            return self.session.run(None, {self.input_name: blob})[0]
+        with self.lock:
+            self.net.setInput(blob)
+            return self.net.forward()
+
+    def _run(self, images: List[np.ndarray]) -> List[List[dict]]:
+        blob, scales, pads = letterbox_batch(images, self.input_size)
+        if self.fixed_batch and len(images) > 1:
+            # Model exported with a static batch of 1
+            out = np.concatenate([self._forward(blob[i:i + 1]) for i in range(len(images))])
+        else:
+            out = self._forward(blob)
+        return [
+            postprocess_yolo(out[i], float(scales[i]), pads[i], images[i].shape, self.labels)
+            for i in range(len(images))
+        ]
+
+    def _record_latency(self, t0: float, n: int) -> float:
+        ms = (time.perf_counter() - t0) * 1000.0
+        self.calls += 1
+        self.images += n
+        self.total_ms += ms
+        self.last_ms = ms
+        return ms
+
+    def predict_batch(self, images: List[np.ndarray]) -> List[dict]:
+        t0 = time.perf_counter()
+        if self.backend == "simulation":
+            results = [self._simulate() for _ in images]
+        else:
+            results = [
+                {"result": "NG" if dets else "OK", "detections": dets}
+                for dets in self._run(images)
             ]
-        }
-    else:
+        ms = self._record_latency(t0, len(images))
+        for r in results:
+            r["latency_ms"] = round(ms, 1)
+        return results
+
+    def _simulate(self):
+        time.sleep(0.5) # Simulate inference time
+        is_ng = random.random() < 0.3 # 30% chance of NG
+        if is_ng:
+            return {
+                "result": "NG",
+                "detections": [
+                    {
+                        "label": "missing_component",
+                        "confidence": 0.95,
+                        "box": [100, 100, 50, 50]
+                    }
+                ]
+            }
+        return {"result": "OK", "detections": []}
+
+    def stats(self):
         return {
-            "result": "OK",
-            "detections": []
+            "backend": self.backend,
+            "input_size": self.input_size,
+            "threads": INFER_THREADS,
+            "labels": self.labels,
+            "calls": self.calls,
+            "images": self.images,
+            "last_ms": round(self.last_ms, 1),
+            "avg_ms_per_call": round(self.total_ms / self.calls, 1) if self.calls else None,
         }
 
+class ClassifierEngine(InferenceEngine):
+    """
+    Small image classifier for per-component ROI crops (N, 3, S, S) -> (N, classes).
+    Same loading / warmup / backends as the detector.
+    """
+    def _run(self, crops: List[np.ndarray]):
+        s = self.input_size
+        batch = np.empty((len(crops), s, s, 3), np.uint8)
+        for i, crop in enumerate(crops):
+            # Resize straight into the batch buffer (the crop itself is a view of the frame)
+            cv2.resize(crop, (s, s), dst=batch[i], interpolation=cv2.INTER_AREA)
+        blob = np.ascontiguousarray(batch[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32)
+        blob *= 1.0 / 255.0
+        if self.fixed_batch and len(crops) > 1:
+            out = np.concatenate([self._forward(blob[i:i + 1]) for i in range(len(crops))])
+        else:
+            out = self._forward(blob)
+        out = out.reshape(len(crops), -1)
+        if out.min() < 0 or out.max() > 1:
+            # Raw logits -> softmax
+            e = np.exp(out - out.max(axis=1, keepdims=True))
+            out = e / e.sum(axis=1, keepdims=True)
+        cls = out.argmax(axis=1)
+        conf = out[np.arange(len(crops)), cls]
+        return [
+            (self.labels[c] if c < len(self.labels) else str(int(c)), float(p))
+            for c, p in zip(cls, conf)
+        ]
+
+    def classify_batch(self, crops: List[np.ndarray], expected: Optional[List[str]] = None):
+        """
+        Returns [(label, confidence)] per crop.
+        expected is only used by simulation mode, which mostly "sees" the expected part.
+        """
+        if not crops:
+            return []
+        t0 = time.perf_counter()
+        if self.backend == "simulation":
+            time.sleep(0.002 * len(crops)) # Small model, cheap per crop
+            results = []
+            for i in range(len(crops)):
+                if random.random() < 0.05:
+                    results.append(("missing", 0.9))
+                else:
+                    results.append((expected[i] if expected else "ok", 0.97))
+        else:
+            results = self._run(crops)
+        self._record_latency(t0, len(crops))
+        return results
+
+engine = InferenceEngine()
+classifier = ClassifierEngine(
+    model_path=os.getenv("AOI_CLASSIFIER_PATH", "app/data/models/classifier.onnx"),
+    labels=os.getenv("AOI_CLASSIFIER_LABELS", ""),
+    input_size=int(os.getenv("AOI_CLASSIFIER_INPUT_SIZE", "64")),
+)
+# A crop counts as OK only if the classifier agrees with the expected part this sure
+ROI_MIN_CONFIDENCE = float(os.getenv("AOI_ROI_MIN_CONFIDENCE", "0.5"))
+
+
+# Internal function
+def predict_on_image(image):
+    """
+    Run the model on one image (BGR numpy array).
+    Returns {"result": "OK"|"NG", "detections": [...], "latency_ms": float}
+    """
+    return engine.predict_batch([image])[0]
+
+def predict_batch(images: List[np.ndarray]) -> List[dict]:
+    """Run the model on several frames in one call, one result per frame"""
+    return engine.predict_batch(images)
+
+def crop_roi(frame: np.ndarray, roi) -> np.ndarray:
+    """ROI view into the frame (no copy), clipped to the image"""
+    h, w = frame.shape[:2]
+    x0, y0 = max(0, roi.x), max(0, roi.y)
+    x1, y1 = min(w, roi.x + roi.w), min(h, roi.y + roi.h)
+    return frame[y0:y1, x0:x1]
+
+def inspect_frames(frames: List[np.ndarray], points: List) -> List[dict]:
+    """
+    Inspect several captured frames at once.
+    Points that carry ROIs are judged by classifying every ROI crop (all crops of
+    all frames in one classifier call); the rest go through the full-frame detector
+    (one batched call). A point is NG if any of its ROIs is not the expected part.
+    """
+    results: List[Optional[dict]] = [None] * len(frames)
+
+    crops, expected, owners = [], [], []
+    outside = [] # (frame index, roi) that can't be judged
+    full_idx = []
+    for i, (frame, pt) in enumerate(zip(frames, points)):
+        rois = getattr(pt, "rois", None) or []
+        if not rois:
+            full_idx.append(i)
+            continue
+        for roi in rois:
+            crop = crop_roi(frame, roi)
+            if crop.size == 0:
+                outside.append((i, roi))
+                continue
+            crops.append(crop)
+            expected.append(roi.part_class)
+            owners.append((i, roi))
+
+    if full_idx:
+        for i, r in zip(full_idx, predict_batch([frames[i] for i in full_idx])):
+            results[i] = r
+
+    if crops or len(full_idx) < len(frames):
+        t0 = time.perf_counter()
+        labels = classifier.classify_batch(crops, expected)
+        ms = round((time.perf_counter() - t0) * 1000.0, 1)
+        for i in range(len(frames)):
+            if results[i] is None:
+                results[i] = {"result": "OK", "detections": [], "rois": [], "latency_ms": ms}
+        # Bad teach, large alignment shift or a calibration change: never a silent pass
+        for i, roi in outside:
+            results[i]["rois"].append({"name": roi.name, "expected": roi.part_class, "result": "ERROR",
+                                       "reason": "roi outside frame"})
+            results[i]["result"] = "ERROR"
+            results[i]["reason"] = "roi outside frame"
+        for (i, roi), (label, conf) in zip(owners, labels):
+            ok = label == roi.part_class and conf >= ROI_MIN_CONFIDENCE
+            results[i]["rois"].append({
+                "name": roi.name,
+                "expected": roi.part_class,
+                "label": label,
+                "confidence": round(conf, 4),
+                "result": "OK" if ok else "NG",
+            })
+            if not ok:
+                results[i]["result"] = "NG"
+                results[i]["detections"].append({
+                    "label": label,
+                    "confidence": round(conf, 4),
+                    "box": [roi.x, roi.y, roi.w, roi.h],
+                    "roi": roi.name,
+                    "expected": roi.part_class,
+                })
+    return results
+
 @router.post("/detect", response_model=InferenceResult)
-async def run_inference():
+def run_inference():
     """
-    Simulate running YOLO model.
-    Randomly returns NG with defects.
+    Run the model on the current camera frame.
+    (Plain def: FastAPI runs it in the threadpool, inference must not block the event loop)
     """
-    # For now, just call the internal one with None
-    return predict_on_image(None)
+    frame = camera.get_latest_frame()
+    return predict_on_image(frame)
+
+@router.get("/stats")
+async def inference_stats():
+    return {"detector": engine.stats(), "classifier": classifier.stats()}
@@ -0,0 +1,209 @@
+"""
+Append-only run journal.
+
+Every run directory gets a journal.jsonl with one compact JSON record per line:
+  {"type": "start", "metadata": ..., "total_points": N}
+  {"type": "result", ...one inspected point...}
+  {"type": "override", "point_id": 3, "result": "OK"}   (manual review)
+  {"type": "end", "status": ..., "error": ..., ...}
+Records are appended as they happen (one write + fsync each), so a crash loses
+at most the line being written; a torn last line is ignored on replay.
+
+compact() streams the journal into report.json (the summary the UI reads) and
+stores the journal byte offset it covers. Overrides appended later are applied
+on read from that offset, so changing one point never rewrites the report.
+"""
+from typing import Dict, Iterator, Optional, Tuple
+import json
+import os
+import threading
+import time
+
+JOURNAL_NAME = "journal.jsonl"
+REPORT_NAME = "report.json"
+FSYNC = os.getenv("AOI_JOURNAL_FSYNC", "1") == "1" # Off: faster on slow SD cards, may lose the last points on power loss
+COMPACT_AFTER_OVERRIDES = 50 # Fold overrides into report.json once this many pile up
+
+_append_lock = threading.Lock()
+
+
+def journal_path(run_dir: str) -> str:
+    return os.path.join(run_dir, JOURNAL_NAME)
+
+def report_path(run_dir: str) -> str:
+    return os.path.join(run_dir, REPORT_NAME)
+
+def _encode(record: Dict) -> bytes:
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode()
+
+
+class RunJournal:
+    """Writer side, kept open for the duration of a run"""
+    def __init__(self, run_dir: str):
+        self.run_dir = run_dir
+        path = journal_path(run_dir)
+        torn = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                torn = f.read(1) != b"\n"
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if torn:
+            os.write(self._fd, b"\n") # Terminate a torn line so the next record stays readable
+
+    def append(self, record: Dict):
+        with _append_lock:
+            os.write(self._fd, _encode(record))
+            if FSYNC:
+                os.fsync(self._fd)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def append_record(run_dir: str, record: Dict):
+    """One-off append (overrides from the review UI)"""
+    j = RunJournal(run_dir)
+    try:
+        j.append(record)
+    finally:
+        j.close()
+
+
+def read_records(run_dir: str, offset: int = 0) -> Iterator[Tuple[int, Dict]]:
+    """Yield (end offset, record) from a byte offset on; stops at a torn last line"""
+    path = journal_path(run_dir)
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        f.seek(offset)
+        pos = offset
+        for line in f:
+            if not line.endswith(b"\n"):
+                break # Incomplete write (crash mid-append)
+            pos += len(line)
+            try:
+                yield pos, json.loads(line)
+            except ValueError:
+                continue
+
+
+def _overrides(run_dir: str, offset: int = 0) -> Dict[int, str]:
+    return {rec["point_id"]: rec["result"] for _, rec in read_records(run_dir, offset) if rec.get("type") == "override"}
+
+
+def compact(run_dir: str) -> Optional[Dict]:
+    """
+    Stream the journal into report.json (written via temp file + rename).
+    Results are written one by one, the run is never held in memory as a whole.
+    Returns the report without its results list, None if there is no journal.
+    """
+    if not os.path.exists(journal_path(run_dir)):
+        return None
+    overrides = _overrides(run_dir) # Small: point_id -> result
+    head: Dict = {"metadata": {}, "total_points": 0}
+    tail: Dict = {"status": "interrupted", "error": None, "completed_at": None}
+    summary = {"total": 0, "ok": 0, "ng": 0, "overridden": 0}
+    offset = 0
+
+    tmp = report_path(run_dir) + ".tmp"
+    with open(tmp, "w") as out:
+        out.write('{"results":[')
+        for offset, rec in read_records(run_dir):
+            kind = rec.pop("type", None)
+            if kind == "start":
+                head.update(rec)
+            elif kind == "end":
+                tail.update(rec)
+            elif kind == "result":
+                if rec["point_id"] in overrides:
+                    rec["result"] = overrides[rec["point_id"]]
+                    rec["manual_override"] = True # Flag as manually modified
+                    summary["overridden"] += 1
+                if summary["total"]:
+                    out.write(",")
+                out.write(json.dumps(rec, separators=(",", ":")))
+                summary["total"] += 1
+                if rec["result"] == "NG":
+                    summary["ng"] += 1
+                elif rec["result"] == "OK":
+                    summary["ok"] += 1
+        if tail["completed_at"] is None:
+            tail["completed_at"] = os.path.getmtime(journal_path(run_dir))
+        rest = {**head, **tail, "summary": summary, "journal_offset": offset}
+        out.write("]," + json.dumps(rest, separators=(",", ":"))[1:])
+    os.replace(tmp, report_path(run_dir))
+    return rest
+
+
+def load_report(run_dir: str) -> Optional[Dict]:
+    """
+    report.json with later overrides applied.
+    Runs without a report (crashed mid-run) are compacted from their journal first.
+    """
+    path = report_path(run_dir)
+    if not os.path.exists(path):
+        if compact(run_dir) is None:
+            return None
+    with open(path, "r") as f:
+        data = json.load(f)
+
+    if "journal_offset" in data:
+        overrides = _overrides(run_dir, data["journal_offset"])
+    else:
+        overrides = _overrides(run_dir) # Report from before journals existed
+    if not overrides:
+        return data
+    if len(overrides) >= COMPACT_AFTER_OVERRIDES and "journal_offset" in data:
+        compact(run_dir)
+        with open(path, "r") as f:
+            return json.load(f)
+
+    for r in data.get("results", []):
+        if r["point_id"] in overrides:
+            new = overrides[r["point_id"]]
+            if "summary" in data:
+                s = data["summary"]
+                for res, d in ((r["result"], -1), (new, 1)):
+                    if res in ("OK", "NG"):
+                        s[res.lower()] += d
+                if not r.get("manual_override"):
+                    s["overridden"] += 1
+            r["result"] = new
+            r["manual_override"] = True
+    return data
+
+
+def override(run_dir: str, point_id: int, new_result: str):
+    """O(1): one appended line, report.json is untouched"""
+    append_record(run_dir, {"type": "override", "point_id": point_id, "result": new_result, "t": time.time()})
+
+
+def iter_results(run_dir: str) -> Iterator[Dict]:
+    """
+    Results of a run one at a time, overrides applied.
+    Streams the journal line by line; runs from before journals existed fall
+    back to their report.json.
+    """
+    records = read_records(run_dir)
+    first = next(records, None)
+    if first is None or first[1].get("type") != "start":
+        records.close()
+        data = load_report(run_dir)
+        yield from (data or {}).get("results", [])
+        return
+    overrides = _overrides(run_dir)
+    for _, rec in records:
+        if rec.pop("type", None) != "result":
+            continue
+        if rec["point_id"] in overrides:
+            rec["result"] = overrides[rec["point_id"]]
+            rec["manual_override"] = True
+        yield rec
+
+
+def has_point(run_dir: str, point_id: int) -> bool:
+    """Whether the run recorded a result for point_id (also while the run is still being journaled)"""
+    return any(r.get("point_id") == point_id for r in iter_results(run_dir))
@@ -0,0 +1,314 @@
+"""
+Board mosaic stitching.
+
+Tiles are placed on a canvas from the machine position they were exposed at
+(mm -> px with the camera scale), then nudged by phase correlation against
+what is already on the canvas in the overlap, and feather-blended in. The
+canvas is a memory-mapped file, and every tile only touches its own
+rectangle, so boards larger than RAM stitch with bounded memory. Tiles can
+be added while the scan is still running (MosaicBuilder) or afterwards from
+a scan directory (tiles.json).
+
+The result is also cut into a Deep Zoom (DZI) pyramid: mosaic.dzi plus
+mosaic_files/<level>/<col>_<row>.jpg, served under /data/scans for
+OpenSeadragon-style pan/zoom in the Review UI. Each level is built from the
+one above it, one row of tiles at a time.
+"""
+from fastapi import APIRouter, HTTPException
+from typing import Dict, List, Optional, Tuple
+import json
+import math
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from app.api import camera
+from app.api.scan import SCANS_DIR
+
+router = APIRouter()
+
+DZI_TILE = 254 # + 1px overlap on each side = 256
+DZI_OVERLAP = 1
+DZI_QUALITY = 85
+MAX_CORRECTION_MM = 1.0 # Larger phase-correlation shifts are treated as mismatches
+MIN_OVERLAP_PX = 24
+MIN_RESPONSE = 0.08 # phaseCorrelate peak; below this the overlap has no usable texture
+MARGIN_PX = 32 # Canvas slack for the corrections
+
+
+class Mosaic:
+    """Memory-mapped canvas (uint8 BGR) + coverage map (0 = empty)"""
+    def __init__(self, directory: str, extent_mm: Tuple[float, float, float, float],
+                 mm_per_px: float, tile_shape: Tuple[int, int]):
+        # extent: min_x, min_y, max_x, max_y of the tile centres (machine mm)
+        self.dir = directory
+        self.mmpp = mm_per_px
+        self.min_x, self.min_y, self.max_x, self.max_y = extent_mm
+        th, tw = tile_shape
+        self.width = int(math.ceil((self.max_x - self.min_x) / mm_per_px)) + tw + 2 * MARGIN_PX
+        self.height = int(math.ceil((self.max_y - self.min_y) / mm_per_px)) + th + 2 * MARGIN_PX
+        os.makedirs(directory, exist_ok=True)
+        self.canvas = np.memmap(os.path.join(directory, "mosaic.raw"), dtype=np.uint8, mode="w+",
+                                shape=(self.height, self.width, 3))
+        self.coverage = np.memmap(os.path.join(directory, "mosaic_coverage.raw"), dtype=np.uint8, mode="w+",
+                                  shape=(self.height, self.width))
+        self.placed: List[Dict] = []
+        self._feather: Dict[Tuple[int, int], np.ndarray] = {}
+
+    def nominal(self, x_mm: float, y_mm: float, shape: Tuple[int, int]) -> Tuple[float, float]:
+        """Top-left canvas pixel of a tile centred at machine (x, y); image Y grows downwards"""
+        h, w = shape
+        sx, sy = camera.IMAGE_AXIS_SIGN
+        col = MARGIN_PX + (x_mm - self.min_x) / self.mmpp if sx > 0 else MARGIN_PX + (self.max_x - x_mm) / self.mmpp
+        row = MARGIN_PX + (self.max_y - y_mm) / self.mmpp if sy < 0 else MARGIN_PX + (y_mm - self.min_y) / self.mmpp
+        return col, row
+
+    def _weights(self, shape: Tuple[int, int]) -> np.ndarray:
+        # Feather: 1 in the middle, ramping to ~0 at the tile border
+        if shape not in self._feather:
+            h, w = shape
+            ramp = max(4, int(min(h, w) * 0.1))
+            wx = np.clip((np.minimum(np.arange(w), np.arange(w)[::-1]) + 1) / ramp, 0, 1)
+            wy = np.clip((np.minimum(np.arange(h), np.arange(h)[::-1]) + 1) / ramp, 0, 1)
+            self._feather[shape] = np.minimum.outer(wy, wx).astype(np.float32)
+        return self._feather[shape]
+
+    def _refine(self, tile: np.ndarray, c0: int, r0: int) -> Tuple[int, int, Optional[Dict]]:
+        """Shift (px) that aligns the tile with the covered part of the canvas under it"""
+        h, w = tile.shape[:2]
+        cov = self.coverage[r0:r0 + h, c0:c0 + w]
+        rows = np.flatnonzero(cov.any(axis=1))
+        cols = np.flatnonzero(cov.any(axis=0))
+        if len(rows) < MIN_OVERLAP_PX or len(cols) < MIN_OVERLAP_PX:
+            return 0, 0, None
+        y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        a = cv2.cvtColor(np.asarray(self.canvas[r0 + y0:r0 + y1, c0 + x0:c0 + x1]), cv2.COLOR_BGR2GRAY).astype(np.float32)
+        b = cv2.cvtColor(tile[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY).astype(np.float32)
+        # L-shaped overlaps (left + upper neighbour): blank out what the canvas doesn't have yet
+        mask = cov[y0:y1, x0:x1] > 0
+        a -= a[mask].mean()
+        b -= b[mask].mean()
+        a[~mask] = 0
+        b[~mask] = 0
+        win = cv2.createHanningWindow((a.shape[1], a.shape[0]), cv2.CV_32F)
+        (dx, dy), response = cv2.phaseCorrelate(a * win, b * win)
+        limit = MAX_CORRECTION_MM / self.mmpp
+        info = {"dx": round(dx, 2), "dy": round(dy, 2), "response": round(float(response), 3)}
+        if response < MIN_RESPONSE or abs(dx) > limit or abs(dy) > limit:
+            info["rejected"] = True
+            return 0, 0, info
+        # Content of b sits at +d relative to a: move the tile by -d
+        return -int(round(dx)), -int(round(dy)), info
+
+    def add(self, tile: np.ndarray, x_mm: float, y_mm: float, name: str = "") -> Dict:
+        h, w = tile.shape[:2]
+        col, row = self.nominal(x_mm, y_mm, (h, w))
+        c0 = int(round(min(max(col, 0), self.width - w)))
+        r0 = int(round(min(max(row, 0), self.height - h)))
+        dx, dy, info = self._refine(tile, c0, r0)
+        c0 = min(max(c0 + dx, 0), self.width - w)
+        r0 = min(max(r0 + dy, 0), self.height - h)
+
+        region = self.canvas[r0:r0 + h, c0:c0 + w]
+        cov = self.coverage[r0:r0 + h, c0:c0 + w]
+        wt = self._weights((h, w))
+        # Where the canvas is empty the tile is copied; in overlaps the feather decides
+        alpha = np.where(cov > 0, wt, 1.0)[..., None]
+        blended = region.astype(np.float32) * (1.0 - alpha) + tile.astype(np.float32) * alpha
+        region[...] = np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+        cov[...] = 255
+        placed = {"name": name, "x_mm": x_mm, "y_mm": y_mm, "col": c0, "row": r0, "correction": info}
+        self.placed.append(placed)
+        return placed
+
+    def flush(self):
+        self.canvas.flush()
+        self.coverage.flush()
+
+    # --- Deep Zoom pyramid ---
+    def build_pyramid(self, quality: int = DZI_QUALITY) -> Dict:
+        self.flush()
+        base = os.path.join(self.dir, "mosaic_files")
+        max_level = int(math.ceil(math.log2(max(self.width, self.height))))
+        size = (self.width, self.height)
+        sizes = {}
+        for level in range(max_level, -1, -1):
+            sizes[level] = size
+            size = (max(1, (size[0] + 1) // 2), max(1, (size[1] + 1) // 2))
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        tiles = 0
+        for level in range(max_level, -1, -1):
+            w, h = sizes[level]
+            os.makedirs(os.path.join(base, str(level)), exist_ok=True)
+            if level == max_level:
+                src = self.canvas
+            else:
+                src = _LevelReader(os.path.join(base, str(level + 1)), sizes[level + 1])
+            for r in range(int(math.ceil(h / DZI_TILE))):
+                # One band of tiles at a time: bounded memory at any board size
+                y0 = max(0, r * DZI_TILE - DZI_OVERLAP)
+                y1 = min(h, (r + 1) * DZI_TILE + DZI_OVERLAP)
+                if level == max_level:
+                    band = np.asarray(src[y0:y1])
+                else:
+                    band = cv2.resize(src.rows(2 * y0, 2 * y1), (w, y1 - y0), interpolation=cv2.INTER_AREA)
+                for c in range(int(math.ceil(w / DZI_TILE))):
+                    x0 = max(0, c * DZI_TILE - DZI_OVERLAP)
+                    x1 = min(w, (c + 1) * DZI_TILE + DZI_OVERLAP)
+                    ok, buf = cv2.imencode(".jpg", band[:, x0:x1], params)
+                    with open(os.path.join(base, str(level), f"{c}_{r}.jpg"), "wb") as f:
+                        f.write(buf.tobytes())
+                    tiles += 1
+        with open(os.path.join(self.dir, "mosaic.dzi"), "w") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="jpg" Overlap="{DZI_OVERLAP}" '
+                    f'TileSize="{DZI_TILE}"><Size Width="{self.width}" Height="{self.height}"/></Image>\n')
+        return {"levels": max_level + 1, "tiles": tiles, "width": self.width, "height": self.height}
+
+
+class _LevelReader:
+    """Rows of a pyramid level, reassembled from its (already written) tile files"""
+    def __init__(self, directory: str, size: Tuple[int, int]):
+        self.dir = directory
+        self.width, self.height = size
+        self._cache: Dict[int, np.ndarray] = {} # Tile row -> band, only the last two are kept
+
+    def _band(self, r: int) -> np.ndarray:
+        if r not in self._cache:
+            cols = int(math.ceil(self.width / DZI_TILE))
+            parts = []
+            for c in range(cols):
+                img = cv2.imread(os.path.join(self.dir, f"{c}_{r}.jpg"), cv2.IMREAD_COLOR)
+                # Drop the overlap again
+                left = DZI_OVERLAP if c > 0 else 0
+                top = DZI_OVERLAP if r > 0 else 0
+                parts.append(img[top:top + DZI_TILE, left:left + DZI_TILE])
+            self._cache[r] = np.hstack(parts)
+            for old in [k for k in self._cache if k < r - 1]:
+                del self._cache[old]
+        return self._cache[r]
+
+    def rows(self, y0: int, y1: int) -> np.ndarray:
+        y1 = min(y1, self.height)
+        bands = [self._band(r) for r in range(y0 // DZI_TILE, (y1 - 1) // DZI_TILE + 1)]
+        stacked = np.vstack(bands)
+        off = (y0 // DZI_TILE) * DZI_TILE
+        return stacked[y0 - off:y1 - off]
+
+
+class MosaicBuilder:
+    """Stitches tiles on a background thread while the scan is still running"""
+    def __init__(self, mosaic: Mosaic, queue_depth: int = 8):
+        self.mosaic = mosaic
+        self._q: "queue.Queue" = queue.Queue(maxsize=queue_depth)
+        self.error: Optional[str] = None
+        self._thread = threading.Thread(target=self._run, name="aoi-mosaic", daemon=True)
+        self._thread.start()
+
+    def submit(self, tile: np.ndarray, x_mm: float, y_mm: float, name: str = ""):
+        self._q.put((tile, x_mm, y_mm, name))
+
+    def _run(self):
+        while True:
+            item = self._q.get()
+            if item is None:
+                return
+            try:
+                self.mosaic.add(*item)
+            except Exception as e:
+                self.error = str(e)
+                print(f"Mosaic: tile {item[3]} failed: {e}")
+
+    def close(self) -> Dict:
+        """Finish the queued tiles, then cut the pyramid"""
+        self._q.put(None)
+        self._thread.join()
+        return finish(self.mosaic)
+
+
+def for_scan(scan_dir: str, centres_mm: List[Tuple[float, float]], tile_shape: Tuple[int, int]) -> Mosaic:
+    xs = [c[0] for c in centres_mm]
+    ys = [c[1] for c in centres_mm]
+    return Mosaic(scan_dir, (min(xs), min(ys), max(xs), max(ys)), camera.mm_per_px(), tile_shape)
+
+
+def finish(mosaic: Mosaic) -> Dict:
+    t0 = time.perf_counter()
+    pyramid = mosaic.build_pyramid()
+    corrected = [p["correction"] for p in mosaic.placed if p["correction"] and not p["correction"].get("rejected")]
+    report = {
+        "tiles": len(mosaic.placed),
+        "aligned": len(corrected),
+        "mean_correction_px": round(float(np.mean([math.hypot(c["dx"], c["dy"]) for c in corrected])), 2) if corrected else 0.0,
+        "mm_per_px": mosaic.mmpp,
+        "extent_mm": [mosaic.min_x, mosaic.min_y, mosaic.max_x, mosaic.max_y],
+        "margin_px": MARGIN_PX,
+        "pyramid": pyramid,
+        "pyramid_s": round(time.perf_counter() - t0, 2),
+        "placed": mosaic.placed,
+    }
+    with open(os.path.join(mosaic.dir, "mosaic.json"), "w") as f:
+        json.dump(report, f)
+    # The full-res canvas stays on disk (mosaic.raw) for measurements; coverage is not needed anymore
+    del mosaic.coverage
+    os.remove(os.path.join(mosaic.dir, "mosaic_coverage.raw"))
+    return report
+
+
+def stitch_scan(scan_id: str) -> Dict:
+    """Stitch a finished scan from its tiles.json (exposure positions)"""
+    scan_dir = os.path.join(SCANS_DIR, scan_id)
+    with open(os.path.join(scan_dir, "tiles.json")) as f:
+        meta = json.load(f)
+    tiles = [t for t in meta["tiles"] if not t.get("missed")]
+    if not tiles:
+        raise ValueError("Scan has no tiles")
+    first = cv2.imread(os.path.join(scan_dir, tiles[0]["image"]), cv2.IMREAD_COLOR)
+    centres = [(t.get("exposure_x", t["machine_x"]), t.get("exposure_y", t["machine_y"])) for t in tiles]
+    mosaic = for_scan(scan_dir, centres, first.shape[:2])
+    for t, (x, y) in zip(tiles, centres):
+        img = cv2.imread(os.path.join(scan_dir, t["image"]), cv2.IMREAD_COLOR)
+        mosaic.add(img, x, y, t["image"])
+    return finish(mosaic)
+
+
+# Builds running in the background, by scan id
+builds: Dict[str, Dict] = {}
+
+def _build(scan_id: str):
+    try:
+        builds[scan_id] = {"status": "running"}
+        report = stitch_scan(scan_id)
+        builds[scan_id] = {"status": "done", **{k: v for k, v in report.items() if k != "placed"}}
+    except Exception as e:
+        print(f"Mosaic build failed for {scan_id}: {e}")
+        builds[scan_id] = {"status": "error", "error": str(e)}
+
+
+@router.post("/{scan_id}/build")
+async def build_mosaic(scan_id: str):
+    scan_id = os.path.basename(scan_id)
+    if not os.path.exists(os.path.join(SCANS_DIR, scan_id, "tiles.json")):
+        raise HTTPException(status_code=404, detail="Scan not found")
+    if builds.get(scan_id, {}).get("status") == "running":
+        raise HTTPException(status_code=409, detail="Already building")
+    builds[scan_id] = {"status": "running"}
+    threading.Thread(target=_build, args=(scan_id,), daemon=True).start()
+    return builds[scan_id]
+
+@router.get("/{scan_id}")
+async def get_mosaic(scan_id: str):
+    """Build status, or the stitch report (tile placements, DZI url) once built"""
+    scan_id = os.path.basename(scan_id)
+    path = os.path.join(SCANS_DIR, scan_id, "mosaic.json")
+    if scan_id in builds and builds[scan_id]["status"] != "done":
+        return builds[scan_id]
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="No mosaic for this scan")
+    with open(path) as f:
+        report = json.load(f)
+    return {"status": "done", "dzi": f"/data/scans/{scan_id}/mosaic.dzi", **report}
@@ -1,5 +1,15 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, HTTPException
 from pydantic import BaseModel
+from collections import deque
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import threading
+import time
+
+import numpy as np
+
+from app.api.motion_model import model as motion_model, profile_distance, profile_time
 
 router = APIRouter()
 
@@ -11,63 +21,434 @@ class MotionStatus(BaseModel):
     machine: Position
     work: Position
     offset: Position
+    state: str = "idle" # idle / moving / hold / alarm
+    alarm: Optional[str] = None
+    seq: int = 0
 
 # Global State
+# machine_pos is written by the controller only (every status report); read it, don't assign it
 machine_pos = {"x": 0.0, "y": 0.0}
 work_offset = {"x": 0.0, "y": 0.0}
 
+# Axis velocity / acceleration / settle time: motion_model (stored with the machine)
+MOVE_TIMEOUT_FACTOR = 2.0 # move_and_wait gives up after factor * predicted move time + margin
+MOVE_TIMEOUT_MARGIN_S = 5.0
+SOFT_LIMITS = {"x": (0.0, 300.0), "y": (0.0, 300.0)}
+STATUS_HZ = 20 # Position reports while moving (FluidNC default report rate is similar)
+POSITION_HISTORY_S = 10 # Reports kept for position_at()
+
+
+class MotionError(Exception):
+    """Alarm or stop while waiting for a move"""
+
+
+class MotionController(ABC):
+    """
+    Machine state as reported by the controller: position, idle/moving/alarm.
+    Backends feed it through _report(); everybody else waits on it:
+    threads with wait_idle(), asyncio code with `await move(...)` / subscribe().
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.state = "idle"
+        self.alarm: Optional[str] = None
+        self.target: Optional[Tuple[float, float]] = None
+        self.seq = 0
+        self._listeners: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+        # (monotonic time, x, y) of every report, to place frames exposed mid-move
+        self._history: "deque[Tuple[float, float, float]]" = deque(maxlen=POSITION_HISTORY_S * STATUS_HZ * 2)
+
+    # --- Backend side ---
+    def _report(self, x: Optional[float] = None, y: Optional[float] = None,
+                state: Optional[str] = None, alarm: Optional[str] = None):
+        with self._cond:
+            if x is not None:
+                machine_pos["x"] = x
+            if y is not None:
+                machine_pos["y"] = y
+            if state is not None:
+                self.state = state
+                if state == "idle":
+                    self.target = None
+            if alarm is not None:
+                self.alarm = alarm
+            self._history.append((time.monotonic(), machine_pos["x"], machine_pos["y"]))
+            self.seq += 1
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for loop, ev in listeners:
+            try:
+                loop.call_soon_threadsafe(ev.set)
+            except RuntimeError:
+                pass # Loop already closed
+
+    # --- Commands (implemented by the backend) ---
+    @abstractmethod
+    def move_to(self, x: float, y: float, feed: Optional[float] = None) -> Tuple[float, float]:
+        """Start a move; feed (mm/s) caps the speed (constant-velocity sweeps), None = rapid"""
+
+    @abstractmethod
+    def stop(self):
+        """Abort the move in progress and drop the queued ones"""
+
+    def hold(self):
+        """Feed hold: decelerate and pause, keeping the queued moves"""
+        raise MotionError("Feed hold is not supported by this controller")
+
+    def resume(self):
+        raise MotionError("Feed hold is not supported by this controller")
+
+    def unlock(self):
+        """Clear an alarm (GRBL/FluidNC $X)"""
+        with self._cond:
+            self.alarm = None
+        self._report(state="idle")
+
+    # --- Waiting ---
+    def snapshot(self) -> Dict:
+        with self._cond:
+            return {
+                "machine": dict(machine_pos),
+                "offset": dict(work_offset),
+                "work": {"x": machine_pos["x"] - work_offset["x"], "y": machine_pos["y"] - work_offset["y"]},
+                "state": self.state,
+                "alarm": self.alarm,
+                "seq": self.seq,
+            }
+
+    def position_at(self, t: float) -> Tuple[float, float]:
+        """Machine position at monotonic time t, interpolated between status reports"""
+        with self._cond:
+            hist = list(self._history)
+        if not hist:
+            return machine_pos["x"], machine_pos["y"]
+        ts = [h[0] for h in hist]
+        return (float(np.interp(t, ts, [h[1] for h in hist])), float(np.interp(t, ts, [h[2] for h in hist])))
+
+    def position_history_end(self) -> float:
+        """Time of the newest status report"""
+        with self._cond:
+            return self._history[-1][0] if self._history else 0.0
+
+    def wait_report_after(self, t: float, timeout: float = 0.5) -> bool:
+        """Until a report newer than t arrived (position_at(t) can interpolate) or motion stopped"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: (self._history and self._history[-1][0] >= t) or self.state != "moving", timeout)
+
+    def wait_idle(self, timeout: Optional[float] = None) -> Dict:
+        """Block until the controller reports idle; MotionError on alarm or timeout"""
+        with self._cond:
+            # A feed hold pauses the move, it doesn't finish it
+            ok = self._cond.wait_for(lambda: self.state not in ("moving", "hold"), timeout)
+            if not ok:
+                raise MotionError("Move did not finish in time")
+            if self.state == "alarm":
+                raise MotionError(f"Alarm: {self.alarm}")
+        return self.snapshot()
+
+    def subscribe(self) -> asyncio.Event:
+        ev = asyncio.Event()
+        with self._cond:
+            self._listeners.append((asyncio.get_running_loop(), ev))
+        return ev
+
+    def unsubscribe(self, ev: asyncio.Event):
+        with self._cond:
+            self._listeners = [l for l in self._listeners if l[1] is not ev]
+
+    async def move(self, x: float, y: float, timeout: Optional[float] = None) -> Dict:
+        """Awaitable move: resolves when the controller reports idle"""
+        ev = self.subscribe()
+        try:
+            # move_to may block (streaming controller waiting for RX buffer room): off the event loop
+            await asyncio.to_thread(self.move_to, x, y)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while True:
+                snap = self.snapshot()
+                if snap["state"] == "alarm":
+                    raise MotionError(f"Alarm: {snap['alarm']}")
+                if snap["state"] == "idle":
+                    return snap
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise MotionError("Move did not finish in time")
+                try:
+                    await asyncio.wait_for(ev.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                ev.clear()
+        finally:
+            self.unsubscribe(ev)
+
+
+def clip(x: float, y: float) -> Tuple[float, float]:
+    # Soft limits (0-300mm)
+    return (max(SOFT_LIMITS["x"][0], min(SOFT_LIMITS["x"][1], x)),
+            max(SOFT_LIMITS["y"][0], min(SOFT_LIMITS["y"][1], y)))
+
+
+class SimulatedController(MotionController):
+    """
+    No hardware: interpolates the position over time, each axis independently
+    along its motion_model profile (accelerate, cruise, decelerate), and
+    reports like a real controller (STATUS_HZ while moving, idle when the
+    target is reached).
+    """
+    def __init__(self):
+        super().__init__()
+        self._move = None # (start_xy, target_xy, t0, duration per axis)
+        self._thread: Optional[threading.Thread] = None
+
+    def move_to(self, x: float, y: float, feed: Optional[float] = None) -> Tuple[float, float]:
+        if self.state == "alarm":
+            raise MotionError(f"Alarm: {self.alarm}")
+        tx, ty = clip(x, y)
+        with self._cond:
+            start = self._position_now()
+            vel = tuple(min(motion_model.axis(a).max_velocity, feed or np.inf) for a in ("x", "y"))
+            if feed is None:
+                # Rapids follow the full model (jerk included)
+                dur = (float(motion_model.axis_time("x", tx - start[0])), float(motion_model.axis_time("y", ty - start[1])))
+            else:
+                dur = (float(profile_time(tx - start[0], vel[0], motion_model.axis("x").accel)),
+                       float(profile_time(ty - start[1], vel[1], motion_model.axis("y").accel)))
+            self._move = (start, (tx, ty), time.monotonic(), dur, vel)
+            self.target = (tx, ty)
+        self._report(state="moving")
+        self._ensure_thread()
+        return tx, ty
+
+    def stop(self):
+        with self._cond:
+            if self._move is None:
+                return
+            x, y = self._position_now()
+            self._move = None
+        self._report(x, y, state="idle")
+
+    def _position_now(self) -> Tuple[float, float]:
+        if self._move is None:
+            return machine_pos["x"], machine_pos["y"]
+        (sx, sy), (tx, ty), t0, dur, vel = self._move
+        t = time.monotonic() - t0
+        return _axis_position("x", sx, tx, t, dur[0], vel[0]), _axis_position("y", sy, ty, t, dur[1], vel[1])
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="aoi-motion-sim", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._move is not None)
+                _, target, t0, dur, _ = self._move
+                remaining = t0 + max(dur) - time.monotonic()
+                x, y = self._position_now()
+                done = remaining <= 0
+                if done:
+                    self._move = None
+            if done:
+                self._report(target[0], target[1], state="idle")
+            else:
+                self._report(x, y)
+                time.sleep(min(1.0 / STATUS_HZ, remaining))
+
+
+def _axis_position(axis: str, start: float, target: float, t: float, duration: float, v: float) -> float:
+    d = target - start
+    if duration <= 0 or t >= duration:
+        return target
+    ax = motion_model.axis(axis)
+    # Trapezoid positions; an S-curve (jerk) profile is stretched to its longer duration
+    t_trap = float(profile_time(d, v, ax.accel))
+    s = profile_distance(d, v, ax.accel, t * t_trap / duration)
+    return start + (s if d > 0 else -s)
+
+
+controller: MotionController = SimulatedController()
+
+def set_controller(c: MotionController):
+    """Swap the backend (startup, see gcode_stream.connect); keeps the current position"""
+    global controller
+    controller = c
+
+# Long job driving the gantry (inspection run / fly-scan); the others wait for it to finish
+active_job: Optional[str] = None
+_job_lock = threading.Lock()
+
+def claim(job: str) -> Optional[str]:
+    """Take the machine for a job; returns the job already holding it (nothing is taken then)"""
+    global active_job
+    with _job_lock:
+        if active_job is not None:
+            return active_job
+        active_job = job
+        return None
+
+def release(job: str):
+    global active_job
+    with _job_lock:
+        if active_job == job:
+            active_job = None
+
+def require_free():
+    """409 while a run or fly-scan owns the machine"""
+    if active_job is not None:
+        raise HTTPException(status_code=409, detail=f"Machine busy: {active_job} in progress")
+
+
 @router.get("/status", response_model=MotionStatus)
 async def get_status():
-    return {
-        "machine": machine_pos,
-        "offset": work_offset,
-        "work": {
-            "x": machine_pos["x"] - work_offset["x"],
-            "y": machine_pos["y"] - work_offset["y"]
-        }
-    }
+    return controller.snapshot()
+
+@router.websocket("/ws")
+async def motion_ws(ws: WebSocket):
+    """
+    Push position/state updates instead of polling /status.
+    A slow client only ever gets the newest state (no backlog builds up).
+    """
+    await ws.accept()
+    ev = controller.subscribe()
+    # Notice a closed socket right away, not only at the next send
+    closed = asyncio.ensure_future(_wait_closed(ws))
+    try:
+        last = -1
+        while not closed.done():
+            snap = controller.snapshot()
+            if snap["seq"] != last:
+                await ws.send_json(snap)
+                last = snap["seq"]
+            updated = asyncio.ensure_future(ev.wait())
+            await asyncio.wait({updated, closed}, return_when=asyncio.FIRST_COMPLETED)
+            updated.cancel()
+            ev.clear()
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        closed.cancel()
+        controller.unsubscribe(ev)
+
+async def _wait_closed(ws: WebSocket):
+    while True:
+        msg = await ws.receive()
+        if msg["type"] == "websocket.disconnect":
+            return
 
 class MoveCommand(BaseModel):
     axis: str # 'x' or 'y'
     distance: float # e.g. 0.1, 10.0
 
+class MoveToCommand(BaseModel):
+    x: float
+    y: float
+    wait: bool = False # Respond once the move is done
+
 
 # Internal Helper
 def move_to(x: float, y: float):
-    global machine_pos
-    # Clip logic (0-300mm soft limits)
-    target_x = max(0, min(300, x))
-    target_y = max(0, min(300, y))
-    
-    machine_pos["x"] = target_x
-    machine_pos["y"] = target_y
+    """Start a move and return immediately (see move_and_wait / controller.move)"""
+    tx, ty = controller.move_to(x, y)
+    return {"x": tx, "y": ty}
+
+def move_timeout(start: Tuple[float, float], target: Tuple[float, float]) -> float:
+    """How long a move may take before it counts as lost (no idle report, unresumed hold)"""
+    return float(motion_model.move_time(start, target)) * MOVE_TIMEOUT_FACTOR + MOVE_TIMEOUT_MARGIN_S
+
+def move_and_wait(x: float, y: float, settle: Optional[float] = None):
+    """Blocking move: returns once the controller reports idle + settle time (default: calibrated)"""
+    start = (machine_pos["x"], machine_pos["y"])
+    controller.move_to(x, y)
+    try:
+        controller.wait_idle(timeout=move_timeout(start, (x, y)))
+    except MotionError:
+        if controller.state in ("moving", "hold"):
+            controller.stop()
+        raise
+    if settle is None:
+        settle = motion_model.params.settle_s
+    if settle > 0:
+        time.sleep(settle)
     return machine_pos
 
+async def _move_and_wait_async(x: float, y: float) -> Dict:
+    # Same timeout / stop-on-failure as move_and_wait, for the endpoints
+    start = (machine_pos["x"], machine_pos["y"])
+    try:
+        return await controller.move(x, y, timeout=move_timeout(start, (x, y)))
+    except MotionError:
+        if controller.state in ("moving", "hold"):
+            await asyncio.to_thread(controller.stop)
+        raise
+
+def _commanded_position() -> Tuple[float, float]:
+    # Jogs are relative to where the machine is going, not where it is mid-move
+    target = controller.target
+    return target if target is not None else (machine_pos["x"], machine_pos["y"])
+
 @router.post("/jog")
 async def jog(cmd: MoveCommand):
-    global machine_pos
-    target_x = machine_pos["x"]
+    target_x, target_y = _commanded_position()
     if cmd.axis.lower() == 'x':
         target_x += cmd.distance
-    
-    target_y = machine_pos["y"]
     if cmd.axis.lower() == 'y':
         target_y += cmd.distance
-        
-    move_to(target_x, target_y)
-    
+
+    try:
+        await asyncio.to_thread(move_to, target_x, target_y)
+    except MotionError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return await get_status()
+
+@router.post("/move")
+async def move(cmd: MoveToCommand):
+    """Absolute move (machine coordinates)"""
+    try:
+        if cmd.wait:
+            return await _move_and_wait_async(cmd.x, cmd.y)
+        await asyncio.to_thread(move_to, cmd.x, cmd.y)
+    except MotionError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return await get_status()
+
+@router.post("/stop")
+async def stop():
+    await asyncio.to_thread(controller.stop)
+    return await get_status()
+
+@router.post("/hold")
+async def hold():
+    try:
+        controller.hold()
+    except MotionError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return await get_status()
+
+@router.post("/resume")
+async def resume():
+    try:
+        controller.resume()
+    except MotionError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return await get_status()
+
+@router.post("/unlock")
+async def unlock():
+    await asyncio.to_thread(controller.unlock)
     return await get_status()
 
 @router.post("/home")
 async def home():
-    global machine_pos
     # Return to machine zero
-    machine_pos = {"x": 0.0, "y": 0.0}
+    try:
+        await _move_and_wait_async(0.0, 0.0)
+    except MotionError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     return await get_status()
 
 @router.post("/zero")
 async def set_zero():
     """Set current machine position as new Work Zero (G54)"""
-    global work_offset, machine_pos
-    work_offset = machine_pos.copy()
+    work_offset.update(machine_pos)
     return await get_status()
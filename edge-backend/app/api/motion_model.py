@@ -0,0 +1,234 @@
+"""
+Motion-time model of the gantry.
+
+Each axis has a max velocity, an acceleration and optionally a jerk limit.
+A point-to-point move starts and ends at rest, so its time follows a
+trapezoidal velocity profile (S-curve when jerk is set) instead of
+distance / speed: short moves never reach full speed and are dominated by
+acceleration. Axes either move independently (the built-in simulation,
+time = slowest axis) or coordinated along a straight line like GRBL/FluidNC
+G0/G1 (limits projected on the move direction).
+
+Used by the simulated controllers, the path optimizer and the cycle-time
+prediction endpoint. Parameters are stored with the machine
+(AOI_MOTION_MODEL) and can be fitted from measured move times.
+"""
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from typing import Dict, List, Optional, Sequence, Tuple
+import json
+import math
+import os
+
+import numpy as np
+
+router = APIRouter()
+
+MODEL_FILE = os.getenv("AOI_MOTION_MODEL", "/app/data/motion_model.json")
+
+
+class AxisLimits(BaseModel):
+    max_velocity: float = 100.0 # mm/s
+    accel: float = 800.0 # mm/s^2
+    jerk: Optional[float] = None # mm/s^3, None = trapezoidal profile
+
+class MotionModel(BaseModel):
+    x: AxisLimits = AxisLimits()
+    y: AxisLimits = AxisLimits()
+    coordinated: bool = False # True: straight-line moves (GRBL/FluidNC), False: independent axes
+    settle_s: float = 0.5 # After the controller reports idle
+    capture_s: float = 0.1 # Exposure + readout per point
+    command_latency_s: float = 0.0 # Per move (round trip when not streaming)
+
+
+def profile_time(d, v: float, a: float, j: Optional[float] = None):
+    """
+    Rest-to-rest time (s) to travel distance d with velocity v, acceleration a
+    and optional jerk j (d, v and a broadcast as arrays).
+    """
+    d = np.abs(np.asarray(d, dtype=np.float64))
+    if not j:
+        # Triangle (never reaches v) below v^2/a, trapezoid above
+        return np.where(d < v * v / a, 2.0 * np.sqrt(d / a), d / v + v / a)
+    a = np.minimum(a, np.sqrt(v * j)) # Acceleration the jerk limit lets us reach before v
+    t_ramp = a / j
+    d_full = v * (v / a + t_ramp) # Distance of a complete accel + decel reaching v
+    # Peak velocity of shorter moves: with a constant-accel phase, or pure jerk ramps
+    vp = a * (np.sqrt(t_ramp * t_ramp + 4.0 * d / a) - t_ramp) / 2.0
+    vp_jerk = np.cbrt(d * d * j / 4.0)
+    t_cruise = d / v + v / a + t_ramp
+    t_accel = 2.0 * (vp / a + t_ramp)
+    t_jerk = 4.0 * np.sqrt(vp_jerk / j)
+    return np.where(d >= d_full, t_cruise, np.where(vp >= a * t_ramp, t_accel, t_jerk))
+
+
+def profile_distance(d: float, v: float, a: float, t: float) -> float:
+    """Distance covered after t seconds of a trapezoidal rest-to-rest move of length d"""
+    d = abs(d)
+    if d <= 0 or t <= 0:
+        return 0.0
+    vp = min(v, math.sqrt(d * a)) # Peak velocity (triangle if d < v^2/a)
+    ta = vp / a
+    total = 2 * ta + (d - vp * ta) / vp
+    if t >= total:
+        return d
+    if t < ta:
+        return 0.5 * a * t * t
+    if t < total - ta:
+        return 0.5 * vp * ta + vp * (t - ta)
+    r = total - t
+    return d - 0.5 * a * r * r
+
+
+class Model:
+    """The machine's MotionModel plus vectorised move-time helpers"""
+    def __init__(self, path: str = MODEL_FILE):
+        self.path = path
+        self.params = MotionModel()
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.params = MotionModel(**json.load(f))
+            except Exception as e:
+                print(f"Motion model {self.path} unreadable, using defaults: {e}")
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.params.model_dump(), f, indent=2)
+        os.replace(tmp, self.path)
+
+    def update(self, params: MotionModel):
+        self.params = params
+        self.save()
+
+    def axis(self, name: str) -> AxisLimits:
+        return getattr(self.params, name)
+
+    def axis_time(self, name: str, d):
+        ax = self.axis(name)
+        return profile_time(d, ax.max_velocity, ax.accel, ax.jerk)
+
+    def move_time(self, a, b) -> np.ndarray:
+        """Move time (s) between point arrays a and b (broadcastable, [..., 2]); no settle"""
+        delta = np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64)
+        if not self.params.coordinated:
+            return np.maximum(self.axis_time("x", delta[..., 0]), self.axis_time("y", delta[..., 1]))
+        # Straight line: the path limits are the axis limits divided by the direction cosines
+        length = np.hypot(delta[..., 0], delta[..., 1])
+        safe = np.where(length > 0, length, 1.0)
+        ux, uy = np.abs(delta[..., 0]) / safe, np.abs(delta[..., 1]) / safe
+        x, y = self.params.x, self.params.y
+        with np.errstate(divide="ignore", invalid="ignore"):
+            v = np.minimum(x.max_velocity / ux, y.max_velocity / uy)
+            acc = np.minimum(x.accel / ux, y.accel / uy)
+            jerk = min(x.jerk, y.jerk) if x.jerk and y.jerk else None
+            t = profile_time(length, v, acc, jerk)
+        return np.where(length > 0, t, 0.0)
+
+    def point_time(self, a, b) -> np.ndarray:
+        """Move + settle + capture: what one inspection point costs in the run loop"""
+        p = self.params
+        t = self.move_time(a, b)
+        return t + np.where(t > 0, p.command_latency_s + p.settle_s, 0.0) + p.capture_s
+
+    def predict(self, xy: np.ndarray, start: Sequence[float] = (0.0, 0.0)) -> Dict:
+        """Cycle time of visiting xy in order from start (stop-and-go, one capture per point)"""
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        prev = np.vstack([np.asarray(start, dtype=np.float64)[None, :], xy[:-1]])
+        moves = self.move_time(prev, xy)
+        per_point = self.point_time(prev, xy)
+        p = self.params
+        return {
+            "points": len(xy),
+            "cycle_time_s": round(float(per_point.sum()), 3),
+            "move_s": round(float(moves.sum()), 3),
+            "settle_s": round(float(np.count_nonzero(moves > 0) * (p.settle_s + p.command_latency_s)), 3),
+            "capture_s": round(len(xy) * p.capture_s, 3),
+            "longest_move_s": round(float(moves.max()), 3) if len(xy) else 0.0,
+            "per_point_s": [round(float(t), 3) for t in per_point],
+        }
+
+
+def fit_axis(distances: Sequence[float], times: Sequence[float]) -> Tuple[float, float]:
+    """
+    Velocity and acceleration from measured single-axis move times (s) over
+    distances (mm), trapezoidal profile. Long moves give t = d/v + v/a,
+    a straight line in d; short ones t = 2*sqrt(d/a).
+    """
+    d = np.abs(np.asarray(distances, dtype=np.float64))
+    t = np.asarray(times, dtype=np.float64)
+    # Least squares over a log grid of the plausible range, all candidates at once
+    v = np.geomspace(5.0, 1000.0, 160)[:, None, None]
+    a = np.geomspace(20.0, 20000.0, 160)[None, :, None]
+    err = ((profile_time(d, v, a) - t) ** 2).sum(axis=-1)
+    i, k = np.unravel_index(int(np.argmin(err)), err.shape)
+    return float(v[i, 0, 0]), float(a[0, k, 0])
+
+
+model = Model()
+
+
+class PredictRequest(BaseModel):
+    name: Optional[str] = None # Saved program; current program if omitted
+    start: Optional[List[float]] = None # Machine position the run starts from (default 0,0)
+    optimized: bool = False # Also predict the path-optimized order
+
+class FitSample(BaseModel):
+    axis: str # 'x' or 'y'
+    distance: float
+    time_s: float
+
+
+@router.get("/", response_model=MotionModel)
+async def get_model():
+    return model.params
+
+@router.put("/", response_model=MotionModel)
+async def set_model(params: MotionModel):
+    model.update(params)
+    return model.params
+
+@router.post("/fit")
+async def fit(samples: List[FitSample]):
+    """Fit per-axis velocity/acceleration from measured move times (at least 3 per axis)"""
+    params = model.params.model_copy(deep=True)
+    fitted = {}
+    for name in ("x", "y"):
+        s = [m for m in samples if m.axis.lower() == name]
+        if len(s) < 3:
+            continue
+        v, a = fit_axis([m.distance for m in s], [m.time_s for m in s])
+        getattr(params, name).max_velocity = round(v, 2)
+        getattr(params, name).accel = round(a, 1)
+        fitted[name] = {"max_velocity": round(v, 2), "accel": round(a, 1), "samples": len(s)}
+    if not fitted:
+        raise HTTPException(status_code=400, detail="Need at least 3 samples for an axis")
+    model.update(params)
+    return {"fitted": fitted, "model": model.params}
+
+@router.post("/predict")
+async def predict(req: PredictRequest = PredictRequest()):
+    """Cycle time of a program before running it: refs, then inspect points in program order"""
+    from app.api import program
+    if req.name:
+        prog = program._load_from_disk(req.name)
+        if not prog:
+            raise HTTPException(status_code=404, detail="Program not found")
+    else:
+        prog = program.current_program
+    pts = list(prog.refs) + list(prog.points)
+    start = req.start or [0.0, 0.0]
+    xy = np.array([[p.x, p.y] for p in pts], dtype=np.float64).reshape(-1, 2)
+    result = model.predict(xy, start)
+    result["program"] = prog.name
+    if req.optimized and prog.points:
+        opt_prog = prog.model_copy(deep=True)
+        program._optimize_program_path(opt_prog)
+        opt_xy = np.array([[p.x, p.y] for p in list(opt_prog.refs) + list(opt_prog.points)], dtype=np.float64)
+        result["optimized_cycle_time_s"] = model.predict(opt_xy, start)["cycle_time_s"]
+    return result
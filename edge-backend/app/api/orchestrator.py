@@ -1,20 +1,21 @@
-from fastapi import APIRouter, BackgroundTasks
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, Response
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict
+from collections import deque
 import asyncio
-import time
 import math
-import csv
-import io
+import time
 import os
 import json
-import cv2
 import datetime
 import shutil
 
-from app.api import motion, camera, inference
-from app.api.program import Point
+from app.api import motion, camera, inference, path_optimizer, cascade, golden, storage, journal, history_index, export, analytics, events, settle
+from app.api import program as program_api
+from app.api.program import Point, CascadeConfig
+from app.api.pipeline import InspectionPipeline
+from app.api.motion_model import model as motion_model
 
 HISTORY_DIR = "/app/data/history"
 os.makedirs(HISTORY_DIR, exist_ok=True)
@@ -23,11 +24,16 @@ router = APIRouter()
 
 # --- Job State ---
 class RunStatus(BaseModel):
+    # Summary only; per-point results are pushed over /events
     is_running: bool
     current_point_index: int
     total_points: int
+    completed_points: int = 0
+    run_id: Optional[str] = None
     last_error: Optional[str] = None
-    results: List[Dict] = []
+    summary: Dict = {}
+    cascade: Optional[Dict] = None
+    seq: int = 0 # Last event sequence number
 
 # Global State
 job_state = {
@@ -35,35 +41,115 @@ job_state = {
     "current_point_index": 0,
     "total_points": 0,
     "last_error": None,
-    "results": [],
-    "stop_signal": False
+    "results": deque(),
+    "completed_points": 0,
+    "summary": {"ok": 0, "ng": 0},
+    "stop_signal": False,
+    "cascade": None,
+    "image_profile": "inspection",
+    "settle_mode": settle.SETTLE_MODE,
+    "settle": {} # Point index -> settle measurement, until the result is recorded
 }
 
-def run_loop(points: List[Point]):
+# Pipeline tuning: frames waiting per stage / parallel inference workers
+PIPELINE_QUEUE_DEPTH = 4
+INFERENCE_WORKERS = 1
+# Name the run holds the machine under (motion.claim), shown to whoever is refused
+RUN_JOB = "inspection run"
+# Latest results kept in memory for event snapshots; the full run lives in the journal
+LIVE_RESULTS_WINDOW = int(os.getenv("AOI_LIVE_RESULTS", "1000"))
+
+# Run events for the SSE clients (point started / finished, run started / finished)
+bus = events.EventBus()
+
+def _save_image(pt: Point, frame):
+    # Encode + write happen on the writer pool; the frame is a private copy from the ring
+    storage.writer.submit(job_state["run_dir"], str(pt.id), frame, profile=job_state["image_profile"])
+
+def _record_result(index: int, pt: Point, res: Dict):
+    # Called by the pipeline in point order
+    result_entry = {
+        "point_id": pt.id,
+        "x": pt.x,
+        "y": pt.y,
+        "result": res["result"],
+        "detections": res["detections"],
+        "rois": res.get("rois", []),
+        "cascade": res.get("cascade"),
+        "settle_s": job_state["settle"].pop(index, {}).get("settle_s"),
+        "image_path": f"{job_state['run_id']}/{storage.image_name(str(pt.id), job_state['image_profile'])}" # Relative path
+    }
+    job_state["journal"].append({"type": "result", **result_entry})
+    job_state["results"].append(result_entry)
+    job_state["completed_points"] = index + 1
+    if res["result"] in ("OK", "NG"):
+        job_state["summary"][res["result"].lower()] += 1
+    bus.publish("point_finished", {"index": index, "result": result_entry, "summary": dict(job_state["summary"])})
+
+def _run_id(start_time: float) -> str:
+    return datetime.datetime.fromtimestamp(start_time).strftime("%Y%m%d_%H%M%S")
+
+def _is_active_run(run_id: str) -> bool:
+    # The run in progress is compacted, indexed and ingested by run_loop when it ends
+    return job_state["is_running"] and job_state.get("run_id") == run_id
+
+def run_loop(points: List[Point], program_name: str = "", cascade_cfg: Optional[CascadeConfig] = None):
     """
     The main execution loop running in background.
-    Strictly sequential: Move -> Wait -> Capture -> Infer
+    Pipelined: Move -> Wait -> Capture happens here, Infer -> Save runs on
+    worker threads (see pipeline.InspectionPipeline), so the gantry moves to
+    the next point while the previous frame is still being processed.
     """
     global job_state
+    pipeline = None
     
     try:
         print(f"Starting run with {len(points)} points")
         job_state["is_running"] = True
         job_state["total_points"] = len(points)
-        job_state["results"] = []
+        job_state["results"] = deque(maxlen=LIVE_RESULTS_WINDOW)
+        job_state["summary"] = {"ok": 0, "ng": 0}
+        job_state["completed_points"] = 0
         job_state["current_point_index"] = 0
-        if job_state["metadata"].get("start_time"):
-            run_id = datetime.datetime.fromtimestamp(job_state["metadata"]["start_time"]).strftime("%Y%m%d_%H%M%S")
-        else:
-            run_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        job_state["last_error"] = None
+        job_state["storage_start"] = storage.writer.stats() # The writer's counters are per process
+        run_id = _run_id(job_state["metadata"].get("start_time") or time.time())
         
         # Create Run Directory
         run_dir = os.path.join(HISTORY_DIR, run_id)
         os.makedirs(run_dir, exist_ok=True)
         job_state["run_id"] = run_id
         job_state["run_dir"] = run_dir
+        job_state["journal"] = journal.RunJournal(run_dir)
+        job_state["journal"].append({
+            "type": "start",
+            "metadata": job_state.get("metadata", {}),
+            "total_points": len(points),
+        })
+        bus.publish("run_started", {"run_id": run_id, "total_points": len(points),
+                                    "metadata": job_state.get("metadata", {})})
 
         job_state["stop_signal"] = False
+        camera.set_run_active(True)
+
+        # Optional cascade: golden-image pre-check in front of the model
+        infer_fn = inference.inspect_frames
+        cascade_stats = None
+        if cascade_cfg is not None and cascade_cfg.enabled and program_name:
+            cascade_stats = cascade.CascadeStats()
+            # Templates come from the in-memory cache (built at program load)
+            golden_set = golden.store.load(program_name)
+            infer_fn = cascade.make_cascade_infer(golden_set, cascade_cfg, infer_fn, cascade_stats)
+        job_state["cascade"] = cascade_stats
+
+        pipeline = InspectionPipeline(
+            infer_fn=infer_fn,
+            save_fn=_save_image,
+            on_result=_record_result,
+            infer_workers=INFERENCE_WORKERS,
+            queue_depth=PIPELINE_QUEUE_DEPTH,
+        )
+        pipeline.start()
 
         for i, pt in enumerate(points):
             if job_state["stop_signal"]:
@@ -71,142 +157,157 @@ def run_loop(points: List[Point]):
                 break
                 
             job_state["current_point_index"] = i + 1
+            bus.publish("point_started", {"index": i, "point_id": pt.id, "current_point_index": i + 1})
             
-            # 1. Move Machine (Backend Call)
-            # Calculate distance for simulation delay
-            curr_x = motion.machine_pos["x"]
-            curr_y = motion.machine_pos["y"]
-            dist_x = pt.x - curr_x
-            dist_y = pt.y - curr_y
-            distance = math.sqrt(dist_x**2 + dist_y**2)
-            
-            # Simulate Feed Rate: 100mm/s
-            feed_rate = 100.0
-            travel_time = distance / feed_rate
-            
-            print(f"Moving to Point {pt.id}: {pt.x}, {pt.y} (Dist: {distance:.1f}mm, Est Time: {travel_time:.2f}s)")
-            
-            # Execute Move
-            motion.move_to(pt.x, pt.y)
-            
-            # 2. Travel Wait + Settling Time
-            # In real system, we would poll motion.is_idle()
-            time.sleep(travel_time + 0.5) 
-            
-            # 3. Capture Image
-            print("Capturing...")
-            # Flush existing buffer to avoid stale frames (very important for rolling shutter / usb cams)
-            camera.flush_buffer()
-            frame = camera.get_latest_frame()
-            
-            # 4. Inference
-            print("Inferencing...")
-            res = inference.predict_on_image(frame)
-            
-            # 5. Record Result
-            result_entry = {
-                "point_id": pt.id,
-                "x": pt.x,
-                "y": pt.y,
-                "result": res["result"],
-                "detections": res["detections"],
-                "image_path": f"{job_state['run_id']}/{pt.id}.jpg" # Relative path
-            }
-            job_state["results"].append(result_entry)
-
-            # Save Image to Disk
-            img_path = os.path.join(job_state["run_dir"], f"{pt.id}.jpg")
-            # Convert frame back to BGR for saving if needed (Assuming get_latest_frame returns BGR or RGB). 
-            # Usually OpenCV reads/writes BGR.
-            cv2.imwrite(img_path, frame)
+            # 1. Move Machine + 2. wait until the controller reports idle
+            print(f"Moving to Point {pt.id}: {pt.x}, {pt.y}")
+            t_move = time.monotonic()
+            start_xy = (motion.machine_pos["x"], motion.machine_pos["y"])
+            predicted = float(motion_model.move_time(start_xy, (pt.x, pt.y)))
+            motion.move_and_wait(pt.x, pt.y, settle=0)
+            t_idle = time.monotonic()
+            if job_state["stop_signal"]:
+                # Stopped mid-move: the machine is not at the point, don't capture
+                print("Run stopped by user")
+                break
+
+            # 3. Settle + Capture: fixed wait, or the first stable frame (settle mode "vision")
+            distance = math.hypot(pt.x - start_xy[0], pt.y - start_xy[1])
+            frame, settle_info = settle.wait_settled(t_idle, distance, t_idle - t_move, job_state["settle_mode"])
+            job_state["settle"][i] = settle_info
+            print(f"Move {t_idle - t_move:.2f}s (model: {predicted:.2f}s) + settle {settle_info['settle_s']:.3f}s")
             
-            # Simulate processing time
-            time.sleep(0.1)
+            # 4. Hand off to Infer -> Save stages; returns as soon as there is room in the queue
+            if not pipeline.submit(i, pt, frame):
+                break
+
+        # Finish the frames already captured (also on stop), then surface worker errors
+        pipeline.close()
+        pipeline = None
 
     except Exception as e:
         print(f"Run Error: {e}")
         job_state["last_error"] = str(e)
+        if pipeline is not None:
+            pipeline.cancel()
     finally:
+        # Images still queued for the writer must be on disk before the report points at them
+        storage.writer.drain()
         job_state["is_running"] = False
+        camera.set_run_active(False)
+        motion.release(RUN_JOB)
         print("Run finished")
+        bus.publish("run_finished", {
+            "run_id": job_state.get("run_id"),
+            "status": "completed" if not job_state["last_error"] else "error",
+            "error": job_state["last_error"],
+            "completed_points": job_state["completed_points"],
+            "summary": dict(job_state["summary"]),
+        })
         
-        # Save Final Report
-        if "run_dir" in job_state:
-            report_path = os.path.join(job_state["run_dir"], "report.json")
-            report_data = {
-                "metadata": job_state.get("metadata", {}),
-                "total_points": job_state["total_points"],
-                "results": job_state["results"],
+        # Close the journal and fold it into report.json
+        if job_state.get("journal") is not None:
+            job_state["journal"].append({
+                "type": "end",
                 "completed_at": time.time(),
                 "status": "completed" if not job_state["last_error"] else "error",
-                "error": job_state["last_error"]
-            }
-            with open(report_path, "w") as f:
-                json.dump(report_data, f, indent=2)
+                "error": job_state["last_error"],
+                "cascade": job_state["cascade"].to_dict() if job_state["cascade"] else None,
+                "storage": storage.writer.stats_since(job_state["storage_start"])
+            })
+            job_state["journal"].close()
+            job_state["journal"] = None
+            summary = None
+            try:
+                summary = journal.compact(job_state["run_dir"])
+            except Exception as e:
+                print(f"Report compaction failed: {e}")
+            try:
+                if summary is not None:
+                    history_index.upsert(job_state["run_id"], summary)
+            except Exception as e:
+                print(f"History index update failed: {e}")
+            try:
+                analytics.ingest_run(HISTORY_DIR, job_state["run_id"])
+            except Exception as e:
+                print(f"Analytics ingest failed: {e}")
 
 # --- History Endpoints ---
+def _is_active_run(run_id: str) -> bool:
+    # Its journal is still being written; the report appears when the run ends
+    return job_state["is_running"] and job_state.get("run_id") == run_id
+
+def _load_run(run_id: str) -> Optional[Dict]:
+    if _is_active_run(run_id):
+        return None
+    run_dir = os.path.join(HISTORY_DIR, run_id)
+    if not os.path.isdir(run_dir):
+        return None
+    return journal.load_report(run_dir)
+
 @router.get("/history")
-async def list_history():
-    runs = []
-    if not os.path.exists(HISTORY_DIR):
-        return []
-    
-    for dirname in sorted(os.listdir(HISTORY_DIR), reverse=True):
-        dir_path = os.path.join(HISTORY_DIR, dirname)
-        if os.path.isdir(dir_path):
-            report_path = os.path.join(dir_path, "report.json")
-            if os.path.exists(report_path):
-                try:
-                    with open(report_path, "r") as f:
-                        data = json.load(f)
-                        runs.append({
-                            "run_id": dirname,
-                            "metadata": data.get("metadata", {}),
-                            "completed_at": data.get("completed_at"),
-                            "status": data.get("status"),
-                            "stats": {
-                                "total": len(data.get("results", [])),
-                                "ng": len([r for r in data.get("results", []) if r["result"] == "NG"])
-                            }
-                        })
-                except:
-                    pass
-    return runs
+async def list_history(
+    response: Response,
+    limit: int = 100,
+    offset: int = 0,
+    part_no: Optional[str] = None,
+    batch_no: Optional[str] = None,
+    status: Optional[str] = None,
+    date_from: Optional[float] = None, # Unix time, on completed_at
+    date_to: Optional[float] = None,
+    sort: str = "completed_at",
+    order: str = "desc",
+):
+    """
+    One page of runs from the history index (no report.json is opened).
+    The total number of matching runs is in the X-Total-Count header.
+    """
+    try:
+        page = history_index.query(limit=max(1, min(limit, 1000)), offset=max(0, offset),
+                                   part_no=part_no, batch_no=batch_no, status=status,
+                                   date_from=date_from, date_to=date_to,
+                                   sort=sort, descending=order != "asc")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    response.headers["X-Total-Count"] = str(page["total"])
+    return [{
+        "run_id": r["run_id"],
+        "metadata": json.loads(r["metadata"]) if r["metadata"] else {},
+        "completed_at": r["completed_at"],
+        "status": r["status"],
+        "stats": {"total": r["total"], "ng": r["ng"], "ok": r["ok"], "overridden": r["overridden"]}
+    } for r in page["items"]]
+
+@router.post("/history/rebuild_index")
+async def rebuild_history_index():
+    """Rescan all run directories into the index (e.g. after copying runs in by hand)"""
+    active = [job_state["run_id"]] if job_state["is_running"] and job_state.get("run_id") else []
+    return await asyncio.to_thread(history_index.rebuild, HISTORY_DIR, None, active)
 
 @router.get("/history/{run_id}")
 async def get_history_detail(run_id: str):
-    run_dir = os.path.join(HISTORY_DIR, run_id)
-    report_path = os.path.join(run_dir, "report.json")
-    if not os.path.exists(report_path):
+    data = _load_run(run_id)
+    if data is None:
         return {"error": "Run not found"}
-    
-    with open(report_path, "r") as f:
-        data = json.load(f)
     return data
 
 @router.post("/history/{run_id}/update_result")
 async def update_result(run_id: str, point_id: int, new_result: str):
     run_dir = os.path.join(HISTORY_DIR, run_id)
-    report_path = os.path.join(run_dir, "report.json")
-    if not os.path.exists(report_path):
+    if not os.path.exists(journal.report_path(run_dir)) and not os.path.exists(journal.journal_path(run_dir)):
         return {"error": "Run not found"}
-    
-    with open(report_path, "r") as f:
-        data = json.load(f)
-    
-    found = False
-    for r in data["results"]:
-        if r["point_id"] == point_id:
-            r["result"] = new_result
-            r["manual_override"] = True # Flag as manually modified
-            found = True
-            break
-            
-    if found:
-        with open(report_path, "w") as f:
-            json.dump(data, f, indent=2)
-        return {"status": "updated"}
-    return {"error": "Point not found"}
+
+    # The journal is the record of what was inspected (images may be queued, skipped or in another profile)
+    if not await asyncio.to_thread(journal.has_point, run_dir, point_id):
+        return {"error": "Point not found"}
+    if _is_active_run(run_id):
+        raise HTTPException(status_code=409, detail="Run in progress, override it after it finishes")
+
+    # Appended to the journal, report.json is not rewritten
+    journal.override(run_dir, point_id, new_result)
+    await asyncio.to_thread(history_index.refresh, HISTORY_DIR, run_id)
+    await asyncio.to_thread(analytics.store.set_result, run_id, point_id, new_result)
+    return {"status": "updated"}
 
 @router.post("/history/{run_id}/upload")
 async def upload_run(run_id: str):
@@ -223,55 +324,28 @@ async def upload_run(run_id: str):
     
     return {"status": "success", "message": "Uploaded to Host"}
 
-@router.get("/history/{run_id}/export/csv")
-async def export_run_csv(run_id: str):
+@router.get("/history/{run_id}/export/{fmt}")
+async def export_run(run_id: str, fmt: str = "csv"):
+    """One run as csv / ndjson / parquet / arrow, streamed (see export.py)"""
     run_dir = os.path.join(HISTORY_DIR, run_id)
-    report_path = os.path.join(run_dir, "report.json")
-    
-    if not os.path.exists(report_path):
+    if _is_active_run(run_id) or not os.path.isdir(run_dir):
         return {"error": "Run not found"}
-        
-    with open(report_path, "r") as f:
-        data = json.load(f)
-        
-    # Create CSV in memory
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    # Header
-    writer.writerow(["Point ID", "X", "Y", "Result", "Label", "Confidence"])
-    
-    # Rows
-    for r in data.get("results", []):
-        # Flatten detections (just take first one or join them)
-        label = ""
-        conf = ""
-        if r.get("detections"):
-            d = r["detections"][0]
-            label = d.get("label", "")
-            conf = d.get("confidence", "")
-            
-        writer.writerow([
-            r.get("point_id"),
-            r.get("x"),
-            r.get("y"),
-            r.get("result"),
-            label,
-            conf
-        ])
-        
-    output.seek(0)
-    return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename=run_{run_id}.csv"}
-    )
+    page = history_index.query(limit=1, run_id=run_id)
+    if not page["items"]:
+        # Not indexed yet (e.g. copied in by hand)
+        await asyncio.to_thread(history_index.refresh, HISTORY_DIR, run_id)
+        page = history_index.query(limit=1, run_id=run_id)
+        if not page["items"]:
+            return {"error": "Run not found"}
+    return export.export_response(fmt, iter(page["items"]), f"run_{run_id}", legacy_csv=True)
 
 @router.delete("/history/{run_id}")
 async def delete_run(run_id: str):
     run_dir = os.path.join(HISTORY_DIR, run_id)
     if os.path.exists(run_dir):
         shutil.rmtree(run_dir)
+        history_index.remove(run_id)
+        analytics.store.remove_run(run_id)
         return {"status": "deleted", "run_id": run_id}
     return {"error": "Run not found"}
 
@@ -279,36 +353,107 @@ class RunRequest(BaseModel):
     points: List[Point]
     part_no: str = ""
     batch_no: str = ""
+    # Program the points come from (golden images, cascade thresholds); defaults to the loaded one
+    program_name: str = ""
+    # Reorder points for minimum travel before running (ids in fixed_ids keep their slot)
+    optimize_path: bool = False
+    fixed_ids: List[int] = []
+    # "inspection" (JPEG) or "training" (lossless WebP, for dataset collection)
+    image_profile: str = "inspection"
+    # "fixed" (calibrated settle time) or "vision" (capture once frames are stable); default AOI_SETTLE_MODE
+    settle_mode: Optional[str] = None
 
 @router.post("/start")
 async def start_run(req: RunRequest, background_tasks: BackgroundTasks):
     if job_state["is_running"]:
         return {"status": "error", "message": "Already running"}
+    if req.image_profile not in ("inspection", "training"):
+        return {"status": "error", "message": f"Unknown image profile: {req.image_profile}"}
+    if req.settle_mode not in (None, "fixed", "vision"):
+        return {"status": "error", "message": f"Unknown settle mode: {req.settle_mode}"}
+    busy = motion.claim(RUN_JOB)
+    if busy:
+        return {"status": "error", "message": f"Machine busy: {busy} in progress"}
+    job_state["image_profile"] = req.image_profile
+    job_state["settle_mode"] = req.settle_mode or settle.SETTLE_MODE
+    job_state["settle"] = {}
     
     # Update Job State with Metadata
+    program_name = req.program_name or program_api.current_program.name
     job_state["metadata"] = {
         "part_no": req.part_no,
         "batch_no": req.batch_no,
+        "program_name": program_name,
         "start_time": time.time()
     }
+
+    # Cascade thresholds are per program
+    if program_name == program_api.current_program.name:
+        cascade_cfg = program_api.current_program.cascade
+    else:
+        prog = program_api._load_from_disk(program_name)
+        cascade_cfg = prog.cascade if prog else None
+
+    points = req.points
+    if req.optimize_path:
+        points, report = path_optimizer.optimize_points(
+            points,
+            start=(motion.machine_pos["x"], motion.machine_pos["y"]),
+            fixed_ids=req.fixed_ids,
+        )
+        job_state["metadata"]["path_optimization"] = report
     
     # Start the background task
-    background_tasks.add_task(run_loop, req.points)
+    background_tasks.add_task(run_loop, points, program_name, cascade_cfg)
     
-    return {"status": "started", "points": len(req.points)}
+    # Clients match run events / snapshots against this id
+    return {"status": "started", "points": len(req.points), "run_id": _run_id(job_state["metadata"]["start_time"])}
 
 @router.post("/stop")
 async def stop_run():
     job_state["stop_signal"] = True
+    if job_state["is_running"]:
+        # Abort the move in progress too: the run thread may be waiting on it
+        await asyncio.to_thread(motion.controller.stop)
     return {"status": "stopping"}
 
-@router.get("/status", response_model=RunStatus)
-async def get_run_status():
+def _status() -> RunStatus:
     return RunStatus(
         is_running=job_state["is_running"],
         current_point_index=job_state["current_point_index"],
         total_points=job_state["total_points"],
+        completed_points=job_state["completed_points"],
+        run_id=job_state.get("run_id"),
         last_error=job_state["last_error"],
-        results=job_state["results"]
+        summary=dict(job_state["summary"]),
+        cascade=job_state["cascade"].to_dict() if job_state["cascade"] else None,
+        seq=bus.seq
         # In a real app, we might return metadata here too
     )
+
+@router.get("/status", response_model=RunStatus)
+async def get_run_status():
+    return _status()
+
+def _snapshot() -> Dict:
+    # Status + the live results window; results[0] is point index results_offset
+    data = _status().model_dump()
+    results = list(job_state["results"])
+    data["results"] = results
+    data["results_offset"] = job_state["completed_points"] - len(results)
+    return data
+
+@router.get("/events")
+async def run_events(request: Request, since: Optional[int] = None):
+    """
+    Server-Sent Events: run_started, point_started, point_finished, run_finished.
+    Resume with ?since=<seq> or the Last-Event-ID header (EventSource does this itself).
+    """
+    last_id = request.headers.get("last-event-id")
+    if since is None and last_id and last_id.isdigit():
+        since = int(last_id)
+    return StreamingResponse(
+        events.stream(request, bus, _snapshot, since),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,183 @@
+"""
+Inspection path optimizer.
+
+Reorders inspect points to minimise total gantry move time:
+nearest-neighbour construction followed by 2-opt refinement.
+
+Cost is the move time from motion_model: per-axis acceleration-limited
+profiles, so a move takes as long as its slowest axis (or the straight-line
+time on coordinated controllers), not euclidean distance / feed.
+"""
+import time
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from app.api.motion_model import model as motion_model
+
+
+def move_cost(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Move time (s) between point arrays a and b (broadcastable, [..., 2])."""
+    return motion_model.move_time(a, b)
+
+
+def path_cost(xy: np.ndarray, start: Optional[Sequence[float]] = None) -> float:
+    """Total move time (s) to visit xy in the given order."""
+    if len(xy) == 0:
+        return 0.0
+    total = float(move_cost(xy[:-1], xy[1:]).sum())
+    if start is not None:
+        total += float(move_cost(np.asarray(start, dtype=np.float64), xy[0]))
+    return total
+
+
+def nearest_neighbour(xy: np.ndarray, start: Sequence[float]) -> np.ndarray:
+    """Greedy tour: always go to the cheapest unvisited point next."""
+    n = len(xy)
+    order = np.empty(n, dtype=np.int64)
+    visited = np.zeros(n, dtype=bool)
+    cur = np.asarray(start, dtype=np.float64)
+    for k in range(n):
+        c = move_cost(xy, cur)
+        c[visited] = np.inf
+        nxt = int(np.argmin(c))
+        order[k] = nxt
+        visited[nxt] = True
+        cur = xy[nxt]
+    return order
+
+
+def two_opt(pts: np.ndarray, fixed_end: bool, deadline: float) -> np.ndarray:
+    """
+    2-opt on an open path through pts, in the given order. The first node is
+    pinned (the start position); if fixed_end, the last node is pinned too.
+    All candidate reversals for edge i are evaluated in one vectorised step.
+    Returns the improved order as indices into pts.
+    """
+    n = len(pts)
+    path = np.arange(n)
+    if n < 4:
+        return path
+    P = pts.copy()  # coordinates in current path order
+
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(0, n - 2):
+            if time.perf_counter() >= deadline:
+                break
+            a, b = P[i], P[i + 1]
+            ab = move_cost(a, b)
+            # Candidate second edges (c, d) = (P[j], P[j+1]) for j in [i+2, n-2]
+            c = P[i + 2:n - 1]
+            d = P[i + 3:n]
+            gain = (ab + move_cost(c, d)) - (move_cost(a, c) + move_cost(b, d))
+            if not fixed_end:
+                # Reversing the whole tail: no (c, d) edge, the path simply ends at b
+                gain = np.append(gain, ab - move_cost(a, P[n - 1]))
+            if len(gain) == 0:
+                continue
+            k = int(np.argmax(gain))
+            if gain[k] > 1e-9:
+                j = i + 2 + k
+                path[i + 1:j + 1] = path[i + 1:j + 1][::-1]
+                P[i + 1:j + 1] = P[i + 1:j + 1][::-1]
+                improved = True
+    return path
+
+
+def optimize_order(
+    xy: np.ndarray,
+    start: Sequence[float],
+    fixed: Optional[np.ndarray] = None,
+    time_limit: float = 0.3,
+) -> np.ndarray:
+    """
+    Return a visiting order (indices into xy).
+
+    Points flagged in `fixed` keep their position in the sequence; the free
+    points between two fixed ones are only reordered within that segment.
+    """
+    n = len(xy)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    if fixed is None:
+        fixed = np.zeros(n, dtype=bool)
+
+    deadline = time.perf_counter() + time_limit
+    order = np.arange(n)
+    anchors = np.flatnonzero(fixed)
+
+    # Segments of free points, each bounded by a start and maybe a fixed end
+    bounds = [-1] + anchors.tolist() + [n]
+    segments = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if hi - lo > 1:
+            segments.append((lo, hi))
+
+    nn_done = []
+    for lo, hi in segments:
+        idx = np.arange(lo + 1, hi)
+        seg_start = xy[lo] if lo >= 0 else np.asarray(start, dtype=np.float64)
+        local = nearest_neighbour(xy[idx], seg_start)
+        nn_done.append(idx[local])
+
+    # Split the 2-opt budget by segment size
+    total_free = sum(hi - lo - 1 for lo, hi in segments) or 1
+    for (lo, hi), idx in zip(segments, nn_done):
+        seg_deadline = min(deadline, time.perf_counter() + (deadline - time.perf_counter()) * (hi - lo - 1) / total_free)
+        total_free -= hi - lo - 1
+
+        # Build the node list: pinned start, free points, optional pinned end
+        seg_start = xy[lo] if lo >= 0 else np.asarray(start, dtype=np.float64)
+        nodes = [seg_start[None, :], xy[idx]]
+        fixed_end = hi < n
+        if fixed_end:
+            nodes.append(xy[hi][None, :])
+        pts = np.concatenate(nodes)
+
+        # Pinned nodes stay in place, so the inner part maps back onto idx
+        path = two_opt(pts, fixed_end, seg_deadline)
+        order[lo + 1:hi] = idx[path[1:len(idx) + 1] - 1]
+
+    return order
+
+
+def optimize_points(
+    points: List,
+    start: Optional[Sequence[float]] = None,
+    fixed_ids: Iterable[int] = (),
+    time_limit: float = 0.3,
+):
+    """
+    Reorder program points (anything with .id/.x/.y) for minimum move time.
+    Returns (reordered_points, report).
+    """
+    t0 = time.perf_counter()
+    if start is None:
+        start = (0.0, 0.0)
+    n = len(points)
+    xy = np.array([[p.x, p.y] for p in points], dtype=np.float64).reshape(n, 2)
+    fixed_set = set(fixed_ids)
+    fixed = np.array([p.id in fixed_set for p in points], dtype=bool)
+
+    before = path_cost(xy, start)
+    order = optimize_order(xy, start, fixed, time_limit)
+    after = path_cost(xy[order], start)
+
+    # Never hand back something worse than what the operator taught
+    if after > before:
+        order = np.arange(n)
+        after = before
+
+    report = {
+        "points": n,
+        "fixed_points": int(fixed.sum()),
+        "before_s": round(before, 3),
+        "after_s": round(after, 3),
+        "saved_s": round(before - after, 3),
+        "saved_percent": round(100.0 * (before - after) / before, 1) if before > 0 else 0.0,
+        "compute_ms": round((time.perf_counter() - t0) * 1000.0, 1),
+    }
+    return [points[i] for i in order], report
+
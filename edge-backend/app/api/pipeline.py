@@ -0,0 +1,189 @@
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+# Sentinel pushed through the queues to tell a worker to exit
+_STOP = object()
+
+
+class InspectionPipeline:
+    """
+    Staged inspection pipeline: Capture -> Infer -> Save.
+
+    The run loop stays responsible for Move + Capture and hands every frame to
+    `submit()`. Inference and disk writes run on worker threads connected by
+    bounded queues, so the gantry can already travel to point N+1 while frame N
+    is being inferred and saved. Threads (not processes) are enough here:
+    ONNX Runtime / OpenCV release the GIL while they work.
+
+    Results are delivered to `on_result` strictly in submit order, even with
+    several inference workers. The bounded queues give back-pressure: if the
+    model falls behind, `submit()` blocks instead of piling up frames in RAM.
+
+    infer_fn is batched: infer_fn(frames, points) -> one result per frame.
+    A worker takes whatever is already queued (up to max_batch) in one call.
+    """
+
+    def __init__(
+        self,
+        infer_fn: Callable[[List[Any], List[Any]], List[Dict]],
+        save_fn: Callable[[Any, Any], None],
+        on_result: Callable[[int, Any, Dict], None],
+        infer_workers: int = 1,
+        queue_depth: int = 4,
+        max_batch: int = 4,
+    ):
+        self.infer_fn = infer_fn
+        self.save_fn = save_fn
+        self.on_result = on_result
+        self.infer_workers = max(1, infer_workers)
+        self.max_batch = max(1, max_batch)
+
+        self._infer_q: "queue.Queue" = queue.Queue(maxsize=queue_depth)
+        self._save_q: "queue.Queue" = queue.Queue(maxsize=queue_depth)
+        self._cancel = threading.Event()
+        self._threads = []
+
+        # Reorder buffer: index -> (point, result), released in index order
+        self._pending: Dict[int, Any] = {}
+        self._next_index = 0
+        self._order_lock = threading.Lock()
+
+        self.error: Optional[BaseException] = None
+
+    # --- Lifecycle ---
+    def start(self):
+        for n in range(self.infer_workers):
+            t = threading.Thread(target=self._infer_worker, name=f"aoi-infer-{n}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._save_worker, name="aoi-save", daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def submit(self, index: int, point: Any, frame: Any) -> bool:
+        """
+        Queue a captured frame. Blocks while the pipeline is full.
+        Returns False if the pipeline was cancelled (e.g. a worker failed).
+        """
+        self._raise_if_failed()
+        return self._put(self._infer_q, (index, point, frame))
+
+    def close(self):
+        """
+        Finish all frames already submitted, then stop the workers.
+        Used on normal completion and on user stop: points that were captured
+        still get their result and image.
+        """
+        for _ in range(self.infer_workers):
+            self._put(self._infer_q, _STOP, force=True)
+        for t in self._threads[:self.infer_workers]:
+            t.join()
+        self._put(self._save_q, _STOP, force=True)
+        for t in self._threads[self.infer_workers:]:
+            t.join()
+        self._raise_if_failed()
+
+    def cancel(self):
+        """Drop all queued work and stop the workers as soon as possible."""
+        self._cancel.set()
+        for q in (self._infer_q, self._save_q):
+            try:
+                while True:
+                    q.get_nowait()
+            except queue.Empty:
+                pass
+        for _ in range(self.infer_workers):
+            self._put(self._infer_q, _STOP, force=True)
+        self._put(self._save_q, _STOP, force=True)
+        for t in self._threads:
+            t.join()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    # --- Internals ---
+    def _put(self, q: "queue.Queue", item, force: bool = False) -> bool:
+        # Poll so a cancel (or a dead worker) never leaves the caller stuck on a full queue
+        while True:
+            if self._cancel.is_set() and not force:
+                return False
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if force and self._cancel.is_set():
+                    # Workers are going away, make room for the sentinel
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _fail(self, e: BaseException):
+        if self.error is None:
+            self.error = e
+        self._cancel.set()
+
+    def _raise_if_failed(self):
+        if self.error is not None:
+            raise self.error
+
+    def _next_batch(self):
+        """Block for one item, then grab what else is already waiting. Returns (batch, stop)"""
+        item = self._infer_q.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        while len(batch) < self.max_batch:
+            try:
+                item = self._infer_q.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _infer_worker(self):
+        while True:
+            batch, stop = self._next_batch()
+            if batch and not self._cancel.is_set():
+                try:
+                    results = list(self.infer_fn([b[2] for b in batch], [b[1] for b in batch]))
+                    if len(results) != len(batch):
+                        # Every index must reach the reorder buffer, or the run stalls on the gap
+                        print(f"Inference returned {len(results)} results for {len(batch)} frames")
+                        results = results[:len(batch)] + [
+                            {"result": "ERROR", "detections": [], "reason": "no inference result"}
+                            for _ in range(len(batch) - len(results))
+                        ]
+                    for (index, point, frame), res in zip(batch, results):
+                        # Hand the frame to the writer before releasing the result
+                        self._put(self._save_q, (point, frame))
+                        self._release(index, point, res)
+                except Exception as e:
+                    self._fail(e)
+            if stop:
+                return
+
+    def _save_worker(self):
+        while True:
+            item = self._save_q.get()
+            if item is _STOP:
+                return
+            if self._cancel.is_set():
+                continue
+            point, frame = item
+            try:
+                self.save_fn(point, frame)
+            except Exception as e:
+                self._fail(e)
+
+    def _release(self, index: int, point: Any, res: Dict):
+        with self._order_lock:
+            self._pending[index] = (point, res)
+            while self._next_index in self._pending:
+                pt, r = self._pending.pop(self._next_index)
+                self.on_result(self._next_index, pt, r)
+                self._next_index += 1
@@ -3,23 +3,45 @@ from pydantic import BaseModel
 from typing import List, Optional
 import numpy as np
 import cv2 # Used for Affine Transform calculation
-from app.api import motion
+from app.api import motion, path_optimizer
+from app.api.motion_model import model as motion_model
 
 router = APIRouter()
 
+class ROI(BaseModel):
+    # Pixel rectangle in the frame captured at this point
+    x: int
+    y: int
+    w: int
+    h: int
+    part_class: str # Expected component class, e.g. "C0402"
+    name: str = "" # Designator, e.g. "C12"
+
 class Point(BaseModel):
     id: int
     x: float
     y: float
     type: str # 'ref' or 'inspect'
+    rois: List[ROI] = [] # Components covered by this point (optional)
+
+class CascadeConfig(BaseModel):
+    # Classical pre-check against the golden image before the neural model
+    enabled: bool = False
+    ok_ncc: float = 0.97 # Best NCC at or above this ...
+    ok_diff: float = 6.0 # ... and mean abs diff (gray levels) at or below this -> OK, model skipped
+    downscale: int = 4 # Compare on a 1/N size image (power of two: golden pyramid level)
+    max_shift_px: int = 16 # Alignment slack searched, full-res pixels
 
 class Program(BaseModel):
     name: str
     refs: List[Point] = []
     points: List[Point] = []
+    cascade: CascadeConfig = CascadeConfig()
 
 import os
 import json
+import asyncio
+import threading
 from glob import glob
 
 # ... imports ...
@@ -70,12 +92,34 @@ async def list_programs():
             continue
     return summaries
 
+def _optimize_program_path(program: Program, fixed_ids: Optional[List[int]] = None, time_limit_s: float = 0.3) -> dict:
+    """Reorder program.points in place for minimum move time, returns the optimizer report"""
+    # The run starts right after alignment, i.e. at the last ref
+    start = (program.refs[-1].x, program.refs[-1].y) if program.refs else (0.0, 0.0)
+    program.points, report = path_optimizer.optimize_points(
+        program.points, start=start, fixed_ids=fixed_ids or (), time_limit=time_limit_s
+    )
+    return report
+
 @router.post("/save/{name}")
-async def save_program(name: str):
+async def save_program(name: str, optimize: bool = False):
     global current_program
     current_program.name = name
+    report = _optimize_program_path(current_program) if optimize else None
     _save_to_disk(current_program)
-    return {"status": "saved", "name": name}
+    return {"status": "saved", "name": name, "optimization": report}
+
+class OptimizeRequest(BaseModel):
+    # Points that must keep their position in the sequence
+    fixed_ids: List[int] = []
+    time_limit_s: float = 0.3
+
+@router.post("/optimize")
+async def optimize_path(req: OptimizeRequest = OptimizeRequest()):
+    """Reorder inspect points of the current program to minimise total move time"""
+    global current_program
+    report = _optimize_program_path(current_program, req.fixed_ids, req.time_limit_s)
+    return {"program": current_program, "report": report}
 
 @router.post("/load/{name}")
 async def load_program(name: str):
@@ -85,14 +129,17 @@ async def load_program(name: str):
         raise HTTPException(status_code=404, detail="Program not found")
     
     current_program = p
+    # Precompute golden templates now, so the first run doesn't pay for it
+    from app.api import golden
+    await asyncio.to_thread(golden.store.load, name)
     return current_program
 
 @router.post("/record/ref/{idx}")
 async def record_ref(idx: int):
-    """Record current position as Reference Point 1, 2, or 3"""
+    """Record current position as Reference Point (fiducial) idx, any number of refs"""
     global current_program
-    if idx < 1 or idx > 3:
-        raise HTTPException(status_code=400, detail="Index must be 1, 2, or 3")
+    if idx < 1:
+        raise HTTPException(status_code=400, detail="Index must be >= 1")
     
     # Remove existing ref with this index
     current_program.refs = [p for p in current_program.refs if p.id != idx]
@@ -130,6 +177,19 @@ async def record_point():
 class PointsUpdate(BaseModel):
     points: List[Point]
 
+class ROIsUpdate(BaseModel):
+    rois: List[ROI]
+
+@router.post("/points/{point_id}/rois")
+async def update_point_rois(point_id: int, data: ROIsUpdate):
+    """Set the component ROIs inspected at one point"""
+    global current_program
+    for p in current_program.points:
+        if p.id == point_id:
+            p.rois = data.rois
+            return current_program
+    raise HTTPException(status_code=404, detail="Point not found")
+
 @router.post("/points")
 async def update_points(data: PointsUpdate):
     """Update valid points list (for reordering, deleting, editing)"""
@@ -147,6 +207,13 @@ async def clear_program():
 async def get_program():
     return current_program
 
+@router.post("/cascade")
+async def update_cascade(cfg: CascadeConfig):
+    """Set the cascade pre-check thresholds of the current program"""
+    global current_program
+    current_program.cascade = cfg
+    return current_program
+
 class AlignmentInput(BaseModel):
     # The actual coordinates measured at Runtime
     run_refs: List[Point] 
@@ -157,47 +224,84 @@ async def calculate_alignment(data: AlignmentInput):
     Calculate transform from Teaching Refs -> Runtime Refs
     And return corrected inspection points.
     """
-    if len(current_program.refs) < 2 or len(data.run_refs) < 2:
-         raise HTTPException(status_code=400, detail="Need at least 2 points for alignment")
+    return _align_program(current_program, data.run_refs)
 
-    # Extract coordinates
-    src_pts = np.float32([[p.x, p.y] for p in current_program.refs[:3]]) # Teaching
-    dst_pts = np.float32([[p.x, p.y] for p in data.run_refs[:3]])        # Runtime
+# Alignment tolerances (mm)
+ALIGN_RANSAC_THRESHOLD_MM = 0.2 # Fiducials further off than this are outliers
+ALIGN_MAX_SCALE_ERROR = 0.01 # A board doesn't shrink/stretch by more than 1%
 
-    # Determine Transformation Matrix (Affine if 3 pts, Euclidean if 2)
-    # Determine Transformation Matrix (Affine if 3 pts, Euclidean if 2)
-    if len(src_pts) >= 3 and len(dst_pts) >= 3:
-        M = cv2.getAffineTransform(src_pts[:3], dst_pts[:3])
+def apply_affine(M: np.ndarray, xy: np.ndarray) -> np.ndarray:
+    """Apply a 2x3 affine matrix to an Nx2 array in one matrix multiply"""
+    return xy @ M[:, :2].T + M[:, 2]
+
+def solve_alignment(src: np.ndarray, dst: np.ndarray):
+    """
+    Fit teach -> runtime transform from any number of fiducial pairs (Nx2 arrays).
+    >= 4 pairs: RANSAC affine (estimateAffine2D), bad fiducials become outliers.
+    3 pairs: exact affine, sanity-checked for scale/shear (no redundancy to vote with).
+    2 pairs: rotation + translation + uniform scale.
+    Returns (M 2x3, inlier mask, residuals in mm).
+    """
+    n = len(src)
+    inliers = np.ones(n, dtype=bool)
+    if n >= 4:
+        M, mask = cv2.estimateAffine2D(src, dst, method=cv2.RANSAC,
+                                       ransacReprojThreshold=ALIGN_RANSAC_THRESHOLD_MM,
+                                       maxIters=2000, confidence=0.999, refineIters=10)
+        if M is not None:
+            inliers = mask.ravel().astype(bool)
+    elif n == 3:
+        M = cv2.getAffineTransform(src.astype(np.float32), dst.astype(np.float32))
     else:
-        # Fallback to Euclidean (Rotation + Translation) for 2 points
         # estimateAffinePartial2D handles 2 points perfectly
-        M, _ = cv2.estimateAffinePartial2D(src_pts, dst_pts)
-        if M is None:
-             # Absolute Fallback (just translation) if something fails
-            dx = dst_pts[0][0] - src_pts[0][0]
-            dy = dst_pts[0][1] - src_pts[0][1]
-            M = np.float32([[1, 0, dx], [0, 1, dy]])
-        
-    # Apply to all inspection points
-    corrected_points = []
-    for p in current_program.points:
-        # [x, y, 1]
-        original = np.array([p.x, p.y, 1.0])
-        # M is 2x3, but we need dot product
-        # corrected = M * original
-        new_x = (original[0] * M[0,0]) + (original[1] * M[0,1]) + M[0,2]
-        new_y = (original[0] * M[1,0]) + (original[1] * M[1,1]) + M[1,2]
-        
-        corrected_points.append(Point(
-            id=p.id,
-            x=round(float(new_x), 2),
-            y=round(float(new_y), 2),
-            type="inspect"
-        ))
-        
+        M, _ = cv2.estimateAffinePartial2D(src, dst)
+
+    if M is None:
+        # Absolute Fallback (just translation) if something fails
+        d = (dst - src).mean(axis=0)
+        M = np.array([[1, 0, d[0]], [0, 1, d[1]]], dtype=np.float64)
+
+    residuals = np.linalg.norm(apply_affine(M, src) - dst, axis=1)
+    return M.astype(np.float64), inliers, residuals
+
+def _align_program(program: Program, run_refs: List[Point]) -> dict:
+    """Fit teach refs -> measured refs, applied to all inspect points"""
+    # Pair fiducials by id (refs can be measured in any order / some skipped)
+    measured = {p.id: p for p in run_refs}
+    pairs = [(t, measured[t.id]) for t in program.refs if t.id in measured]
+    if not pairs:
+        pairs = list(zip(program.refs, run_refs))
+    if len(pairs) < 2:
+         raise HTTPException(status_code=400, detail="Need at least 2 points for alignment")
+
+    src_pts = np.array([[t.x, t.y] for t, _ in pairs], dtype=np.float64) # Teaching
+    dst_pts = np.array([[r.x, r.y] for _, r in pairs], dtype=np.float64) # Runtime
+    M, inliers, residuals = solve_alignment(src_pts, dst_pts)
+
+    if inliers.sum() < min(3, len(pairs)):
+        raise HTTPException(status_code=422, detail="Fiducials are inconsistent, alignment rejected")
+    # Singular values of the linear part = scale along the principal axes
+    scales = np.linalg.svd(M[:, :2], compute_uv=False)
+    if np.abs(scales - 1.0).max() > ALIGN_MAX_SCALE_ERROR:
+        raise HTTPException(status_code=422, detail=f"Implausible board scale {scales.round(4).tolist()}, check fiducials")
+
+    # Apply to all inspection points at once
+    xy = np.array([[p.x, p.y] for p in program.points], dtype=np.float64).reshape(-1, 2)
+    corrected = np.round(apply_affine(M, xy), 3)
+    corrected_points = [
+        Point(id=p.id, x=x, y=y, type="inspect", rois=p.rois)
+        for p, (x, y) in zip(program.points, corrected.tolist())
+    ]
+
     return {
         "matrix": M.tolist(),
-        "corrected_points": corrected_points
+        "corrected_points": corrected_points,
+        "fiducial_residuals": [
+            {"id": t.id, "residual_mm": round(float(res), 4), "inlier": bool(ok)}
+            for (t, _), res, ok in zip(pairs, residuals, inliers)
+        ],
+        "rejected_refs": [t.id for (t, _), ok in zip(pairs, inliers) if not ok],
+        "rms_mm": round(float(np.sqrt(np.mean(residuals[inliers] ** 2))), 4),
     }
 
 def _generate_fluidnc_gcode(program: Program) -> str:
@@ -219,10 +323,12 @@ def _generate_fluidnc_gcode(program: Program) -> str:
         
     # 2. Inspection Points
     lines.append("(INSPECTION START)")
+    # Dwell = the machine's calibrated settle time (see /api/motion/settle/apply)
+    settle = motion_model.params.settle_s
     for pt in program.points:
         lines.append(f"(POINT {pt.id})")
         lines.append(f"G0 X{pt.x:.3f} Y{pt.y:.3f}")
-        lines.append("G4 P0.5 (Wait for settling)")
+        lines.append(f"G4 P{settle:.3f} (Wait for settling)")
         # Trigger Camera (e.g., M62/M63 or specific M-code)
         lines.append("M62 P1 (Trigger Camera)")
         lines.append("G4 P0.1")
@@ -243,6 +349,38 @@ async def export_gcode(name: str):
     from fastapi.responses import PlainTextResponse
     return PlainTextResponse(gcode, media_type="text/plain", headers={"Content-Disposition": f"attachment; filename={name}.nc"})
 
+# Program streamed to the motion controller (GET /stream/status)
+stream_job = {"name": None, "running": False, "sent": 0, "total": 0, "error": None}
+
+def _stream_program(name: str, lines: List[str]):
+    try:
+        motion.controller.stream(lines, on_progress=lambda n: stream_job.update(sent=n))
+        motion.controller.wait_idle()
+    except Exception as e:
+        stream_job["error"] = str(e)
+        print(f"G-code stream of {name} failed: {e}")
+    finally:
+        stream_job["running"] = False
+
+@router.post("/{name}/stream")
+async def stream_gcode(name: str):
+    """Run the program's G-code on the controller (character-counting stream, not line by line)"""
+    p = _load_from_disk(name)
+    if not p:
+        raise HTTPException(status_code=404, detail="Program not found")
+    if not hasattr(motion.controller, "stream"):
+        raise HTTPException(status_code=409, detail="Motion controller does not accept G-code (set AOI_MOTION_PORT)")
+    if stream_job["running"]:
+        raise HTTPException(status_code=409, detail=f"Already streaming {stream_job['name']}")
+    lines = [l for l in _generate_fluidnc_gcode(p).splitlines() if l.strip() not in ("", "%")]
+    stream_job.update(name=name, running=True, sent=0, total=len(lines), error=None)
+    threading.Thread(target=_stream_program, args=(name, lines), daemon=True).start()
+    return stream_job
+
+@router.get("/stream/status")
+async def stream_status():
+    return stream_job
+
 @router.delete("/{name}")
 async def delete_program(name: str):
     path = os.path.join(DATA_DIR, f"{name}.json")
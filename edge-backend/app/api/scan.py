@@ -2,10 +2,14 @@ from fastapi import APIRouter
 from pydantic import BaseModel
 from typing import List
 import math
-from app.api import motion
+import os
+from app.api import motion, camera
 
 router = APIRouter()
 
+# Raster / fly-scan results (tiles, mosaics), one directory per scan
+SCANS_DIR = os.getenv("AOI_SCANS_DIR", "/app/data/scans")
+
 class ScanConfig(BaseModel):
     width_mm: float
     height_mm: float
@@ -18,47 +22,42 @@ class ScanPoint(BaseModel):
     machine_x: float
     machine_y: float
 
+def grid(config: ScanConfig):
+    """Tile centres of the raster covering the board (work coordinates): xs, ys, step_x, step_y"""
+    # Calibrated FOV (pixels * mm_per_pixel), nominal 40 x 30 mm until calibrated
+    fov_w, fov_h = camera.fov_mm()
+    # Step size considering overlap
+    step_x = fov_w * (1 - config.overlap_percent)
+    step_y = fov_h * (1 - config.overlap_percent)
+    cols = math.ceil(config.width_mm / step_x)
+    rows = math.ceil(config.height_mm / step_y)
+    return [c * step_x for c in range(cols)], [r * step_y for r in range(rows)], step_x, step_y
+
 @router.post("/preview", response_model=List[ScanPoint])
 async def preview_scan_path(config: ScanConfig):
     """
     Generate a Zigzag (S-curve) scanning path based on:
     1. PCB Dimensions
     2. Current Work Offset (G54) from motion module
-    3. Camera FOV (Simulated as 40mm x 30mm)
+    3. Camera FOV (calibrated; 40mm x 30mm nominal)
     """
     
     # 1. Get current Offset (The "Origin Compensation" user asked about)
     offset_x = motion.work_offset["x"]
     offset_y = motion.work_offset["y"]
     
-    # 2. Camera Field of View Settings (Simulated)
-    # In real world, this comes from calibration (pixels * mm_per_pixel)
-    FOV_W = 40.0 
-    FOV_H = 30.0
-    
-    # 3. Calculate Step Size (considering overlap)
-    step_x = FOV_W * (1 - config.overlap_percent)
-    step_y = FOV_H * (1 - config.overlap_percent)
-    
-    cols = math.ceil(config.width_mm / step_x)
-    rows = math.ceil(config.height_mm / step_y)
+    # 2. + 3. Tile raster from the FOV, considering overlap
+    xs, ys, _, _ = grid(config)
     
     path = []
     point_id = 1
     
     # 4. Generate Zigzag Path
-    for row in range(rows):
-        y = row * step_y
-        
+    for row, y in enumerate(ys):
         # Determine direction for this row (Zigzag)
-        if row % 2 == 0:
-            col_range = range(cols)      # Left to Right
-        else:
-            col_range = range(cols-1, -1, -1) # Right to Left
-            
-        for col in col_range:
-            x = col * step_x
+        row_xs = xs if row % 2 == 0 else xs[::-1] # Left to Right / Right to Left
             
+        for x in row_xs:
             # Create Point
             p = ScanPoint(
                 id=point_id,
@@ -0,0 +1,185 @@
+"""
+Vision-based settle detection.
+
+Instead of sleeping a fixed time after the controller reports idle, watch
+the camera: consecutive frames are compared on a downscaled centre ROI with
+phase correlation (residual vibration shows up as a sub-pixel shift) and a
+sharpness score (variance of the Laplacian, drops with motion blur). The
+first frame that barely moved against its predecessor and is just as sharp
+is the capture, so short moves don't pay for the worst-case settle. A
+timeout bounds the wait.
+
+Every measurement is kept (with the move distance) for /api/motion/settle:
+percentiles per move length tell how hard the gantry rings, and the
+recommended fixed settle (used for the G-code dwell) comes from them.
+"""
+from fastapi import APIRouter, HTTPException
+from collections import deque
+from typing import Dict, Optional, Tuple
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from app.api import camera
+from app.api.motion_model import model as motion_model
+
+router = APIRouter()
+
+# "fixed" (motion model settle_s) or "vision"
+SETTLE_MODE = os.getenv("AOI_SETTLE_MODE", "fixed")
+MAX_SHIFT_PX = float(os.getenv("AOI_SETTLE_MAX_SHIFT_PX", "0.5")) # Full-res pixels between frames
+SHARPNESS_RATIO = 0.9 # Consecutive frames at least this similar in sharpness (no blur change)
+ROI_FRACTION = 0.5 # Centre crop (of width and height) that is compared
+DOWNSCALE = 4
+TIMEOUT_S = float(os.getenv("AOI_SETTLE_TIMEOUT_S", "1.5"))
+HISTORY = 2000 # Measurements kept for the statistics
+
+
+def _prepare(frame: np.ndarray, downscale: int = DOWNSCALE) -> np.ndarray:
+    """Grey, centre ROI, downscaled, float32 (what phaseCorrelate wants)"""
+    h, w = frame.shape[:2]
+    rh, rw = int(h * ROI_FRACTION), int(w * ROI_FRACTION)
+    y0, x0 = (h - rh) // 2, (w - rw) // 2
+    roi = frame[y0:y0 + rh, x0:x0 + rw]
+    if roi.ndim == 3:
+        roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+    if downscale > 1:
+        roi = cv2.resize(roi, (rw // downscale, rh // downscale), interpolation=cv2.INTER_AREA)
+    return roi.astype(np.float32)
+
+
+def sharpness(img: np.ndarray) -> float:
+    return float(cv2.Laplacian(img, cv2.CV_32F).var())
+
+
+class SettleDetector:
+    def __init__(self, max_shift_px: float = MAX_SHIFT_PX, sharpness_ratio: float = SHARPNESS_RATIO,
+                 downscale: int = DOWNSCALE, timeout: float = TIMEOUT_S):
+        self.max_shift_px = max_shift_px
+        self.sharpness_ratio = sharpness_ratio
+        self.downscale = downscale
+        self.timeout = timeout
+        self._window = None
+        self.samples: "deque[Dict]" = deque(maxlen=HISTORY)
+        self._lock = threading.Lock()
+
+    def _hann(self, shape) -> np.ndarray:
+        if self._window is None or self._window.shape != shape:
+            self._window = cv2.createHanningWindow((shape[1], shape[0]), cv2.CV_32F)
+        return self._window
+
+    def wait(self, since: float, timeout: Optional[float] = None) -> Tuple[np.ndarray, Dict]:
+        """
+        Frames exposed after `since` (time.monotonic() when the controller reported
+        idle) until one is stable. Returns (frame, info); info["settle_s"] is the time
+        from `since` to that frame's exposure.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = since + timeout
+        frame, ts, seq = camera.read_frame(after=since)
+        prev = _prepare(frame, self.downscale)
+        win = self._hann(prev.shape)
+        prev_sharp = sharpness(prev)
+        frames, shift = 1, None
+        while True:
+            if ts >= deadline:
+                return frame, self._info(since, ts, frames, shift, prev_sharp, timed_out=True)
+            frame, ts, seq = camera.read_frame(after_seq=seq)
+            cur = _prepare(frame, self.downscale)
+            # Windowed copies: phaseCorrelate may window its inputs in place
+            (dx, dy), _ = cv2.phaseCorrelate((prev - prev.mean()) * win, (cur - cur.mean()) * win)
+            shift = float(np.hypot(dx, dy)) * self.downscale
+            sharp = sharpness(cur)
+            frames += 1
+            if shift <= self.max_shift_px and min(sharp, prev_sharp) >= self.sharpness_ratio * max(sharp, prev_sharp):
+                return frame, self._info(since, ts, frames, shift, sharp, timed_out=False)
+            prev, prev_sharp = cur, sharp
+
+    def _info(self, since: float, ts: float, frames: int, shift: Optional[float], sharp: float, timed_out: bool) -> Dict:
+        return {
+            "settle_s": round(max(0.0, ts - since), 4),
+            "frames": frames,
+            "shift_px": None if shift is None else round(shift, 3),
+            "sharpness": round(sharp, 1),
+            "timed_out": timed_out,
+        }
+
+    def record(self, distance_mm: float, move_s: float, info: Dict):
+        with self._lock:
+            self.samples.append({"distance_mm": distance_mm, "move_s": move_s, **info})
+
+    def stats(self) -> Dict:
+        with self._lock:
+            samples = list(self.samples)
+        if not samples:
+            return {"samples": 0}
+        t = np.array([s["settle_s"] for s in samples])
+        d = np.array([s["distance_mm"] for s in samples])
+        bins = []
+        edges = [0.0, 5.0, 20.0, 50.0, 100.0, np.inf]
+        for lo, hi in zip(edges[:-1], edges[1:]):
+            sel = t[(d >= lo) & (d < hi)]
+            if len(sel):
+                bins.append({
+                    "distance_mm": [lo, None if np.isinf(hi) else hi],
+                    "samples": int(len(sel)),
+                    "p50_s": round(float(np.percentile(sel, 50)), 3),
+                    "p95_s": round(float(np.percentile(sel, 95)), 3),
+                    "max_s": round(float(sel.max()), 3),
+                })
+        return {
+            "samples": len(samples),
+            "timed_out": sum(1 for s in samples if s["timed_out"]),
+            "p50_s": round(float(np.percentile(t, 50)), 3),
+            "p95_s": round(float(np.percentile(t, 95)), 3),
+            "max_s": round(float(t.max()), 3),
+            "by_distance": bins,
+            # A fixed settle that covers almost every measured move (G-code dwell, "fixed" mode)
+            "recommended_settle_s": round(float(np.percentile(t, 99)), 3),
+            "current_settle_s": motion_model.params.settle_s,
+        }
+
+
+detector = SettleDetector()
+last_mode: Optional[str] = None # Mode of the last settle (runs may override SETTLE_MODE)
+
+
+def wait_settled(since: float, distance_mm: float = 0.0, move_s: float = 0.0,
+                 mode: Optional[str] = None) -> Tuple[np.ndarray, Dict]:
+    """
+    Called once the controller reported idle: returns (capture frame, info).
+    "fixed": sleep the calibrated settle time, then the first frame after it.
+    "vision": the first stable frame (see SettleDetector).
+    """
+    global last_mode
+    mode = mode or SETTLE_MODE
+    last_mode = mode
+    if mode == "vision":
+        frame, info = detector.wait(since)
+        detector.record(distance_mm, move_s, info)
+        return frame, info
+    settle = motion_model.params.settle_s
+    remaining = since + settle - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+    frame, ts, _ = camera.read_frame(after=time.monotonic())
+    return frame, {"settle_s": settle}
+
+
+@router.get("/stats")
+async def settle_stats():
+    return {"mode": last_mode or SETTLE_MODE, "default_mode": SETTLE_MODE, **detector.stats()}
+
+@router.post("/apply")
+async def apply_recommended():
+    """Store the recommended settle as the machine's fixed settle (also the G-code dwell)"""
+    st = detector.stats()
+    if not st["samples"]:
+        raise HTTPException(status_code=400, detail="No settle measurements yet (run with settle mode 'vision')")
+    params = motion_model.params.model_copy()
+    params.settle_s = st["recommended_settle_s"]
+    motion_model.update(params)
+    return {"settle_s": params.settle_s, "samples": st["samples"]}
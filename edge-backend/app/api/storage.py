@@ -0,0 +1,151 @@
+"""
+Asynchronous image persistence.
+
+Callers hand frames to a pool of writer threads through a bounded queue and
+carry on; encoding (cv2.imencode) and the file write happen in the background.
+Each write uses a codec profile (JPEG for inspection images, lossless PNG/WebP
+for golden and training captures) and can emit downscaled review variants.
+Queue depth, bytes written and per-write latency are exposed so it is visible
+when SD/USB storage becomes the bottleneck.
+"""
+from fastapi import APIRouter
+from collections import deque
+from typing import Dict, List, Optional
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+router = APIRouter()
+
+WRITER_THREADS = int(os.getenv("AOI_WRITER_THREADS", "2"))
+WRITER_QUEUE = int(os.getenv("AOI_WRITER_QUEUE", "16")) # Frames waiting; submit() blocks beyond this
+JPEG_QUALITY = int(os.getenv("AOI_JPEG_QUALITY", "90"))
+REVIEW_WIDTH = int(os.getenv("AOI_REVIEW_WIDTH", "320")) # 0 disables the review thumbnail
+
+# Codec profiles: file extension + cv2.imencode params
+PROFILES = {
+    "inspection": {"ext": ".jpg", "params": [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]},
+    "golden": {"ext": ".png", "params": [cv2.IMWRITE_PNG_COMPRESSION, 1]}, # lossless, fast
+    "training": {"ext": ".webp", "params": [cv2.IMWRITE_WEBP_QUALITY, 101]}, # >100 = lossless WebP
+    "review": {"ext": ".jpg", "params": [cv2.IMWRITE_JPEG_QUALITY, 75]},
+}
+
+def image_name(stem: str, profile: str = "inspection") -> str:
+    return stem + PROFILES[profile]["ext"]
+
+def review_name(stem: str) -> str:
+    return image_name(stem + "_review", "review")
+
+
+class ImageWriter:
+    """Bounded queue + writer threads. Started lazily on first submit."""
+    def __init__(self, workers: int = WRITER_THREADS, queue_depth: int = WRITER_QUEUE):
+        self.workers = workers
+        self._q: "queue.Queue" = queue.Queue(maxsize=queue_depth)
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self.files = 0
+        self.bytes_written = 0
+        self.errors = 0
+        self.last_error: Optional[str] = None
+        self.blocked_s = 0.0 # Time callers spent waiting for queue space
+        self._latencies = deque(maxlen=500) # (encode_ms, write_ms)
+
+    def _ensure_started(self):
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker, name=f"aoi-writer-{len(self._threads)}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, directory: str, stem: str, image: np.ndarray,
+               profile: str = "inspection", review_width: int = REVIEW_WIDTH) -> str:
+        """
+        Queue an image for writing, returns the file name it will have.
+        The frame must not be modified by the caller afterwards (it is not copied).
+        """
+        self._ensure_started()
+        t0 = time.perf_counter()
+        self._q.put((directory, stem, image, profile, review_width))
+        waited = time.perf_counter() - t0
+        if waited > 0.001:
+            with self._lock:
+                self.blocked_s += waited
+        return image_name(stem, profile)
+
+    def drain(self):
+        """Block until everything submitted so far is on disk"""
+        self._q.join()
+
+    def _write(self, path: str, image: np.ndarray, profile: str) -> int:
+        p = PROFILES[profile]
+        t0 = time.perf_counter()
+        ok, buf = cv2.imencode(p["ext"], image, p["params"])
+        if not ok:
+            raise RuntimeError(f"Encoding {path} failed")
+        t1 = time.perf_counter()
+        # Write + rename: readers (review UI) never see half-written files
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(buf.tobytes())
+        os.replace(tmp, path)
+        t2 = time.perf_counter()
+        with self._lock:
+            self.files += 1
+            self.bytes_written += len(buf)
+            self._latencies.append(((t1 - t0) * 1000.0, (t2 - t1) * 1000.0))
+        return len(buf)
+
+    def _worker(self):
+        while True:
+            directory, stem, image, profile, review_width = self._q.get()
+            try:
+                self._write(os.path.join(directory, image_name(stem, profile)), image, profile)
+                if review_width and image.shape[1] > review_width:
+                    h = int(image.shape[0] * review_width / image.shape[1])
+                    small = cv2.resize(image, (review_width, h), interpolation=cv2.INTER_AREA)
+                    self._write(os.path.join(directory, review_name(stem)), small, "review")
+            except Exception as e:
+                print(f"Image write failed ({stem}): {e}")
+                with self._lock:
+                    self.errors += 1
+                    self.last_error = str(e)
+            finally:
+                self._q.task_done()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lat = np.array(self._latencies) if self._latencies else np.zeros((0, 2))
+            total = lat.sum(axis=1) if len(lat) else lat
+            return {
+                "queue_depth": self._q.qsize(),
+                "queue_capacity": self._q.maxsize,
+                "workers": self.workers,
+                "files": self.files,
+                "bytes_written": self.bytes_written,
+                "errors": self.errors,
+                "last_error": self.last_error,
+                "blocked_s": round(self.blocked_s, 3),
+                "encode_ms_avg": round(float(lat[:, 0].mean()), 2) if len(lat) else None,
+                "write_ms_avg": round(float(lat[:, 1].mean()), 2) if len(lat) else None,
+                "latency_ms_p95": round(float(np.percentile(total, 95)), 2) if len(lat) else None,
+            }
+
+    def stats_since(self, before: Dict) -> Dict:
+        """stats() with the counters taken relative to an earlier stats() snapshot (one run)"""
+        now = self.stats()
+        for k in ("files", "bytes_written", "errors"):
+            now[k] -= before[k]
+        now["blocked_s"] = round(now["blocked_s"] - before["blocked_s"], 3)
+        return now
+
+writer = ImageWriter()
+
+@router.get("/stats")
+async def storage_stats():
+    return writer.stats()
@@ -14,6 +14,7 @@ app.add_middleware(
 
 from fastapi.staticfiles import StaticFiles
 import os
+import threading
 os.makedirs("/app/data/history", exist_ok=True)
 app.mount("/data/history", StaticFiles(directory="/app/data/history"), name="history")
 
@@ -27,6 +28,74 @@ app.include_router(inference.router, prefix="/api/inference", tags=["inference"]
 from app.api import orchestrator
 app.include_router(orchestrator.router, prefix="/api/orchestrator", tags=["orchestrator"])
 
+from app.api import golden
+app.include_router(golden.router, prefix="/api/golden", tags=["golden"])
+
+from app.api import fiducial
+app.include_router(fiducial.router, prefix="/api/fiducial", tags=["fiducial"])
+
+from app.api import storage
+app.include_router(storage.router, prefix="/api/storage", tags=["storage"])
+
+from app.api import export
+app.include_router(export.router, prefix="/api/export", tags=["export"])
+
+from app.api import analytics
+app.include_router(analytics.router, prefix="/api/analytics", tags=["analytics"])
+
+from app.api import motion_model
+app.include_router(motion_model.router, prefix="/api/motion/model", tags=["motion"])
+
+from app.api import settle
+app.include_router(settle.router, prefix="/api/motion/settle", tags=["motion"])
+
+from app.api import flyscan
+app.include_router(flyscan.router, prefix="/api/scan/fly", tags=["scan"])
+
+from app.api import coverage
+app.include_router(coverage.router, prefix="/api/scan/coverage", tags=["scan"])
+
+from app.api import cad_import
+app.include_router(cad_import.router, prefix="/api/program", tags=["program"])
+
+# Scan tiles + mosaic zoom pyramids (mosaic.dzi, mosaic_files/...)
+from app.api import mosaic
+os.makedirs(mosaic.SCANS_DIR, exist_ok=True)
+app.mount("/data/scans", StaticFiles(directory=mosaic.SCANS_DIR), name="scans")
+app.include_router(mosaic.router, prefix="/api/mosaic", tags=["mosaic"])
+
+from app.api import calibration
+app.include_router(calibration.router, prefix="/api/calibration", tags=["camera"])
+
+def _sync_history(history_dir: str):
+    from app.api import history_index, analytics, orchestrator
+    try:
+        if history_index.count() == 0 and any(os.scandir(history_dir)):
+            state = orchestrator.job_state
+            active = [state["run_id"]] if state["is_running"] and state.get("run_id") else []
+            history_index.rebuild(history_dir, exclude=active)
+        analytics.catch_up(history_dir)
+    except Exception as e:
+        print(f"History sync failed: {e}")
+
+@app.on_event("startup")
+async def startup():
+    # Motion backend: built-in simulation, or a GRBL/FluidNC controller streamed over serial/TCP
+    from app.api import gcode_stream
+    motion.set_controller(gcode_stream.connect(os.getenv("AOI_MOTION_PORT", "")))
+    # Camera calibration: scale + undistortion / flat-field LUTs for the capture thread
+    calibration.load_and_apply()
+    # Load + warm up the model once, before the first board
+    inference.engine.load()
+    inference.classifier.load()
+    # Background: build the history index on first start (or after it was deleted),
+    # then ingest runs the analytics arrays don't have yet
+    threading.Thread(target=_sync_history, args=("/app/data/history",), daemon=True).start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    camera.stop_capture()
+
 @app.get("/api/health")
 async def health_check():
     return {"status": "ok", "mode": "simulation"}
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react'
+import React, { useState, useEffect, useRef } from 'react'
 import { Crosshair, Camera, AlertTriangle, CheckCircle } from 'lucide-react'
 import { clsx } from 'clsx'
 import { twMerge } from 'tailwind-merge'
@@ -61,10 +61,26 @@ function App() {
 
 
     useEffect(() => {
-        const i = setInterval(fetchStatus, 500)
+        // Position/state pushed by the backend on every controller report
+        let ws: WebSocket | null = null
+        let retry: any
+        const connect = () => {
+            const proto = window.location.protocol === 'https:' ? 'wss' : 'ws'
+            ws = new WebSocket(`${proto}://${window.location.host}/api/motion/ws`)
+            ws.onmessage = (e: MessageEvent) => setStatus(JSON.parse(e.data))
+            ws.onclose = () => { retry = setTimeout(connect, 1000) }
+        }
+        fetchStatus()
+        connect()
         fetchProgram()
         fetchProgList()
-        return () => clearInterval(i)
+        return () => {
+            clearTimeout(retry)
+            if (ws) {
+                ws.onclose = null
+                ws.close()
+            }
+        }
     }, [])
 
     // --- HANDLERS ---
@@ -82,23 +98,20 @@ function App() {
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ axis, distance: dist })
         })
-        fetchStatus()
     }
 
     const handleHome = async () => {
         if (!confirm("Return to Machine Zero?")) return
         await fetch('/api/motion/home', { method: 'POST' })
-        fetchStatus()
     }
 
     const moveToAbsolute = async (x: number, y: number) => {
-        // Calculate diff because our API is relative jog
-        // Note: In real app, we should have an absolute move API
-        const dx = x - status.machine.x
-        const dy = y - status.machine.y
-
-        if (Math.abs(dx) > 0.1) await handleJog('x', dx)
-        if (Math.abs(dy) > 0.1) await handleJog('y', dy)
+        // Resolves once the machine is there
+        await fetch('/api/motion/move', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ x, y, wait: true })
+        })
     }
 
     const handleRecordRef = async (idx: number) => {
@@ -187,33 +200,57 @@ function App() {
         }
     }
 
-    // --- ORCHESTRATOR POLLING ---
+    // Run id returned by /orchestrator/start; events and snapshots of other runs are ignored
+    const runIdRef = useRef<string | null>(null)
+
+    // --- ORCHESTRATOR EVENTS (SSE) ---
     useEffect(() => {
-        let interval: any
-        if (alignState === 'running') {
-            interval = setInterval(async () => {
-                try {
-                    const res = await fetch('/api/orchestrator/status')
-                    const data = await res.json()
-
-                    if (data.is_running) {
-                        setIsRunning(true)
-                        setRunIndex(data.current_point_index)
-                        // Update results gracefully
-                        setRunResults(data.results)
-                    } else {
-                        // Job finished
-                        setIsRunning(false)
-                        setRunResults(data.results)
-                        setAlignState('idle') // Return to idle
-                        clearInterval(interval)
-                    }
-                } catch (e) {
-                    console.error("Orchestrator poll failed", e)
-                }
-            }, 500)
-        }
-        return () => clearInterval(interval)
+        if (alignState !== 'running') return
+        // EventSource reconnects by itself and resumes from Last-Event-ID
+        const es = new EventSource('/api/orchestrator/events')
+        let offset = 0 // Point index of runResults[0]
+
+        es.addEventListener('snapshot', (e: MessageEvent) => {
+            const data = JSON.parse(e.data)
+            if (!data.is_running) {
+                if (data.run_id !== runIdRef.current) return // Previous run; ours has not started yet
+                // Ours already ended (finished before we connected, or while reconnecting)
+                setIsRunning(false)
+                setAlignState('idle')
+                es.close()
+                return
+            }
+            setIsRunning(true)
+            setRunIndex(data.current_point_index)
+            offset = data.results_offset
+            setRunResults(data.results)
+        })
+        es.addEventListener('run_started', () => {
+            setIsRunning(true)
+            setRunIndex(0)
+            offset = 0
+            setRunResults([])
+        })
+        es.addEventListener('point_started', (e: MessageEvent) => {
+            setRunIndex(JSON.parse(e.data).current_point_index)
+        })
+        es.addEventListener('point_finished', (e: MessageEvent) => {
+            const data = JSON.parse(e.data)
+            // Keyed by index: an event replayed after a snapshot just overwrites itself
+            setRunResults(prev => {
+                const next = [...prev]
+                next[data.index - offset] = data.result
+                return next
+            })
+        })
+        es.addEventListener('run_finished', () => {
+            setIsRunning(false)
+            setAlignState('idle') // Return to idle
+            es.close()
+        })
+        es.onerror = () => console.error("Orchestrator event stream interrupted, reconnecting")
+
+        return () => es.close()
     }, [alignState])
 
     // Run Metadata State
@@ -229,18 +266,33 @@ function App() {
                 body: JSON.stringify({ run_refs: refs })
             })
             const data = await res.json()
+            if (!res.ok) {
+                // e.g. 422: scale / outlier check rejected the measured refs
+                alert(`Alignment Failed: ${data.detail ?? res.statusText}`)
+                setAlignState('idle')
+                return
+            }
 
             // 2. Start Backend Orchestrator
-            setAlignState('running') // Start polling
-            await fetch('/api/orchestrator/start', {
+            const startRes = await fetch('/api/orchestrator/start', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
                     points: data.corrected_points,
                     part_no: partNo,
-                    batch_no: batchNo
+                    batch_no: batchNo,
+                    program_name: program.name
                 })
             })
+            const started = await startRes.json()
+            if (!startRes.ok || started.status !== 'started') {
+                const detail = started.message ?? (typeof started.detail === 'string' ? started.detail : startRes.statusText)
+                alert(`Run not started: ${detail}`)
+                setAlignState('idle')
+                return
+            }
+            runIdRef.current = started.run_id
+            setAlignState('running') // Subscribe to run events
 
         } catch (e) {
             alert("Alignment Failed!")
@@ -16,6 +16,7 @@ export default defineConfig({
             '/api': {
                 target: 'http://edge-backend:8000',
                 changeOrigin: true,
+                ws: true, // /api/motion/ws
             }
         }
     }